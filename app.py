@@ -19,7 +19,11 @@ from routers.auth_router import auth_router, jwt
 # from routers.admin_router import admin_router
 from routers.gemini_router import gemini_router
 from routers.websocket_router import socket_router
+from routers.telegram_router import telegram_router
+from utils.telegram.update_queue import get_update_queue
+from utils.ai.prompt_registry import prompt_watcher
 from models import db, User
+from models.migrations import upgrade_schema
 
 
 # Configure logging
@@ -55,11 +59,45 @@ app.register_blueprint(auth_router, url_prefix='/auth')
 # Register FastAPI routers
 fastapi_app.include_router(gemini_router, prefix="/api")
 fastapi_app.include_router(socket_router, prefix="/api")
+fastapi_app.include_router(telegram_router, prefix="/api")
 
 
 fastapi_app.mount("/", WSGIMiddleware(app))
 
 
+@fastapi_app.on_event("startup")
+async def start_prompt_watcher():
+  """Hot-reload prompt configs while the server runs."""
+  if prompt_watcher.interval > 0:
+    prompt_watcher.start()
+
+
+@fastapi_app.on_event("startup")
+async def open_telegram_update_queue():
+  """Fail startup, rather than drop updates, if the webhook queue is unusable."""
+  if not os.getenv("TELEGRAM_WEBHOOK_SECRET"):
+    logger.warning("TELEGRAM_WEBHOOK_SECRET is not set; the Telegram webhook rejects all updates")
+    return
+  get_update_queue()
+
+
+@fastapi_app.on_event("shutdown")
+async def stop_prompt_watcher():
+  prompt_watcher.stop()
+
+
+@fastapi_app.on_event("shutdown")
+async def stop_validation_pool():
+  # Imported here so webrtcvad stays off the boot path
+  from services.audio_validation import validation_pool
+  validation_pool.shutdown(wait=False)
+
+
+@fastapi_app.on_event("shutdown")
+async def close_s3_client():
+  await s3_service.close()
+
+
 def init_s3():
   """Initialize S3 connection."""
   try:
@@ -81,6 +119,8 @@ with app.app_context():
     logger.info("Database tables created successfully")
   else:
     logger.info("Database tables already exist")
+    # create_all skips existing tables, so apply changes to them here
+    upgrade_schema(db.engine)
 
   # Initialize S3 after database setup
   init_s3()
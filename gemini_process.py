@@ -2,6 +2,8 @@
 # Updated to support unified batch processing with a single consolidated result
 
 import logging
+import asyncio
+import threading
 import re
 import json
 import os
@@ -9,11 +11,18 @@ import datetime
 # Add this import to the gemini_config imports
 import google.generativeai as genai
 from google.ai.generativelanguage_v1beta.types import content
-from typing import Dict, List, Union, Any, TypedDict
+from typing import Dict, List, Tuple, Union, Any, Optional, TypedDict
 from dotenv import load_dotenv
 from utils.ai.gemini_chat_formatter import _format_chat_messages
 from utils.ai.extract_json_from_response import extract_json_from_response
-from utils.ai.json_prompt_types_loader import ConfigLoader
+from utils.ai.prompt_registry import get_prompt_registry, CompiledPrompt
+from utils.ai.model_registry import model_registry
+from utils.ai.gemini_scheduler import gemini_scheduler, Priority
+from utils.ai.rate_limiter import rate_limiter, is_rate_limit_error
+from utils.ai.token_counter import token_counter
+from utils.ai.token_estimator import token_estimator
+from utils.ai.result_cache import result_cache
+from utils.ai.gemini_files import gemini_files
 from utils.ai.gemini_config import (GeminiPart, GeminiInlinePart,
                                     GeminiContent, GeminiRequest, PromptSchema)
 from utils.ai.gemini_config import (
@@ -36,31 +45,215 @@ if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY environment variable is not set")
 genai.configure(api_key=GOOGLE_API_KEY)
 
-# Path to the configs directory
-CONFIGS_DIR = os.path.join(
-    os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
-    'ebowwa/wingly/configs'
-)  # Points to root configs directory
-
-# Initialize the ConfigLoader
-config_loader = ConfigLoader(CONFIGS_DIR)
-
-# Update type hint for PROMPTS_SCHEMAS
-PROMPTS_SCHEMAS: Dict[str, PromptSchema] = {}
-for filename in os.listdir(CONFIGS_DIR):
-    if filename.endswith('.json'):
-        prompt_type = os.path.splitext(filename)[0]
-        config = config_loader.load_config(prompt_type)
-        if config:
-            PROMPTS_SCHEMAS[prompt_type] = PromptSchema(
-                prompt_text=config["prompt_text"],
-                response_schema=config["response_schema"])
-            logger.info(f"Loaded configuration '{prompt_type}' successfully.")
-        else:
-            logger.error(f"Failed to load configuration for '{prompt_type}'.")
-
-
-# Update the function signature
+# Compile every prompt config once at startup; hot reloads swap the registry
+get_prompt_registry()
+
+
+def _get_compiled_prompt(prompt_type: str) -> CompiledPrompt:
+    """Look up prompt_type in the current registry."""
+    compiled_prompt = get_prompt_registry().get(prompt_type)
+    if not compiled_prompt:
+        logger.error(f"Invalid prompt_type selected: {prompt_type}")
+        raise GeminiHTTPException(
+            status_code=400, detail=f"Invalid prompt_type: {prompt_type}")
+    return compiled_prompt
+
+
+def _collect_variables(
+        uploaded_files: Union[List[GeminiRequest], GeminiRequest],
+        step_variables: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge request-level and step-specific variables for prompt injection."""
+    variables_to_inject = {}
+
+    # First, get variables from uploaded_files if available
+    if isinstance(uploaded_files, object) and hasattr(
+            uploaded_files, 'variables'):
+        variables_to_inject.update(uploaded_files.variables)
+
+    # Then, override with step-specific variables if provided
+    if step_variables:
+        variables_to_inject.update(step_variables)
+    return variables_to_inject
+
+
+def _collect_parts(
+        uploaded_files: Union[List[GeminiRequest], GeminiRequest]) -> List[Dict[str, Any]]:
+    """Flatten the content parts of one or more requests."""
+    if isinstance(uploaded_files, list):
+        # Handle multiple files with sequential processing
+        parts = []
+        for file in uploaded_files:
+            parts.extend(file["content"]["parts"])
+        return parts
+    # Single file processing
+    return uploaded_files["content"]["parts"]
+
+
+def _result_cache_key(
+        uploaded_files: Union[List[GeminiRequest], GeminiRequest],
+        compiled_prompt: CompiledPrompt,
+        model_name: str,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        max_output_tokens: int,
+        step_variables: Dict[str, Any],
+        force_json: bool,
+        media_digests: Optional[List[Optional[str]]] = None) -> str:
+    """Content-addressed cache key for a request."""
+    return result_cache.make_key(
+        _collect_parts(uploaded_files), compiled_prompt.name,
+        _collect_variables(uploaded_files, step_variables), {
+            # Editing a prompt invalidates results produced by older versions
+            "prompt_hash": compiled_prompt.content_hash,
+            "model_name": model_name,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "max_output_tokens": max_output_tokens,
+            "force_json": force_json
+        }, gemini_files.file_digests(), media_digests)
+
+
+class GeminiResultMeta(TypedDict):
+    cache_hit: bool
+    cache_key: Optional[str]
+    prompt_type: str
+    prompt_version: str
+
+
+def _finish(result: Union[Dict[str, Any], str], cache_hit: bool, cache_key: Optional[str],
+            compiled_prompt: CompiledPrompt, return_meta: bool) -> Any:
+    """Return result, paired with its cache and prompt metadata if requested.
+
+    The metadata travels next to the model output, never inside it, so a
+    result reads the same whether it came from the cache or the API.
+    """
+    if not return_meta:
+        return result
+    meta: GeminiResultMeta = {
+        "cache_hit": cache_hit,
+        "cache_key": cache_key,
+        "prompt_type": compiled_prompt.name,
+        "prompt_version": compiled_prompt.version
+    }
+    return result, meta
+
+
+def _prepare_chat(
+        uploaded_files: Union[List[GeminiRequest], GeminiRequest],
+        compiled_prompt: CompiledPrompt,
+        model_name: str,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        max_output_tokens: int,
+        step_variables: Dict[str, Any],
+        force_json: bool) -> Tuple[genai.GenerativeModel, List[Dict[str, Any]]]:
+    """Build the model and chat history for a request."""
+    # Render the precompiled prompt with any injected variables
+    prompt_text = compiled_prompt.render(
+        _collect_variables(uploaded_files, step_variables), force_json)
+
+    # Reuse a cached model for these generation parameters
+    model = model_registry.get_model(model_name=model_name,
+                                     temperature=temperature,
+                                     top_p=top_p,
+                                     top_k=top_k,
+                                     max_output_tokens=max_output_tokens)
+
+    logger.info(
+        f"Using Gemini GenerativeModel with prompt_type '{compiled_prompt.name}' "
+        f"v{compiled_prompt.version}"
+    )
+
+    # Create dynamic chat history with configurable message sequence
+    parts = _collect_parts(uploaded_files)
+
+    # Create chat history with separate content and prompt messages
+    chat_history = [{
+        "role": "user",
+        "parts": parts
+    }, {
+        "role": "user",
+        "parts": [{
+            "text": prompt_text
+        }]
+    }]
+
+    logger.debug(
+        f"Dynamic chat history constructed with {len(parts)} content parts and prompt"
+    )
+    return model, chat_history
+
+
+def _parse_response(response: Any, force_json: bool) -> Union[Dict[str, Any], str]:
+    """Extract the final result from a Gemini response."""
+    logger.debug(f"Received response from Gemini: {response.text}")
+
+    if force_json:
+        parsed_result = extract_json_from_response(response.text)
+        logger.info("Successfully extracted JSON from Gemini response.")
+        return parsed_result
+    return response.text
+
+
+def _estimate_history_tokens(chat_history: List[Dict[str, Any]]) -> Tuple[int, int]:
+    """Estimate the text and media input tokens of a chat history for rate limiting."""
+    return token_counter.split_parts_tokens(
+        [part for message in chat_history for part in message["parts"]],
+        gemini_files.file_sizes())
+
+
+async def _send_rate_limited_async(model: genai.GenerativeModel, chat_history: List[Dict[str, Any]],
+                                   model_name: str, message: str, priority: int) -> Any:
+    """Send message through the rate limiter and scheduler, backing off on 429 responses.
+
+    Each attempt waits for rate limit budget before taking a scheduler slot
+    and gives the slot back as soon as the call returns, so a caller backing
+    off after a 429 does not keep others from the model.
+    """
+    # Decoding inline media to read its duration stays off the event loop
+    raw_tokens, media_tokens = await asyncio.to_thread(_estimate_history_tokens, chat_history)
+    raw_tokens += token_estimator.raw_text_tokens(message)
+    estimated_tokens = token_estimator.correct(model_name, raw_tokens, media_tokens)
+    for attempt in range(1, rate_limiter.max_attempts + 1):
+        await rate_limiter.acquire(model_name, estimated_tokens)
+        try:
+            async with gemini_scheduler.slot(model_name, priority):
+                response = await model.start_chat(history=chat_history).send_message_async(message)
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            rate_limiter.on_throttled(model_name)
+            if attempt == rate_limiter.max_attempts:
+                raise GeminiHTTPException(status_code=429,
+                                          detail="Gemini rate limit exceeded")
+            continue
+        rate_limiter.on_success(model_name)
+        rate_limiter.record_usage(model_name, estimated_tokens, response)
+        token_estimator.observe_response(model_name, raw_tokens, response, media_tokens)
+        return response
+
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_loop_lock = threading.Lock()
+
+
+def _sync_loop() -> asyncio.AbstractEventLoop:
+    """Loop synchronous callers submit to: the scheduler's, else a shared background one."""
+    global _background_loop
+    loop = gemini_scheduler.loop
+    if loop is not None:
+        return loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever,
+                             name="gemini-sync-loop", daemon=True).start()
+        return _background_loop
+
+
 def process_with_gemini(
         uploaded_files: Union[List[GeminiRequest], GeminiRequest],
         prompt_type: str = "default_transcription",
@@ -70,105 +263,101 @@ def process_with_gemini(
         top_k: int = 40,
         max_output_tokens: int = 8192,
         step_variables: Dict[str, Any] = None,
-        force_json: bool = True) -> Union[Dict[str, Any], str]:
+        force_json: bool = True,
+        use_cache: bool = True,
+        use_file_api: bool = True,
+        return_meta: bool = False,
+        media_digests: Optional[List[Optional[str]]] = None) -> Union[Dict[str, Any], str, Tuple[Any, GeminiResultMeta]]:
+    """Analyze media with Gemini from synchronous code (scripts, worker threads).
+
+    Blocks while process_with_gemini_async runs on the scheduler's event
+    loop (the app's, when one is serving), or on a background loop shared
+    by all synchronous callers, so the call goes through the scheduler and
+    rate limiter like every other. Code already on an event loop must await
+    process_with_gemini_async instead.
+
+    Raises:
+        RuntimeError: If called from a running event loop
+    """
     try:
-        config = PROMPTS_SCHEMAS.get(prompt_type)
-        if not config:
-            logger.error(f"Invalid prompt_type selected: {prompt_type}")
-            raise GeminiHTTPException(
-                status_code=400, detail=f"Invalid prompt_type: {prompt_type}")
-
-        # Get base prompt and schema from config
-        prompt_text = config["prompt_text"]
-        response_schema = config["response_schema"] if force_json else None
-
-        # Handle dynamic variable injection if present in the prompt
-        variables_to_inject = {}
-
-        # First, get variables from uploaded_files if available
-        if isinstance(uploaded_files, object) and hasattr(
-                uploaded_files, 'variables'):
-            variables_to_inject.update(uploaded_files.variables)
-
-        # Then, override with step-specific variables if provided
-        if step_variables:
-            variables_to_inject.update(step_variables)
-
-        # Apply variables to prompt and schema
-        if variables_to_inject:
-            for var_name, var_value in variables_to_inject.items():
-                placeholder = f"{{{var_name}}}"
-                prompt_text = prompt_text.replace(placeholder, str(var_value))
-
-                if isinstance(response_schema, str):
-                    response_schema = response_schema.replace(
-                        placeholder, str(var_value))
-
-        # Prepare the prompt and model configuration
-        generation_config = genai.types.GenerationConfig(
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            max_output_tokens=max_output_tokens)
-
-        # Initialize model with generation config
-        model = genai.GenerativeModel(model_name=model_name,
-                                      generation_config=generation_config)
-
-        logger.info(
-            f"Initialized Gemini GenerativeModel with prompt_type '{prompt_type}'"
-        )
-
-        # Create dynamic chat history with configurable message sequence
-        if isinstance(uploaded_files, list):
-            # Handle multiple files with sequential processing
-            parts = []
-            for file in uploaded_files:
-                parts.extend(file["content"]["parts"])
-        else:
-            # Single file processing
-            parts = uploaded_files["content"]["parts"]
-
-        # Create chat history with separate content and prompt messages
-        chat_history = [{
-            "role": "user",
-            "parts": parts
-        }, {
-            "role": "user",
-            "parts": [{
-                "text": (f"{prompt_text}\nResponse format: {json.dumps(response_schema, indent=2)}"
-                        if force_json else prompt_text)
-            }]
-        }]
-
-        logger.debug(
-            f"Dynamic chat history constructed with {len(parts)} content parts and prompt"
-        )
-
-        chat_session = model.start_chat(history=chat_history)
-        logger.info("Chat session started with Gemini.")
-
-        # Send a message to the model
-        # Handle response based on force_json setting
-        response = chat_session.send_message("Process the audio and think deeply")
-        logger.debug(f"Received response from Gemini: {response.text}")
-
-        if force_json:
-            parsed_result = extract_json_from_response(response.text)
-            logger.info("Successfully extracted JSON from Gemini response.")
-            return parsed_result
-        else:
-            return response.text
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(
+            "process_with_gemini cannot run on an event loop; await process_with_gemini_async")
+    return asyncio.run_coroutine_threadsafe(process_with_gemini_async(
+        uploaded_files, prompt_type, model_name, temperature, top_p, top_k,
+        max_output_tokens, step_variables, force_json, priority=Priority.BULK,
+        use_cache=use_cache, use_file_api=use_file_api, return_meta=return_meta,
+        media_digests=media_digests), _sync_loop()).result()
+
+
+async def process_with_gemini_async(
+        uploaded_files: Union[List[GeminiRequest], GeminiRequest],
+        prompt_type: str = "default_transcription",
+        model_name: str = "gemini-1.5-flash",
+        temperature: float = 1.0,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        max_output_tokens: int = 8192,
+        step_variables: Dict[str, Any] = None,
+        force_json: bool = True,
+        priority: int = Priority.BULK,
+        use_cache: bool = True,
+        use_file_api: bool = True,
+        return_meta: bool = False,
+        media_digests: Optional[List[Optional[str]]] = None) -> Union[Dict[str, Any], str, Tuple[Any, GeminiResultMeta]]:
+    """Analyze media with Gemini.
+
+    Inline media at or above the File API threshold is uploaded once and
+    referenced by file URI; the handle is reused for identical content.
+    Calls go through the shared scheduler, which bounds concurrency per
+    model and serves waiting callers by priority.
+    With return_meta, returns (result, GeminiResultMeta) instead of result.
+    media_digests, the SHA-256 of each media part in order, lets callers
+    that already hashed the media (e.g. at ingest) skip rehashing it for
+    the cache key.
+    """
+    try:
+        # Cache hits are answered before queueing for a scheduler slot
+        compiled_prompt = _get_compiled_prompt(prompt_type)
+        cache_key = None
+        if use_cache:
+            # Keying may hash inline media, which must not block the loop
+            cache_key = await asyncio.to_thread(
+                _result_cache_key, uploaded_files, compiled_prompt, model_name,
+                temperature, top_p, top_k, max_output_tokens, step_variables,
+                force_json, media_digests)
+            cached = await result_cache.get_async(cache_key)
+            if cached is not None:
+                logger.info(f"Result cache hit for prompt_type '{prompt_type}'")
+                return _finish(cached, True, cache_key, compiled_prompt, return_meta)
+
+        model, chat_history = _prepare_chat(
+            uploaded_files, compiled_prompt, model_name, temperature, top_p,
+            top_k, max_output_tokens, step_variables, force_json)
+        if use_file_api:
+            # Uploads happen before taking a slot so they do not hold up other calls
+            chat_history[0]["parts"] = await gemini_files.resolve_parts_async(
+                chat_history[0]["parts"])
+
+        response = await _send_rate_limited_async(
+            model, chat_history, model_name,
+            "Process the audio and think deeply", priority)
+        result = _parse_response(response, force_json)
+        if cache_key:
+            await result_cache.set_async(cache_key, result)
+        return _finish(result, False, cache_key, compiled_prompt, return_meta)
 
     except GeminiHTTPException as he:
-        logger.error(f"HTTPException in process_with_gemini: {he.detail}")
+        logger.error(f"HTTPException in process_with_gemini_async: {he.detail}")
         raise he
     except Exception as e:
-        logger.error(f"Unexpected error in process_with_gemini: {e}")
+        logger.error(f"Unexpected error in process_with_gemini_async: {e}")
         raise GeminiHTTPException(status_code=500,
                                 detail="Gemini processing failed")
 
-
 if __name__ == "__main__":
     # Set up logging
     logging.basicConfig(level=logging.INFO)
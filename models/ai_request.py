@@ -66,4 +66,6 @@ class MediaAsset(db.Model):
     asset_metadata: Optional[str] = db.Column(db.Text)
     original_filename: Optional[str] = db.Column(db.String)
     mime_type: Optional[str] = db.Column(db.String)
-    size_bytes: Optional[int] = db.Column(db.Integer)
\ No newline at end of file
+    size_bytes: Optional[int] = db.Column(db.Integer)
+    # SHA-256 of the content; assets with the same hash share one S3 object
+    content_hash: Optional[str] = db.Column(db.String(64), index=True)
@@ -178,8 +178,9 @@ class TelegramUser(db.Model):
     last_name = db.Column(db.String(64))
     language_code = db.Column(db.String(10))
     
-    # Link to base user
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    # Link to base user; set once the Telegram user registers, the bot
+    # creates the row on first contact to keep their onboarding state
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     user = db.relationship('User', backref=db.backref('telegram_user', uselist=False))
     
     # Telegram-specific fields
@@ -190,6 +191,7 @@ class TelegramUser(db.Model):
     # Tutorial and onboarding state
     onboarding_completed = db.Column(db.Boolean, default=False)
     tutorial_state = db.Column(db.String(50))
+    tutorial_data = db.Column(db.JSON)  # Answers collected during onboarding
     
     def __init__(self, telegram_id, username=None, first_name=None, last_name=None, language_code=None):
         self.telegram_id = telegram_id
@@ -0,0 +1,101 @@
+"""Schema upgrades for databases created before a model change.
+
+app.py only runs create_all on an empty database, so columns and indexes
+added to existing models, and constraints relaxed on them, are applied
+here. Every step checks the live schema first and is safe to run on each
+start.
+"""
+
+import logging
+from sqlalchemy import MetaData, inspect
+
+logger = logging.getLogger(__name__)
+
+
+def _add_missing_columns(engine, table, names):
+    """ALTER TABLE ... ADD COLUMN for each named column the database lacks."""
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    with engine.begin() as conn:
+        for name in names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            column_type = column.type.compile(dialect=engine.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}")
+            logger.info(f"Added column {table.name}.{name}")
+
+
+def _create_missing_indexes(engine, table):
+    """Create the model's indexes that no existing index covers (schema.sql names them differently)."""
+    existing = {tuple(index["column_names"]) for index in inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if tuple(column.name for column in index.columns) not in existing:
+            index.create(engine)
+            logger.info(f"Created index {index.name}")
+
+
+def _rebuild_sqlite_table(engine, table):
+    """Recreate a SQLite table from its model, keeping its rows.
+
+    SQLite cannot alter column constraints, so this follows its documented
+    procedure: create the new table, copy, drop the old one and rename.
+    """
+    # The copy's foreign keys need the tables they point to in its metadata
+    metadata = MetaData()
+    metadata.reflect(engine, only=sorted({fk.column.table.name for fk in table.foreign_keys}))
+    staging = table.to_metadata(metadata, name=f"{table.name}_new")
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    columns = ", ".join(column.name for column in table.columns if column.name in existing)
+    with engine.connect() as conn:
+        # Outside a transaction, where SQLite honours it
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.commit()
+        try:
+            with conn.begin():
+                staging.create(conn)
+                conn.exec_driver_sql(
+                    f"INSERT INTO {staging.name} ({columns}) SELECT {columns} FROM {table.name}")
+                conn.exec_driver_sql(f"DROP TABLE {table.name}")
+                conn.exec_driver_sql(f"ALTER TABLE {staging.name} RENAME TO {table.name}")
+        finally:
+            conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+            conn.commit()
+
+
+def _drop_not_null(engine, table, name):
+    """Make a column nullable if the database still declares it NOT NULL."""
+    column = next(c for c in inspect(engine).get_columns(table.name) if c["name"] == name)
+    if column["nullable"]:
+        return
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} ALTER COLUMN {name} DROP NOT NULL")
+    elif engine.dialect.name == "sqlite":
+        _rebuild_sqlite_table(engine, table)
+    else:
+        raise RuntimeError(
+            f"{table.name}.{name} must be nullable; alter it manually on {engine.dialect.name}")
+    logger.info(f"Made {table.name}.{name} nullable")
+
+
+def upgrade_schema(engine) -> None:
+    """Bring an existing database up to the current models.
+
+    Raises:
+        RuntimeError: If a required change cannot be applied on this database
+    """
+    from .auth import TelegramUser
+    from .ai_request import MediaAsset
+
+    tables = set(inspect(engine).get_table_names())
+
+    if TelegramUser.__tablename__ in tables:
+        table = TelegramUser.__table__
+        # The bot creates rows on first contact, before an account is linked
+        _drop_not_null(engine, table, "user_id")
+        _add_missing_columns(engine, table, ["tutorial_data"])
+
+    if MediaAsset.__tablename__ in tables:
+        # Content-addressed storage looks assets up by hash
+        _add_missing_columns(engine, MediaAsset.__table__, ["content_hash"])
+        _create_missing_indexes(engine, MediaAsset.__table__)
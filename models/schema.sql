@@ -26,6 +26,24 @@ CREATE TABLE profiles (
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
+-- Telegram users table
+CREATE TABLE telegram_users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    language_code TEXT,
+    user_id INTEGER,
+    is_bot INTEGER DEFAULT 0,
+    is_premium INTEGER DEFAULT 0,
+    last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    onboarding_completed INTEGER DEFAULT 0,
+    tutorial_state TEXT,
+    tutorial_data TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
 -- Friendships table
 CREATE TABLE friendships (
     user_id INTEGER,
@@ -67,6 +85,7 @@ CREATE TABLE media_assets (
     original_filename TEXT,
     mime_type TEXT,
     size_bytes INTEGER,
+    content_hash TEXT,
     FOREIGN KEY (memory_id) REFERENCES memories(id)
 );
 
@@ -101,4 +120,5 @@ CREATE TABLE ai_requests (
 -- Indexes
 CREATE INDEX idx_profiles_user_id ON profiles(user_id);
 CREATE INDEX idx_media_assets_memory_id ON media_assets(memory_id);
+CREATE INDEX idx_media_assets_content_hash ON media_assets(content_hash);
 CREATE INDEX idx_ai_requests_profile_id ON ai_requests(profile_id);
\ No newline at end of file
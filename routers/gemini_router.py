@@ -18,9 +18,15 @@ from dotenv import load_dotenv
 import google.generativeai as genai
 import logging
 import traceback
-from tenacity import retry, stop_after_attempt, wait_exponential
-from functools import partial
-from utils.ai.gemini_process import process_with_gemini
+from utils.ai.gemini_process import process_with_gemini_async, GeminiResultMeta
+from utils.ai.gemini_scheduler import gemini_scheduler, Priority
+from utils.ai.model_registry import model_registry
+from utils.ai.rate_limiter import rate_limiter
+from utils.ai.token_estimator import token_estimator
+from utils.ai.result_cache import result_cache
+from utils.ai.gemini_files import gemini_files
+from utils.metrics import metrics
+from services.audio_service import audio_service
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -45,8 +51,10 @@ if not google_api_key:
 
 genai.configure(api_key=google_api_key)
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def upload_to_gemini(file_content: bytes, mime_type: Optional[str] = None) -> object:
+# Longest single file accepted; Gemini allows 9.5 hours of audio per prompt
+max_audio_duration_seconds = float(os.getenv("MAX_AUDIO_DURATION_SECONDS", str(9.5 * 3600)))
+
+def upload_to_gemini(file_content: Union[bytes, memoryview], mime_type: Optional[str] = None) -> object:
     """
     Prepares file content for Gemini by encoding it as base64.
     """
@@ -63,27 +71,63 @@ def upload_to_gemini(file_content: bytes, mime_type: Optional[str] = None) -> ob
         traceback.print_exc()
         raise
 
-async def async_upload_file_to_gemini(file: UploadFile) -> object:
+async def async_upload_file_to_gemini(file: UploadFile, validate: bool = False,
+                                      store: bool = False) -> Tuple[dict, dict]:
     """
-    Asynchronously reads and uploads file content to Gemini.
+    Ingests the upload through the audio service and returns the content part
+    for it along with the audio details (duration, validation, storage URL).
+    Large files are sent once through the Gemini File API straight from the
+    spool file; smaller ones are base64-encoded from the memory-mapped buffer.
     """
     try:
-        content = await file.read()
-        return upload_to_gemini(content, file.content_type)
+        media, file_url, validation_details, probe = await audio_service.process_audio(
+            audio=file,
+            validation_required=validate,
+            max_duration_seconds=max_audio_duration_seconds,
+            store=store
+        )
+        async with media:
+            if validate and not validation_details.get("passed", False):
+                raise HTTPException(status_code=422,
+                                    detail=f"Audio validation failed: {validation_details.get('reason')}")
+            details = {
+                "duration": probe.duration if probe else None,
+                "validation": validation_details,
+                "file_url": file_url,
+                # Digest from ingest; keys the result cache without rehashing
+                "content_hash": media.sha256
+            }
+            if gemini_files.should_upload(media.size):
+                part = await gemini_files.file_part_async(
+                    media.path, media.mime_type, media.sha256, media.size)
+            else:
+                part = {"inline_data": upload_to_gemini(media.buffer, media.mime_type)}
+            return part, details
     except Exception as e:
         logger.error(f"Error uploading file {file.filename}: {e}")
         raise
 
-def process_audio_with_gemini(
+def result_meta(meta: GeminiResultMeta) -> dict:
+    """Metadata reported next to "data" in each result."""
+    return {
+        "cache_hit": meta["cache_hit"],
+        "cache_key": meta["cache_key"],
+        # Prompt config the result was produced with
+        "prompt_type": meta["prompt_type"],
+        "prompt_version": meta["prompt_version"]
+    }
+
+async def process_audio_with_gemini(
     filename: str,
-    uploaded_file: object,
+    uploaded_part: dict,
     prompt_type: str,
     model_name: str,
     temperature: float,
     top_p: float,
     top_k: int,
-    max_output_tokens: int
-) -> Union[Tuple[str, object], Exception]:
+    max_output_tokens: int,
+    content_hash: Optional[str] = None
+) -> Union[Tuple[str, object, GeminiResultMeta], Exception]:
     try:
         logger.debug(f"Processing with Gemini webhook for file: {filename}")
         
@@ -91,30 +135,45 @@ def process_audio_with_gemini(
         formatted_data = {
             "role": "user",
             "content": {
-                "parts": [
-                    {
-                        "inline_data": uploaded_file  # Use the uploaded file data directly
-                    }
-                ]
+                "parts": [uploaded_part]
             }
         }
         
-        gemini_result = process_with_gemini(
+        gemini_result, meta = await process_with_gemini_async(
             formatted_data,
             prompt_type=prompt_type,
             model_name=model_name,
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
-            max_output_tokens=max_output_tokens
+            max_output_tokens=max_output_tokens,
+            priority=Priority.BULK,
+            return_meta=True,
+            media_digests=[content_hash]
         )
         logger.debug(f"Gemini processing successful for file: {filename}")
-        return (filename, gemini_result)
+        return (filename, gemini_result, meta)
     except Exception as e:
         logger.error(f"Error in Gemini processing for file {filename}: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Gemini processing failed: {str(e)}")
 
+@router.get("/gemini/metrics")
+async def gemini_metrics():
+    """
+    Report scheduler queue state, model registry usage, rate limiter budgets
+    and recorded metrics.
+    """
+    return {
+        "scheduler": gemini_scheduler.stats(),
+        "model_registry": model_registry.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "result_cache": await asyncio.to_thread(result_cache.stats),
+        "file_api": gemini_files.stats(),
+        "token_estimator": token_estimator.stats(),
+        "metrics": metrics.snapshot()
+    }
+
 @router.post("/process-audio")
 async def process_audio(
     files: List[UploadFile] = File(...),
@@ -124,11 +183,14 @@ async def process_audio(
     temperature: float = Query(1.0, description="Temperature parameter for generation"),
     top_p: float = Query(0.95, description="Top-p parameter for generation"),
     top_k: int = Query(40, description="Top-k parameter for generation"),
-    max_output_tokens: int = Query(8192, description="Maximum output tokens")
+    max_output_tokens: int = Query(8192, description="Maximum output tokens"),
+    validate: bool = Query(False, description="Reject files without detectable speech"),
+    store: bool = Query(False, description="Keep a copy in storage and return its URL")
 ):
     """
     Process multiple audio files concurrently with improved error handling.
-    Allows specifying the Gemini model and generation parameters.
+    Allows specifying the Gemini model and generation parameters. Files longer
+    than MAX_AUDIO_DURATION_SECONDS are rejected.
     """
     supported_mime_types = {
         "audio/wav", "audio/mp3", "audio/aiff",
@@ -150,7 +212,7 @@ async def process_audio(
 
     try:
         # Process files concurrently for uploading
-        processing_tasks = [async_upload_file_to_gemini(file) for file in files]
+        processing_tasks = [async_upload_file_to_gemini(file, validate, store) for file in files]
         uploaded_files = await asyncio.gather(*processing_tasks, return_exceptions=True)
 
         # Check for any exceptions in uploaded_files
@@ -162,10 +224,11 @@ async def process_audio(
                 errors.append({
                     "file": file.filename,
                     "status": "failed",
-                    "error": str(uploaded_file)
+                    "error": getattr(uploaded_file, "detail", None) or str(uploaded_file)
                 })
             else:
-                valid_uploaded_files.append((file.filename, uploaded_file))
+                uploaded_part, audio_details = uploaded_file
+                valid_uploaded_files.append((file.filename, uploaded_part, audio_details))
 
         if not valid_uploaded_files:
             logger.warning("All file uploads failed.")
@@ -177,24 +240,30 @@ async def process_audio(
             # Process with Gemini webhook with batch=True
             try:
                 logger.debug("Starting batch processing with Gemini webhook.")
-                gemini_result = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    partial(
-                        process_with_gemini,
-                        [uploaded_file for _, uploaded_file in valid_uploaded_files],
-                        prompt_type=prompt_type,
-                        batch=True,
-                        model_name=model_name,
-                        temperature=temperature,
-                        top_p=top_p,
-                        top_k=top_k,
-                        max_output_tokens=max_output_tokens
-                    )
+                gemini_result, meta = await process_with_gemini_async(
+                    [
+                        {
+                            "role": "user",
+                            "content": {"parts": [uploaded_part]}
+                        }
+                        for _, uploaded_part, _ in valid_uploaded_files
+                    ],
+                    prompt_type=prompt_type,
+                    model_name=model_name,
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    max_output_tokens=max_output_tokens,
+                    priority=Priority.BULK,
+                    return_meta=True,
+                    media_digests=[details["content_hash"] for _, _, details in valid_uploaded_files]
                 )
                 results.append({
-                    "files": [filename for filename, _ in valid_uploaded_files],
+                    "files": [filename for filename, _, _ in valid_uploaded_files],
                     "status": "processed",
-                    "data": gemini_result
+                    "data": gemini_result,
+                    "meta": result_meta(meta),
+                    "audio": [details for _, _, details in valid_uploaded_files]
                 })
                 logger.debug("Batch processing with Gemini webhook successful.")
             except Exception as e:
@@ -204,27 +273,24 @@ async def process_audio(
         else:
             # Process each file individually
             processing_tasks = []
-            for filename, uploaded_file in valid_uploaded_files:
-                task = asyncio.get_event_loop().run_in_executor(
-                    None,
-                    partial(
-                        process_audio_with_gemini,
-                        filename,
-                        uploaded_file,
-                        prompt_type,
-                        model_name,
-                        temperature,
-                        top_p,
-                        top_k,
-                        max_output_tokens
-                    )
+            for filename, uploaded_file, audio_details in valid_uploaded_files:
+                task = process_audio_with_gemini(
+                    filename,
+                    uploaded_file,
+                    prompt_type,
+                    model_name,
+                    temperature,
+                    top_p,
+                    top_k,
+                    max_output_tokens,
+                    audio_details["content_hash"]
                 )
                 processing_tasks.append(task)
 
             individual_results = await asyncio.gather(*processing_tasks, return_exceptions=True)
 
             for original_file, result in zip(valid_uploaded_files, individual_results):
-                filename, _ = original_file
+                filename, _, audio_details = original_file
                 if isinstance(result, Exception):
                     logger.error(f"Error in Gemini processing for file {filename}: {result}")
                     results.append({
@@ -233,11 +299,13 @@ async def process_audio(
                         "error": str(result)
                     })
                 elif isinstance(result, tuple):
-                    fname, gemini_result = result
+                    fname, gemini_result, meta = result
                     results.append({
                         "file": fname,
                         "status": "processed",
-                        "data": gemini_result
+                        "data": gemini_result,
+                        "meta": result_meta(meta),
+                        "audio": audio_details
                     })
                 else:
                     logger.error(f"Unexpected result type for file {filename}: {result}")
@@ -0,0 +1,57 @@
+import os
+import hmac
+import asyncio
+import logging
+from typing import Optional
+from fastapi import APIRouter, Request, Header, HTTPException
+from utils.telegram.update_queue import get_update_queue
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    tags=["telegram"],
+    responses={404: {"description": "Not found"}},
+)
+
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+
+
+@router.post("/telegram/webhook")
+async def telegram_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+):
+    """
+    Receive a Telegram update and queue it for the bot workers.
+
+    Returns as soon as the update is durably queued; Telegram retries
+    deliveries that fail, and re-deliveries are dropped by update_id.
+    """
+    # Without a configured secret anyone could inject updates for any chat,
+    # so the endpoint stays closed until TELEGRAM_WEBHOOK_SECRET is set
+    if not WEBHOOK_SECRET or not hmac.compare_digest(
+            x_telegram_bot_api_secret_token or "", WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid webhook secret")
+
+    payload = await request.json()
+    if not isinstance(payload, dict) or "update_id" not in payload:
+        raise HTTPException(status_code=400, detail="Not a Telegram update")
+
+    try:
+        accepted = await asyncio.to_thread(get_update_queue().push, payload)
+    except Exception as e:
+        # A non-2xx answer makes Telegram deliver the update again later
+        logger.error(f"Failed to queue Telegram update {payload['update_id']}: {e}")
+        raise HTTPException(status_code=503, detail="Update queue unavailable")
+    if not accepted:
+        logger.debug(f"Duplicate Telegram update {payload['update_id']} ignored")
+    return {"ok": True}
+
+
+@router.get("/telegram/queue")
+async def telegram_queue_stats():
+    """Report queued, leased, finished and dead update counts."""
+    return await asyncio.to_thread(get_update_queue().stats)
+
+
+telegram_router = router
@@ -4,7 +4,8 @@ import os
 import google.generativeai as genai
 import logging
 import json
-from typing import Optional, Dict, Any
+import asyncio
+from typing import Optional, Dict, Any, Callable, Awaitable
 from utils.ai.gemini_socket import GeminiWebSocket
 
 # Initialize logging
@@ -54,58 +55,211 @@ questions = [
 async def healthcheck():
     return {"status": "ok"}
 
+async def run_conversation(
+    send_text: Callable[[str], Awaitable[None]],
+    receive_text: Callable[[], Awaitable[str]]
+):
+    """
+    Run the relationship-profile interview over any text channel.
+
+    Args:
+        send_text: Sends one message to the user
+        receive_text: Waits for the user's next message; raises
+            WebSocketDisconnect when the user is gone
+    """
+    answers = []
+
+    # Initialize Gemini chat session
+    chat = await gemini_socket.create_session(response_type="TEXT")
+
+    try:
+        for question in questions:
+            logging.info(f"Sending question: {question}")
+            await send_text(question)
+
+            user_response = await receive_text()
+            logging.info(f"Received response: {user_response}")
+            answers.append(user_response)
+
+            # Process response through Gemini
+            response = await chat.send_message_async(
+                f"User's response to '{question}': {user_response}"
+            )
+
+            # Send Gemini's analysis back to the user
+            if hasattr(response, 'text'):
+                await send_text(response.text)
+
+        # Generate final summary using Gemini's tool
+        profile_data = {
+            "introduction": answers[0],
+            "looking_for": answers[1],
+            "vision": answers[2]
+        }
+
+        final_response = await chat.send_message_async(
+            f"Please analyze this relationship profile and provide insights: {json.dumps(profile_data)}"
+        )
+
+        await send_text(json.dumps({
+            "Summary": profile_data,
+            "Analysis": final_response.text if hasattr(final_response, 'text') else "No analysis available"
+        }, indent=2))
+
+    except WebSocketDisconnect:
+        logging.info("User disconnected")
+    except Exception as e:
+        logging.error(f"Error in websocket communication: {str(e)}")
+        await send_text(f"Error: {str(e)}")
+
 @router.websocket("/conversation")
 async def conversation_endpoint(websocket: WebSocket):
     """Handles an interactive conversation via WebSockets using Gemini."""
     try:
         await websocket.accept()
-        answers = []
-        
-        # Initialize Gemini chat session
-        chat = await gemini_socket.create_session(response_type="TEXT")
-        
-        try:
-            for question in questions:
-                logging.info(f"Sending question: {question}")
-                await websocket.send_text(question)
-                
-                user_response = await websocket.receive_text()
-                logging.info(f"Received response: {user_response}")
-                answers.append(user_response)
-                
-                # Process response through Gemini
-                response = await chat.send_message_async(
-                    f"User's response to '{question}': {user_response}"
-                )
-                
-                # Send Gemini's analysis back to the user
-                if hasattr(response, 'text'):
-                    await websocket.send_text(response.text)
-
-            # Generate final summary using Gemini's tool
-            profile_data = {
-                "introduction": answers[0],
-                "looking_for": answers[1],
-                "vision": answers[2]
-            }
-            
-            final_response = await chat.send_message_async(
-                f"Please analyze this relationship profile and provide insights: {json.dumps(profile_data)}"
-            )
-            
-            await websocket.send_text(json.dumps({
-                "Summary": profile_data,
-                "Analysis": final_response.text if hasattr(final_response, 'text') else "No analysis available"
-            }, indent=2))
-
-        except WebSocketDisconnect:
-            logging.info("User disconnected")
-        except Exception as e:
-            logging.error(f"Error in websocket communication: {str(e)}")
-            await websocket.send_text(f"Error: {str(e)}")
-            
     except Exception as e:
         logging.error(f"Error accepting websocket connection: {str(e)}")
         raise
+    await run_conversation(websocket.send_text, websocket.receive_text)
+
+MUX_IDLE_SECONDS = float(os.getenv("WS_MUX_IDLE_SECONDS", "900"))
+MUX_MAX_SESSIONS = int(os.getenv("WS_MUX_MAX_SESSIONS", "1000"))
+MUX_MAX_PENDING = int(os.getenv("WS_MUX_MAX_PENDING", "8"))
+MUX_SEND_TIMEOUT = float(os.getenv("WS_MUX_SEND_TIMEOUT", "30"))
+
+class MuxSession:
+    """One conversation carried over a multiplexed connection.
+
+    Outgoing messages are flow-controlled by credits the client grants as it
+    consumes them, so a slow reader holds up only its own conversation.
+    """
+
+    def __init__(self, session_id: str, send_frame: Callable[[Dict[str, Any]], Awaitable[None]],
+                 window: int):
+        self.session_id = session_id
+        self.send_frame = send_frame
+        self.inbox: asyncio.Queue = asyncio.Queue(MUX_MAX_PENDING)
+        self.window = window
+        self.credits = asyncio.Semaphore(window)
+        # Messages sent that the client has not granted credit back for yet
+        self.outstanding = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def grant(self, n: int) -> None:
+        """Return credit for up to n consumed messages, never beyond the window."""
+        n = min(max(0, n), self.outstanding)
+        self.outstanding -= n
+        for _ in range(n):
+            self.credits.release()
+
+    async def send_text(self, text: str):
+        try:
+            await asyncio.wait_for(self.credits.acquire(), MUX_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            logging.info(f"Mux session {self.session_id} stopped reading, closing")
+            raise WebSocketDisconnect()
+        self.outstanding += 1
+        await self.send_frame({"type": "message", "session": self.session_id, "text": text})
+
+    async def receive_text(self) -> str:
+        try:
+            text = await asyncio.wait_for(self.inbox.get(), MUX_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            logging.info(f"Mux session {self.session_id} idle, closing")
+            raise WebSocketDisconnect()
+        return text
+
+@router.websocket("/conversation/mux")
+async def conversation_mux_endpoint(websocket: WebSocket):
+    """
+    Carries many conversations over one WebSocket.
+
+    Frames are JSON objects tagged with a session id:
+    client sends {"type": "message", "session", "text"} (the first message
+    of an unknown session starts a conversation, with an optional "window"
+    of messages it may send before waiting for credit), {"type": "credit",
+    "session", "n"} after consuming messages and {"type": "close", "session"};
+    server sends {"type": "message", "session", "text"}, {"type": "closed",
+    "session"} when a conversation ends and {"type": "error", "session",
+    "error"} for rejected frames.
+    """
+    await websocket.accept()
+    sessions: Dict[str, MuxSession] = {}
+    send_lock = asyncio.Lock()
+
+    async def send_locked(text: str):
+        async with send_lock:
+            await websocket.send_text(text)
+
+    async def send_frame(frame: Dict[str, Any]):
+        # A client that stops reading would otherwise hold the lock, and with
+        # it every conversation on the connection, indefinitely
+        try:
+            await asyncio.wait_for(send_locked(json.dumps(frame)), MUX_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.info("Mux client stopped reading, closing connection")
+            try:
+                await asyncio.wait_for(websocket.close(code=1011), 1)
+            except Exception:
+                pass
+            raise WebSocketDisconnect()
+
+    async def run_session(session: MuxSession):
+        try:
+            await run_conversation(session.send_text, session.receive_text)
+        finally:
+            sessions.pop(session.session_id, None)
+            try:
+                await send_frame({"type": "closed", "session": session.session_id})
+            except Exception:
+                # The connection itself is gone
+                pass
+
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+                session_id = str(frame["session"])
+                frame_type = frame.get("type", "message")
+            except (ValueError, KeyError, TypeError):
+                await send_frame({"type": "error", "session": None, "error": "Malformed frame"})
+                continue
+            try:
+                credit = int(frame.get("n", 1))
+                window = int(frame.get("window", MUX_MAX_PENDING))
+                text = frame.get("text", "")
+                if window < 1 or not isinstance(text, str):
+                    raise ValueError(frame)
+            except (ValueError, TypeError, OverflowError):
+                # Rejected for this conversation only; the others carry on
+                await send_frame({"type": "error", "session": session_id, "error": "Malformed frame"})
+                continue
+
+            session = sessions.get(session_id)
+            if frame_type == "credit":
+                if session:
+                    session.grant(credit)
+            elif frame_type == "close":
+                if session:
+                    session.task.cancel()
+            elif frame_type == "message":
+                if session is None:
+                    if len(sessions) >= MUX_MAX_SESSIONS:
+                        await send_frame({"type": "error", "session": session_id,
+                                          "error": "Too many conversations"})
+                        continue
+                    session = MuxSession(session_id, send_frame, window)
+                    sessions[session_id] = session
+                    session.task = asyncio.create_task(run_session(session))
+                try:
+                    session.inbox.put_nowait(text)
+                except asyncio.QueueFull:
+                    await send_frame({"type": "error", "session": session_id,
+                                      "error": "Conversation busy"})
+    except WebSocketDisconnect:
+        logging.info(f"Mux connection closed with {len(sessions)} open conversations")
+    finally:
+        for session in list(sessions.values()):
+            session.task.cancel()
 
 socket_router = router
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+Single-pass audio probing shared by validation, token counting and limits.
+
+The first stage that needs to know about an upload probes it: the content is
+decoded once, summarized into an AudioProbe and memoized by content hash.
+Later stages (duration limits, token estimates, validation) look the probe
+up instead of decoding again.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from utils.audio.decoder import audio_decoder, content_digest, AudioSource
+from utils.audio.probe import AudioProbe
+from .audio_validation import audio_validator
+
+logger = logging.getLogger(__name__)
+
+
+class AudioProbeService:
+    def __init__(self, max_entries: int = 512):
+        """Initialize the service.
+
+        Args:
+            max_entries: Number of probes memoized by content hash
+        """
+        self.max_entries = max_entries
+        self._probes: "OrderedDict[str, AudioProbe]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_hash: str) -> Optional[AudioProbe]:
+        """Return the memoized probe for content_hash, if any."""
+        with self._lock:
+            probe = self._probes.get(content_hash)
+            if probe is not None:
+                self._probes.move_to_end(content_hash)
+            return probe
+
+    def _remember(self, probe: AudioProbe) -> None:
+        with self._lock:
+            self._probes[probe.content_hash] = probe
+            self._probes.move_to_end(probe.content_hash)
+            while len(self._probes) > self.max_entries:
+                self._probes.popitem(last=False)
+
+    async def probe(
+        self,
+        source: AudioSource,
+        digest: Optional[str] = None,
+        mime_type: Optional[str] = None,
+        size_bytes: Optional[int] = None,
+        validate: bool = False
+    ) -> AudioProbe:
+        """Probe audio, decoding it only if no memoized probe covers the request.
+
+        Args:
+            source: Encoded audio bytes or a path to the file
+            digest: SHA-256 of the content if already known
+            mime_type: MIME type recorded on the probe
+            size_bytes: Encoded size recorded on the probe
+            validate: Also run speech validation and attach its VAD results
+
+        Returns:
+            AudioProbe for the content
+        """
+        if digest is None:
+            digest = await asyncio.to_thread(content_digest, source)
+
+        probe = self.get(digest)
+        if probe is not None and (probe.validated or not validate):
+            self.hits += 1
+            return probe
+        self.misses += 1
+
+        decoded = await audio_decoder.decode(source, digest=digest)
+        if probe is None:
+            probe = await asyncio.to_thread(
+                AudioProbe.from_decoded, decoded, digest, mime_type, size_bytes)
+        if validate:
+            _, validation_details = await audio_validator.validate_decoded(decoded)
+            probe = probe.with_validation(validation_details)
+
+        self._remember(probe)
+        logger.debug(f"Probed {digest[:12]}: {probe.duration:.2f}s {probe.codec} "
+                     f"{probe.sample_rate}Hz x{probe.channels}")
+        return probe
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._probes),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+# Create singleton instance
+audio_probe_service = AudioProbeService(
+    max_entries=int(os.getenv("AUDIO_PROBE_CACHE_SIZE", "512")))
@@ -3,13 +3,19 @@ Core audio processing service that handles audio uploads and processing.
 Provides a clean, reusable interface for audio operations.
 """
 
+import os
+import asyncio
+import tempfile
 from pathlib import Path
-from typing import Optional, Dict, Any, Tuple, Union
+from typing import Optional, Dict, Any, Tuple
 from fastapi import UploadFile, HTTPException, status
-import tempfile
 import logging
 from .s3 import s3_service
-from .audio_validation import audio_validator
+from .audio_probe import audio_probe_service
+from .media_ingest import SpooledMedia, ingest_upload, ingest_stream
+from utils.audio.probe import AudioProbe
+from utils.audio.decoder import AudioDecodeError
+from utils.audio.duration import read_duration
 
 logger = logging.getLogger(__name__)
 
@@ -22,87 +28,159 @@ class AudioService:
         self,
         audio: Optional[UploadFile] = None,
         existing_audio_url: Optional[str] = None,
-        validation_required: bool = True
-    ) -> Tuple[bytes, str, Dict[str, Any]]:
+        validation_required: bool = True,
+        max_duration_seconds: Optional[float] = None,
+        store: bool = True
+    ) -> Tuple[SpooledMedia, Optional[str], Dict[str, Any], Optional[AudioProbe]]:
         """
         Process audio from either upload or existing URL.
-        Returns: (audio_content, file_url, validation_details)
+        Returns: (spooled_media, file_url, validation_details, probe)
+
+        The caller owns spooled_media and must close() it when done; its
+        buffer can be handed to Gemini without another copy. Audio is only
+        decoded when it has to be: for validation, or for the duration limit
+        when the container headers do not give the duration. Without a
+        decode, probe carries just the header duration, and it is None if
+        even that is unknown.
+
+        Args:
+            max_duration_seconds: Reject longer audio, e.g. Subscription.max_audio_duration
+            store: Upload new audio to storage; file_url is None if False
         """
-        temp_file = None
-        try:
-            if audio:
-                file_content, file_url, validation_details = await self._handle_new_upload(audio, validation_required)
-            elif existing_audio_url:
-                file_content, file_url, validation_details = await self._handle_existing_audio(existing_audio_url)
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Either audio file or audio_url must be provided"
-                )
-                
-            return file_content, file_url, validation_details
-            
-        finally:
-            if temp_file and hasattr(temp_file, 'name'):
-                await self._cleanup_temp_file(temp_file)
+        if audio:
+            return await self._handle_new_upload(audio, validation_required, max_duration_seconds, store)
+        if existing_audio_url:
+            return await self._handle_existing_audio(existing_audio_url, max_duration_seconds)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Either audio file or audio_url must be provided"
+        )
 
     async def _handle_new_upload(
         self,
         audio: UploadFile,
-        validation_required: bool
-    ) -> Tuple[bytes, str, Dict[str, Any]]:
+        validation_required: bool,
+        max_duration_seconds: Optional[float],
+        store: bool
+    ) -> Tuple[SpooledMedia, Optional[str], Dict[str, Any], Optional[AudioProbe]]:
         """Handle new audio upload with optional validation."""
+        media = None
         try:
-            file_content = await audio.read()
-            
+            # One chunked copy on disk shared by validation and storage
+            media = await ingest_upload(audio, temp_dir=self.temp_dir)
+
+            probe = await self._probe(media, validation_required, max_duration_seconds)
             if validation_required:
-                validation_details = await self._validate_audio(
-                    file_content,
-                    audio.content_type
-                )
+                validation_details = probe.validation
             else:
                 validation_details = {"passed": True, "reason": "Validation skipped"}
 
-            file_url = await self._upload_to_storage(
-                file_content,
-                audio.filename,
-                audio.content_type
-            )
-            
-            return file_content, file_url, validation_details
+            file_url = await self._upload_to_storage(media) if store else None
             
+            return media, file_url, validation_details, probe
+
+        except HTTPException:
+            if media is not None:
+                media.close()
+            raise
         except Exception as e:
+            if media is not None:
+                media.close()
             logger.error(f"Error processing new audio upload: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"Failed to process audio upload: {str(e)}"
             )
 
-    async def _handle_existing_audio(self, audio_url: str) -> Tuple[bytes, str, Dict[str, Any]]:
+    async def _handle_existing_audio(
+        self,
+        audio_url: str,
+        max_duration_seconds: Optional[float]
+    ) -> Tuple[SpooledMedia, str, Dict[str, Any], Optional[AudioProbe]]:
         """Handle existing audio from URL."""
+        media = None
         try:
-            file_content = await s3_service.download_file(audio_url)
-            return file_content, audio_url, {"passed": True, "reason": "Using existing audio"}
+            # Stream the object straight into the spool with get_object
+            media = await ingest_stream(s3_service.iter_object(audio_url),
+                                        filename=audio_url, temp_dir=self.temp_dir)
+            probe = await self._probe(media, False, max_duration_seconds)
+            return media, audio_url, {"passed": True, "reason": "Using existing audio"}, probe
+        except HTTPException:
+            if media is not None:
+                media.close()
+            raise
         except Exception as e:
+            if media is not None:
+                media.close()
             logger.error(f"Error retrieving existing audio: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"Failed to retrieve existing audio: {str(e)}"
             )
 
-    async def _validate_audio(self, file_content: bytes, content_type: str) -> Dict[str, Any]:
-        """Validate audio content."""
-        with tempfile.NamedTemporaryFile(suffix='.wav', dir=self.temp_dir, delete=False) as temp_file:
-            temp_file.write(file_content)
-            temp_file.flush()
-            return await audio_validator.validate_audio(Path(temp_file.name), content_type)
-
-    async def _upload_to_storage(self, file_content: bytes, filename: str, content_type: str) -> str:
-        """Upload to storage and return URL."""
-        success, message, file_key = await s3_service.upload_file(
-            file_content=file_content,
-            filename=filename,
-            content_type=content_type
+    async def _probe(
+        self,
+        media: SpooledMedia,
+        validate: bool,
+        max_duration_seconds: Optional[float]
+    ) -> Optional[AudioProbe]:
+        """Probe the spool file, decoding at most once and only when needed.
+
+        The container headers answer the duration limit without decoding;
+        a decode (memoized by content hash) runs for validation, or for the
+        limit when the headers do not carry a duration. If that decode fails
+        without validation, the audio passes through unprobed.
+        """
+        duration = await asyncio.to_thread(read_duration, media.path)
+        if duration is not None:
+            self._check_duration(duration, max_duration_seconds)
+            if not validate:
+                return AudioProbe.from_headers(media.sha256, duration, media.mime_type, media.size)
+        elif not validate and max_duration_seconds is None:
+            return None
+
+        try:
+            probe = await audio_probe_service.probe(
+                media.path,
+                digest=media.sha256,
+                mime_type=media.mime_type,
+                size_bytes=media.size,
+                validate=validate
+            )
+        except (AudioDecodeError, OSError) as e:
+            if validate:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"Could not decode audio for validation: {e}"
+                )
+            logger.warning(f"Could not decode {media.filename} to check its duration: {e}")
+            return None
+        self._check_duration(probe.duration, max_duration_seconds)
+        return probe
+
+    @staticmethod
+    def _check_duration(duration: float, max_duration_seconds: Optional[float]) -> None:
+        if max_duration_seconds is not None and duration > max_duration_seconds:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=(f"Audio is {duration:.1f}s long; "
+                        f"the limit is {max_duration_seconds:.0f}s")
+            )
+
+    async def _upload_to_storage(self, media: SpooledMedia) -> str:
+        """Upload to storage and return URL.
+
+        Streams straight from the ingest spool file; large media goes up as a
+        parallel multipart upload instead of one put_object. Storage is keyed
+        by the spool's SHA-256, so re-uploads of the same audio (client
+        retries, forwarded voice notes) skip the upload entirely.
+        """
+        success, message, file_key = await s3_service.upload_content_addressed(
+            media.path,
+            sha256=media.sha256,
+            filename=media.filename,
+            size=media.size,
+            content_type=media.mime_type
         )
         
         if not success:
@@ -113,12 +191,7 @@ class AudioService:
             
         return s3_service.get_presigned_url(file_key, expires_in=3600)
 
-    async def _cleanup_temp_file(self, temp_file: tempfile.NamedTemporaryFile) -> None:
-        """Clean up temporary file."""
-        try:
-            temp_file_path = Path(temp_file.name)
-            temp_file.close()
-            if temp_file_path.exists():
-                temp_file_path.unlink()
-        except Exception as e:
-            logger.error(f"Failed to clean up temp file: {e}")
+
+# Create singleton instance
+audio_service = AudioService(
+    Path(os.getenv("AUDIO_TEMP_DIR", os.path.join(tempfile.gettempdir(), "audio_uploads"))))
@@ -1,42 +1,16 @@
-import webrtcvad
 import wave
 import logging
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, Optional
 import numpy as np
 import array
-import struct
-from scipy import signal
-import subprocess
-import tempfile
 import os
 import asyncio
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.panel import Panel
-from rich.table import Table
-from rich.theme import Theme
-from rich.style import Style
-from rich.box import ROUNDED
-
-# Custom theme with improved colors and styles
-custom_theme = Theme({
-    "info": "cyan",
-    "warning": "yellow",
-    "error": "red",
-    "success": "green bold",
-    "metric": "cyan",
-    "value": "white",
-    "header": "blue bold"
-})
-
-console = Console(theme=custom_theme)
-logging.basicConfig(
-    level="INFO",
-    format="%(message)s",
-    datefmt="[%X]",
-    handlers=[RichHandler(rich_tracebacks=True, show_time=True, show_path=False)]
-)
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from utils.audio.decoder import audio_decoder, DecodedAudio, AudioDecodeError
+from .validation_reporters import ValidationReporter, NullReporter, create_reporter
 
 logger = logging.getLogger(__name__)
 
@@ -45,9 +19,17 @@ class AudioValidationError(Exception):
     pass
 
 class AudioValidator:
-    def __init__(self, aggressiveness: int = 3):
-        """Initialize VAD with specified aggressiveness (0-3)."""
-        self.vad = webrtcvad.Vad(aggressiveness)
+    def __init__(self, aggressiveness: int = 3, reporter: Optional[ValidationReporter] = None):
+        """Initialize VAD with specified aggressiveness (0-3).
+
+        Args:
+            aggressiveness: VAD aggressiveness (0-3)
+            reporter: Receives each result returned by validate_*; defaults
+                to the one named by AUDIO_VALIDATION_REPORTER
+        """
+        self.aggressiveness = aggressiveness
+        self._vad = None
+        self.reporter = reporter or create_reporter()
         self.frame_duration_ms = 30  # Use 30ms frames for better accuracy
         self.min_speech_frames = 15  # Reduced from 20
         self.min_speech_ratio = 0.25  # Reduced from 0.35
@@ -55,10 +37,15 @@ class AudioValidator:
         self.max_silence_duration = 1.5  # Increased from 1.0
         self.min_duration_seconds = 1.0
         self.max_duration_seconds = 300.0
-        console.print(Panel.fit(
-            f"[success]VAD Initialized[/success]\nAggressiveness: {aggressiveness}",
-            title="Audio Validator"
-        ))
+        logger.debug(f"Validator configured with VAD aggressiveness {aggressiveness}")
+
+    @property
+    def vad(self):
+        """Lazy initialization of the VAD, so webrtcvad is only needed to validate."""
+        if self._vad is None:
+            import webrtcvad
+            self._vad = webrtcvad.Vad(self.aggressiveness)
+        return self._vad
 
     def _frame_generator(self, audio: bytes, sample_rate: int) -> bytes:
         """Generate frames from audio data."""
@@ -72,20 +59,16 @@ class AudioValidator:
 
     def _analyze_audio_energy(self, audio_array: array.array) -> Tuple[bool, dict]:
         """Analyze audio energy levels and patterns."""
-        samples = np.array(audio_array, dtype=np.float32) / 32768.0  # Normalize to [-1, 1]
+        samples = np.asarray(audio_array, dtype=np.float32) / 32768.0  # Normalize to [-1, 1]
         
         frame_length = int(16000 * 0.03)  # 30ms frames
-        energies = []
-        for i in range(0, len(samples), frame_length):
-            frame = samples[i:i + frame_length]
-            if len(frame) == frame_length:
-                energy = np.sqrt(np.mean(frame ** 2))
-                energies.append(float(energy))
-        
-        if not energies:
+        n_frames = len(samples) // frame_length
+        if not n_frames:
             return False, {"error": "No energy frames detected"}
-            
-        energies = np.array(energies)
+
+        # RMS per full 30ms frame over a (frames, samples) view of the buffer
+        frames = samples[:n_frames * frame_length].reshape(n_frames, frame_length)
+        energies = np.sqrt(np.einsum('ij,ij->i', frames, frames) / frame_length)
         
         mean_energy = float(np.mean(energies))
         std_energy = float(np.std(energies))
@@ -129,197 +112,87 @@ class AudioValidator:
         
         stats["checks"] = energy_checks
         
-        console.print(Panel.fit(
-            "[bold]Energy validation results:[/bold]",
-            title="Energy Validation"
-        ))
-        for check, passed in energy_checks.items():
-            status = "[success]✓ PASSED[/success]" if passed else "[error]✗ FAILED[/error]"
-            console.print(f"  {check}: {status}")
-        
         passes_checks = all(energy_checks.values())
         
         return passes_checks, stats
 
     def _process_audio_frames(self, frames_with_timestamps, sample_rate: int) -> Tuple[int, int, bool, dict]:
         """Process audio frames and count speech frames."""
-        speech_frames = 0
-        total_frames = 0
-        window = []
-        consecutive_speech = 0
-        max_consecutive_speech = 0
-        current_silence_duration = 0
-        last_speech_timestamp = None
         window_size = 8  # Window size for context
-        silence_periods = []
-        speech_segments = []
-        current_segment = None
+        decisions = []
+        timestamps = []
+        timestamp = 0.0
+        frame_errors = 0
         
+        # VAD is a per-frame C call; everything after it works on arrays
         for frame, timestamp in frames_with_timestamps:
             if len(frame) < 480:  # Minimum frame size for 30ms at 8kHz
                 continue
                 
             try:
-                is_speech = self.vad.is_speech(frame, sample_rate)
+                decisions.append(self.vad.is_speech(frame, sample_rate))
             except Exception as e:
-                console.print(f"[yellow]Frame processing error[/yellow] at {timestamp:.2f}s: {e}")
+                frame_errors += 1
+                logger.debug(f"Frame processing error at {timestamp:.2f}s: {e}")
                 continue
-                
-            if is_speech:
-                if current_segment is None:
-                    current_segment = {"start": float(timestamp)}
-                consecutive_speech += 1
-                max_consecutive_speech = max(max_consecutive_speech, consecutive_speech)
-                if current_silence_duration > 0:
-                    silence_periods.append(float(current_silence_duration))
-                current_silence_duration = 0
-                last_speech_timestamp = timestamp
-            else:
-                if current_segment is not None:
-                    current_segment["end"] = float(timestamp)
-                    speech_segments.append(current_segment)
-                    current_segment = None
-                consecutive_speech = 0
-                if last_speech_timestamp is not None:
-                    current_silence_duration = float(timestamp - last_speech_timestamp)
-            
-            window.append(is_speech)
-            if len(window) > window_size:
-                window.pop(0)
-            
-            if len(window) == window_size:
-                total_frames += 1
-                if sum(window) >= int(window_size * 0.7):
-                    speech_frames += 1
-        
-        if current_segment is not None:
-            current_segment["end"] = float(timestamp)
-            speech_segments.append(current_segment)
+            timestamps.append(timestamp)
+
+        is_speech = np.array(decisions, dtype=bool)
+        times = np.array(timestamps, dtype=np.float64)
+
+        # Sliding 70%-speech window via cumulative sums
+        total_frames = max(0, len(is_speech) - window_size + 1)
+        speech_frames = 0
+        if total_frames:
+            csum = np.concatenate(([0], np.cumsum(is_speech, dtype=np.int64)))
+            window_sums = csum[window_size:] - csum[:-window_size]
+            speech_frames = int(np.count_nonzero(window_sums >= int(window_size * 0.7)))
+
+        # Run boundaries: starts/ends of speech and silence runs
+        padded = np.concatenate(([False], is_speech, [False]))
+        edges = np.flatnonzero(padded[1:] != padded[:-1])
+        run_starts, run_ends = edges[0::2], edges[1::2]  # end is exclusive
+        max_consecutive_speech = int((run_ends - run_starts).max()) if len(run_starts) else 0
+
+        speech_segments = [
+            {"start": float(times[start]),
+             "end": float(times[end]) if end < len(times) else float(timestamp)}
+            for start, end in zip(run_starts, run_ends)
+        ]
+
+        # A silence period spans from the last speech frame of one run to the
+        # last non-speech frame before the next run starts
+        silence_periods = [
+            float(times[next_start - 1] - times[end - 1])
+            for end, next_start in zip(run_ends[:-1], run_starts[1:])
+        ]
         
         stats = {
-            "max_consecutive_speech_frames": int(max_consecutive_speech),
-            "silence_periods": [float(x) for x in silence_periods],
+            "max_consecutive_speech_frames": max_consecutive_speech,
+            "silence_periods": silence_periods,
             "speech_segments": speech_segments,
             "total_silence_duration": float(sum(silence_periods) if silence_periods else 0),
-            "speech_ratio": float(speech_frames) / float(total_frames) if total_frames > 0 else 0
+            "speech_ratio": float(speech_frames) / float(total_frames) if total_frames > 0 else 0,
+            "frame_errors": frame_errors
         }
         
-        console.print(Panel.fit(
-            "[bold]Speech detection stats:[/bold]",
-            title="Speech Detection"
-        ))
-        console.print(f"  Total frames: {total_frames}")
-        console.print(f"  Speech frames: {speech_frames}")
-        console.print(f"  Speech ratio: {stats['speech_ratio']:.2%}")
-        console.print(f"  Max consecutive speech frames: {max_consecutive_speech}")
-        console.print(f"  Number of speech segments: {len(speech_segments)}")
-        console.print(f"  Total silence duration: {stats['total_silence_duration']:.2f}s")
-        
         has_consecutive = max_consecutive_speech >= self.consecutive_speech_frames
         return speech_frames, total_frames, has_consecutive, stats
 
-    async def _convert_to_wav(self, input_path: Path, output_path: Path) -> bool:
-        """Convert audio file to WAV format using ffmpeg."""
-        try:
-            cmd = [
-                'ffmpeg',
-                '-i', str(input_path),
-                '-af', 'loudnorm=I=-16:LRA=11:TP=-1.5',
-                '-acodec', 'pcm_s16le',
-                '-ac', '1',
-                '-ar', '16000',
-                '-y',
-                '-loglevel', 'error',
-                str(output_path)
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                console.print(f"[red]FFmpeg conversion failed:[/red] {stderr.decode()}")
-                return False
-            
-            if not output_path.exists() or output_path.stat().st_size == 0:
-                console.print("[red]Converted file is empty or does not exist[/red]")
-                return False
-                
-            return True
-            
-        except Exception as e:
-            console.print(f"[red]Audio conversion error:[/red] {str(e)}")
-            return False
-
-    def _create_audio_properties_panel(self, properties: dict) -> Panel:
-        """Create a formatted panel for audio properties."""
-        content = [
-            "[header]Audio Properties[/header]",
-            f"[metric]Format:[/metric] {properties['channels']}ch {properties['width']*8}bit {properties['rate']}Hz",
-            f"[metric]Duration:[/metric] {self.format_duration(properties['duration'])}",
-            f"[metric]Frames:[/metric] {properties['frames']:,}"
-        ]
-        return Panel("\n".join(content), title="Audio File", box=ROUNDED)
-
-    def _create_validation_table(self, results: dict) -> Table:
-        """Create a formatted table for validation results."""
-        table = Table(
-            title="Energy Validation Results",
-            box=ROUNDED,
-            show_header=True,
-            header_style="header",
-            title_style="header"
-        )
-        table.add_column("Metric", style="metric")
-        table.add_column("Status", justify="center")
-        
-        for metric, passed in results.items():
-            status = "[success]✓ PASSED[/success]" if passed else "[error]✗ FAILED[/error]"
-            table.add_row(metric.replace('_', ' ').title(), status)
-        return table
-
-    def _create_speech_stats_table(self, stats: dict) -> Table:
-        """Create a formatted table for speech statistics."""
-        table = Table(
-            title="Speech Detection Statistics",
-            box=ROUNDED,
-            show_header=True,
-            header_style="header",
-            title_style="header"
-        )
-        table.add_column("Metric", style="metric")
-        table.add_column("Value", justify="right", style="value")
-        
-        # Format values with appropriate units and precision
-        formatted_stats = {
-            "Total Frames": f"{stats['Total frames']:,}",
-            "Speech Frames": f"{stats['Speech frames']:,}",
-            "Speech Ratio": f"{float(stats['Speech ratio'].rstrip('%')):.1f}%",
-            "Max Consecutive Speech": f"{stats['Max consecutive speech']:,} frames",
-            "Speech Segments": str(stats['Speech segments']),
-            "Total Silence": self.format_duration(float(stats['Total silence'].rstrip('s')))
-        }
-        
-        for key, value in formatted_stats.items():
-            table.add_row(key, value)
-        return table
-
-    def format_duration(self, seconds: float) -> str:
-        """Format duration in a human-readable way."""
-        if seconds < 1:
-            return f"{seconds*1000:.0f}ms"
-        return f"{seconds:.1f}s"
-
     async def validate_wav(self, audio_path: Path) -> Tuple[bool, dict]:
         """
-        Validate WAV file for speech content.
+        Validate WAV file for speech content in the validation worker pool.
         Returns (has_speech, validation_details).
         """
-        validation_details = {"passed": False, "reason": None}
+        has_speech, validation_details = await validation_pool.submit(audio_path)
+        self.reporter.report(has_speech, validation_details)
+        return has_speech, validation_details
 
+    def validate_wav_sync(self, audio_path: Path) -> Tuple[bool, dict]:
+        """
+        Validate WAV file for speech content in the calling thread.
+        Returns (has_speech, validation_details).
+        """
         try:
             with wave.open(str(audio_path), 'rb') as wf:
                 properties = {
@@ -329,109 +202,188 @@ class AudioValidator:
                     "frames": wf.getnframes(),
                     "duration": wf.getnframes() / wf.getframerate()
                 }
-                
-                console.print("\n")  # Add some spacing
-                console.print(self._create_audio_properties_panel(properties))
-
-                # Read all audio data
-                wf.setpos(0)
                 audio_data = wf.readframes(properties['frames'])
+        except Exception as e:
+            return self._validation_error(e)
+        return self._validate_pcm(properties, audio_data)
 
-                # Convert to array for energy analysis
-                audio_array = array.array('h')
-                audio_array.frombytes(audio_data)
-                
-                # Analyze energy levels
-                energy_passed, energy_stats = self._analyze_audio_energy(audio_array)
-                if not energy_passed:
-                    validation_details["reason"] = "Failed energy level checks"
-                    validation_details.update(energy_stats)
-                    return False, validation_details
-
-                # Analyze speech content
-                speech_frames, total_frames, has_consecutive, frame_stats = self._process_audio_frames(
-                    self._frame_generator(audio_data, properties['rate']), properties['rate']
-                )
+    def validate_pcm_sync(self, pcm: bytes, sample_rate: int = 16000) -> Tuple[bool, dict]:
+        """
+        Validate 16-bit mono PCM for speech content in the calling thread.
+        Returns (has_speech, validation_details).
+        """
+        frames = len(pcm) // 2
+        properties = {
+            "channels": 1,
+            "width": 2,
+            "rate": sample_rate,
+            "frames": frames,
+            "duration": frames / sample_rate
+        }
+        return self._validate_pcm(properties, pcm)
 
-                speech_ratio = frame_stats["speech_ratio"]
-                has_speech = (
-                    speech_ratio >= self.min_speech_ratio and
-                    has_consecutive and
-                    speech_frames >= self.min_speech_frames
-                )
+    def _validate_pcm(self, properties: dict, audio_data: bytes) -> Tuple[bool, dict]:
+        """Run the energy and VAD checks on decoded samples."""
+        validation_details = {
+            "passed": False,
+            "reason": None,
+            "duration_seconds": properties["duration"],
+            "audio_properties": properties
+        }
 
-                validation_details.update(frame_stats)
-                validation_details["energy_stats"] = energy_stats
-                
-                if not has_speech:
-                    validation_details["reason"] = (
-                        f"Insufficient speech content: ratio={speech_ratio:.2%}, "
-                        f"frames={speech_frames}/{total_frames}"
-                    )
-                else:
-                    validation_details["passed"] = True
-                
-                # Display results in well-formatted tables
-                console.print("\n")  # Add spacing between sections
-                console.print(self._create_validation_table(energy_stats["checks"]))
-                console.print("\n")  # Add spacing between tables
-                console.print(self._create_speech_stats_table({
-                    "Total frames": total_frames,
-                    "Speech frames": speech_frames,
-                    "Speech ratio": f"{speech_ratio:.1f}%",
-                    "Max consecutive speech": frame_stats.get("max_consecutive", 0),
-                    "Speech segments": len(frame_stats.get("speech_segments", [])),
-                    "Total silence": f"{frame_stats.get('total_silence_duration', 0):.2f}s"
-                }))
-                
-                # Final status with clear visual indicator
-                result_style = "success" if has_speech else "error"
-                result_icon = "✓" if has_speech else "✗"
-                console.print("\n")  # Add spacing before final status
-                console.print(Panel(
-                    f"[{result_style}]{result_icon} Speech validation {has_speech and 'PASSED' or 'FAILED'}[/{result_style}]" +
-                    (f"\nReason: {validation_details['reason']}" if not has_speech else ""),
-                    title="Validation Result",
-                    box=ROUNDED
-                ))
-                console.print("\n")  # Add final spacing
-                
-                return has_speech, validation_details
+        try:
+            # Convert to array for energy analysis
+            audio_array = array.array('h')
+            audio_array.frombytes(audio_data)
+        
+            # Analyze energy levels
+            energy_passed, energy_stats = self._analyze_audio_energy(audio_array)
+            if not energy_passed:
+                validation_details["reason"] = "Failed energy level checks"
+                validation_details.update(energy_stats)
+                return False, validation_details
+
+            # Analyze speech content
+            speech_frames, total_frames, has_consecutive, frame_stats = self._process_audio_frames(
+                self._frame_generator(audio_data, properties['rate']), properties['rate']
+            )
+
+            speech_ratio = frame_stats["speech_ratio"]
+            has_speech = (
+                speech_ratio >= self.min_speech_ratio and
+                has_consecutive and
+                speech_frames >= self.min_speech_frames
+            )
+
+            validation_details.update(frame_stats)
+            validation_details["energy_stats"] = energy_stats
+        
+            if not has_speech:
+                validation_details["reason"] = (
+                    f"Insufficient speech content: ratio={speech_ratio:.2%}, "
+                    f"frames={speech_frames}/{total_frames}"
+                )
+            else:
+                validation_details["passed"] = True
+        
+            return has_speech, validation_details
 
         except Exception as e:
-            validation_details["reason"] = f"Validation error: {str(e)}"
-            console.print(Panel(
-                f"[error]✗ Error during audio validation[/error]\n{str(e)}",
-                title="Error",
-                box=ROUNDED
-            ))
-            logger.exception("Audio processing error")
-            return False, validation_details
+            return self._validation_error(e)
+
+    def _validation_error(self, e: Exception) -> Tuple[bool, dict]:
+        validation_details = {"passed": False, "reason": f"Validation error: {str(e)}"}
+        logger.exception("Audio processing error")
+        return False, validation_details
 
-    async def validate_audio(self, audio_path: Path, content_type: str = None) -> Tuple[bool, dict]:
+    async def validate_decoded(self, decoded: DecodedAudio) -> Tuple[bool, dict]:
+        """
+        Validate already decoded audio in the validation worker pool.
+        Returns (has_speech, validation_details).
+        """
+        has_speech, validation_details = await validation_pool.submit_pcm(decoded.pcm, decoded.sample_rate)
+        self.reporter.report(has_speech, validation_details)
+        return has_speech, validation_details
+
+    async def validate_audio(
+        self,
+        audio_path: Path,
+        content_type: str = None,
+        digest: Optional[str] = None
+    ) -> Tuple[bool, dict]:
         """
         Validate audio file for speech content.
-        Converts non-WAV files to WAV format before validation.
+        Decodes the file once to 16 kHz mono PCM (shared with other stages
+        through the decoder cache) before validation.
         Returns (has_speech, validation_details).
         """
         if not audio_path.exists():
             return False, {"error": "Audio file does not exist"}
-            
-        if content_type and 'wav' not in content_type.lower():
-            console.print(f"[yellow]Converting {content_type} to WAV format[/yellow]")
-            temp_wav = audio_path.parent / f"{audio_path.stem}_temp.wav"
-            if not await self._convert_to_wav(audio_path, temp_wav):
-                return False, {"error": "Failed to convert audio to WAV format"}
-            audio_path = temp_wav
-            
+
         try:
-            return await self.validate_wav(audio_path)
-        finally:
-            if 'temp_wav' in locals():
-                try:
-                    temp_wav.unlink()
-                except Exception as e:
-                    console.print(f"[yellow]Failed to clean up temp WAV file:[/yellow] {e}")
-
-# Create singleton instance
+            decoded = await audio_decoder.decode(audio_path, digest=digest)
+        except AudioDecodeError as e:
+            logger.warning(f"Audio decoding failed: {e}")
+            validation_details = {"error": "Failed to decode audio"}
+            self.reporter.report(False, validation_details)
+            return False, validation_details
+        return await self.validate_decoded(decoded)
+
+# Per-process validator, created once by the pool initializer so each worker
+# keeps a warm VAD instance across jobs
+_worker_validator: Optional[AudioValidator] = None
+
+
+def _init_worker(aggressiveness: int) -> None:
+    global _worker_validator
+    # Results are reported by the calling process, not the worker
+    _worker_validator = AudioValidator(aggressiveness, reporter=NullReporter())
+
+
+def _validate_in_worker(audio_path: str) -> Tuple[bool, dict]:
+    return _worker_validator.validate_wav_sync(Path(audio_path))
+
+
+def _validate_pcm_in_worker(pcm: bytes, sample_rate: int) -> Tuple[bool, dict]:
+    return _worker_validator.validate_pcm_sync(pcm, sample_rate)
+
+
+class AudioValidationPool:
+    """Runs WAV validation in worker processes so the event loop only awaits a future."""
+
+    def __init__(self, workers: int = 2, aggressiveness: int = 3):
+        """
+        Args:
+            workers: Number of worker processes; 0 validates in a thread instead
+            aggressiveness: VAD aggressiveness (0-3) for the worker validators
+        """
+        self.workers = workers
+        self.aggressiveness = aggressiveness
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """Lazy initialization of the process pool."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # spawn avoids forking a process that is already running threads
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.aggressiveness,)
+            )
+        return self._executor
+
+    async def submit(self, audio_path: Path) -> Tuple[bool, dict]:
+        """Validate a WAV file off the event loop."""
+        return await self._run(_validate_in_worker, str(audio_path))
+
+    async def submit_pcm(self, pcm: bytes, sample_rate: int = 16000) -> Tuple[bool, dict]:
+        """Validate decoded PCM off the event loop."""
+        return await self._run(_validate_pcm_in_worker, pcm, sample_rate)
+
+    async def _run(self, worker_fn, *args) -> Tuple[bool, dict]:
+        if self.workers <= 0:
+            # No pool: this process acts as the single worker, on a thread
+            if _worker_validator is None:
+                _init_worker(self.aggressiveness)
+            return await asyncio.to_thread(worker_fn, *args)
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, worker_fn, *args)
+        except BrokenProcessPool as e:
+            logger.error(f"Audio validation worker died, restarting pool: {e}")
+            self.shutdown(wait=False)
+            return False, {"passed": False, "reason": "Validation worker crashed"}
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+# Create singleton instances
+validation_pool = AudioValidationPool(
+    workers=int(os.getenv("AUDIO_VALIDATION_WORKERS", "2")))
 audio_validator = AudioValidator()
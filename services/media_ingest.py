@@ -0,0 +1,245 @@
+"""
+Streaming ingest for uploaded media.
+
+Uploads are read in fixed-size chunks and spooled to a single temp file while
+the SHA-256 digest and MIME type are computed incrementally; writing and
+hashing run on a worker thread, a batch at a time, so large uploads do not
+hold up the event loop. Validation, S3
+and Gemini then share one read-only memory-mapped view of that file instead
+of each holding its own copy of the bytes.
+"""
+
+import os
+import mmap
+import asyncio
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, List, Optional, Union
+from fastapi import UploadFile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.getenv("MEDIA_INGEST_CHUNK_SIZE", str(1024 * 1024)))
+SNIFF_BYTES = 64
+
+
+class MediaTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured size limit"""
+    pass
+
+
+def sniff_mime_type(header: bytes) -> Optional[str]:
+    """Guess the MIME type of audio/video content from its leading bytes."""
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "audio/wav"
+    if header[:4] == b"OggS":
+        return "audio/ogg"
+    if header[:4] == b"fLaC":
+        return "audio/flac"
+    if header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+        return "audio/aiff"
+    if header[4:8] == b"ftyp":
+        return "video/mp4" if header[8:11] in (b"iso", b"mp4", b"avc") else "audio/mp4"
+    if header[:4] == b"\x1aE\xdf\xa3":
+        return "audio/webm"
+    if header[:3] == b"ID3":
+        return "audio/mp3"
+    if len(header) >= 2 and header[0] == 0xFF:
+        # ADTS (AAC) has layer bits 00; MPEG audio frames use the others
+        if header[1] & 0xF6 == 0xF0:
+            return "audio/aac"
+        if header[1] & 0xE0 == 0xE0:
+            return "audio/mp3"
+    return None
+
+
+class SpooledMedia:
+    """An ingested upload spooled to disk with its digest and detected type."""
+
+    def __init__(
+        self,
+        path: Path,
+        size: int,
+        sha256: str,
+        mime_type: Optional[str],
+        filename: Optional[str] = None,
+        declared_mime_type: Optional[str] = None
+    ):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.sniffed_mime_type = mime_type
+        self.declared_mime_type = declared_mime_type
+        self.filename = filename or path.name
+        self._file: Optional[BinaryIO] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+
+    @property
+    def mime_type(self) -> str:
+        """Sniffed type, falling back to the client-declared type."""
+        return self.sniffed_mime_type or self.declared_mime_type or "application/octet-stream"
+
+    @property
+    def buffer(self) -> memoryview:
+        """Read-only view of the spooled bytes, mapped on first access."""
+        if self._view is None:
+            if self.size == 0:
+                self._view = memoryview(b"")
+            else:
+                self._file = open(self.path, "rb")
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+        return self._view
+
+    def open(self) -> BinaryIO:
+        """Open an independent file handle for stream consumers such as S3."""
+        return open(self.path, "rb")
+
+    def close(self) -> None:
+        """Unmap the buffer and delete the spool file."""
+        try:
+            if self._view is not None:
+                self._view.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            # A consumer still holds a slice; the mapping is freed with it
+            logger.warning(f"Buffer for {self.filename} still referenced at close")
+        finally:
+            self._view = None
+            self._mmap = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Failed to clean up spooled media {self.path}: {e}")
+
+    def __enter__(self) -> "SpooledMedia":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "SpooledMedia":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+
+
+def _spool_batch(out: BinaryIO, digest: "hashlib._Hash", batch: List[bytes]) -> None:
+    for chunk in batch:
+        digest.update(chunk)
+        out.write(chunk)
+
+
+async def ingest_stream(
+    chunks: AsyncIterator[bytes],
+    filename: Optional[str] = None,
+    declared_mime_type: Optional[str] = None,
+    temp_dir: Optional[Union[str, Path]] = None,
+    max_bytes: Optional[int] = None
+) -> SpooledMedia:
+    """Spool an async stream of chunks to a temp file.
+
+    Args:
+        chunks: Async iterator yielding the content
+        filename: Original filename, kept for logging and storage keys
+        declared_mime_type: MIME type claimed by the client
+        temp_dir: Directory for the spool file (system default if None)
+        max_bytes: Reject content larger than this many bytes
+
+    Returns:
+        SpooledMedia owning the temp file; the caller must close it
+    """
+    suffix = Path(filename).suffix if filename else ""
+    fd, name = tempfile.mkstemp(prefix="ingest_", suffix=suffix, dir=temp_dir)
+    path = Path(name)
+    digest = hashlib.sha256()
+    header = b""
+    size = 0
+    batch: List[bytes] = []
+    batch_size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise MediaTooLargeError(
+                        f"{filename or 'upload'} exceeds the {max_bytes} byte limit")
+                if len(header) < SNIFF_BYTES:
+                    header += chunk[:SNIFF_BYTES - len(header)]
+                batch.append(chunk)
+                batch_size += len(chunk)
+                if batch_size >= CHUNK_SIZE:
+                    await asyncio.to_thread(_spool_batch, out, digest, batch)
+                    batch = []
+                    batch_size = 0
+            if batch:
+                await asyncio.to_thread(_spool_batch, out, digest, batch)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+    media = SpooledMedia(
+        path=path,
+        size=size,
+        sha256=digest.hexdigest(),
+        mime_type=sniff_mime_type(header),
+        filename=filename,
+        declared_mime_type=declared_mime_type
+    )
+    if declared_mime_type and media.sniffed_mime_type and declared_mime_type != media.sniffed_mime_type:
+        logger.debug(
+            f"{media.filename}: declared {declared_mime_type}, sniffed {media.sniffed_mime_type}")
+    logger.debug(f"Spooled {size} bytes of {media.filename} to {path}")
+    return media
+
+
+async def _read_upload(upload: UploadFile, chunk_size: int) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _single_chunk(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+async def ingest_upload(
+    upload: UploadFile,
+    temp_dir: Optional[Union[str, Path]] = None,
+    max_bytes: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE
+) -> SpooledMedia:
+    """Spool a FastAPI upload to disk chunk by chunk."""
+    return await ingest_stream(
+        _read_upload(upload, chunk_size),
+        filename=upload.filename,
+        declared_mime_type=upload.content_type,
+        temp_dir=temp_dir,
+        max_bytes=max_bytes
+    )
+
+
+async def ingest_bytes(
+    data: bytes,
+    filename: Optional[str] = None,
+    declared_mime_type: Optional[str] = None,
+    temp_dir: Optional[Union[str, Path]] = None
+) -> SpooledMedia:
+    """Spool content that is already in memory (e.g. a legacy download path)."""
+    return await ingest_stream(
+        _single_chunk(data), filename=filename,
+        declared_mime_type=declared_mime_type, temp_dir=temp_dir)
@@ -1,20 +1,151 @@
 import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 from dotenv import load_dotenv
 import boto3
-import aiohttp
+import aioboto3
 from datetime import datetime
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from typing import Tuple, Optional
+from pathlib import Path
+from typing import Tuple, Optional, Union, BinaryIO, Any, AsyncIterator, Dict, List
 import logging
+from utils.metrics import metrics
 
 # Load environment variables at module level
 load_dotenv()
 
 logger = logging.getLogger("s3_service")
 
+# S3 rejects multipart parts smaller than this, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+StreamSource = Union[AsyncIterator[bytes], str, Path]
+
+
+class ContentIndex:
+    """Local LRU of content hashes already stored in the bucket, mapped to their keys."""
+
+    def __init__(self, max_entries: int = 65536):
+        self.max_entries = max_entries
+        self._keys: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sha256: str) -> Optional[str]:
+        with self._lock:
+            file_key = self._keys.get(sha256)
+            if file_key is not None:
+                self._keys.move_to_end(sha256)
+            return file_key
+
+    def put(self, sha256: str, file_key: str) -> None:
+        with self._lock:
+            self._keys[sha256] = file_key
+            self._keys.move_to_end(sha256)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+
+
+class PresignedUrlCache:
+    """Presigned URLs keyed on (key, method), reused until close to expiry."""
+
+    def __init__(self, margin_seconds: float = 300, max_entries: int = 4096):
+        """
+        Args:
+            margin_seconds: Re-sign once a cached URL has less than this left
+            max_entries: Number of URLs kept (least recently used are dropped)
+        """
+        self.margin_seconds = margin_seconds
+        self.max_entries = max_entries
+        self._urls: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_key: str, method: str) -> Optional[str]:
+        """Return a cached URL that stays valid beyond the safety margin."""
+        with self._lock:
+            entry = self._urls.get((file_key, method))
+            if entry is None or entry[1] - time.time() <= self.margin_seconds:
+                self.misses += 1
+                return None
+            self._urls.move_to_end((file_key, method))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, file_key: str, method: str, url: str, expires_at: float) -> None:
+        with self._lock:
+            self._urls[(file_key, method)] = (url, expires_at)
+            self._urls.move_to_end((file_key, method))
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+
+    def invalidate(self, file_key: str) -> None:
+        """Drop every cached URL for file_key (e.g. after it is overwritten or deleted)."""
+        with self._lock:
+            for cache_key in [k for k in self._urls if k[0] == file_key]:
+                del self._urls[cache_key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._urls),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+async def _iter_file(path: Union[str, Path], chunk_size: int) -> AsyncIterator[bytes]:
+    """Read a file in chunks without blocking the event loop."""
+    with open(path, 'rb') as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def _iter_parts(chunks: AsyncIterator[bytes], part_size: int) -> AsyncIterator[bytes]:
+    """Regroup arbitrary chunks into part_size parts (the last may be shorter)."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
 class S3Service:
-    def __init__(self):
-        """Initialize S3 client with credentials from environment."""
+    def __init__(
+        self,
+        max_pool_connections: int = 50,
+        part_size: int = 8 * 1024 * 1024,
+        multipart_concurrency: int = 4,
+        max_part_attempts: int = 3,
+        presign_margin_seconds: float = 300
+    ):
+        """Initialize S3 client with credentials from environment.
+
+        Args:
+            max_pool_connections: Size of the shared async client's connection pool
+            part_size: Multipart part size in bytes (at least 5 MiB)
+            multipart_concurrency: Parts uploaded (and buffered) at once per upload
+            max_part_attempts: Attempts per part before the upload is aborted
+            presign_margin_seconds: Cached presigned URLs are re-signed once
+                they have less than this many seconds left
+        """
+        self.presigned_urls = PresignedUrlCache(margin_seconds=presign_margin_seconds)
+        self.content_index = ContentIndex()
+        # sha256 -> [lock, coroutines holding or waiting for it]
+        self._content_locks: Dict[str, List[Any]] = {}
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.multipart_concurrency = max(1, multipart_concurrency)
+        self.max_part_attempts = max(1, max_part_attempts)
         required_env_vars = {
             'AWS_ACCESS_KEY_ID': 'aws_access_key',
             'AWS_SECRET_ACCESS_KEY': 'aws_secret_key',
@@ -35,6 +166,20 @@ class S3Service:
         if missing_vars:
             raise ValueError(f"Missing required AWS credentials: {', '.join(missing_vars)}")
 
+        self.client_config = Config(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': 3, 'mode': 'adaptive'}
+        )
+        self._session = aioboto3.Session(
+            aws_access_key_id=self.aws_access_key,
+            aws_secret_access_key=self.aws_secret_key,
+            region_name=self.aws_region_name
+        )
+        self._async_client = None
+        self._async_client_loop = None
+        self._async_client_stack: Optional[AsyncExitStack] = None
+        self._async_client_lock: Optional[asyncio.Lock] = None
+
     @property
     def s3_client(self):
         """Lazy initialization of S3 client."""
@@ -49,40 +194,88 @@ class S3Service:
             self._s3_client.head_bucket(Bucket=self.bucket_name)
         return self._s3_client
 
+    async def async_client(self) -> Any:
+        """Shared aioboto3 client, created on first use in the running event loop.
+
+        All async calls reuse its connection pool. Clients are bound to the
+        loop that created them, so a call from another loop (e.g. a separate
+        bot process loop) gets a fresh client.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is not None and self._async_client_loop is loop:
+            return self._async_client
+
+        if self._async_client_lock is None or self._async_client_loop is not loop:
+            self._async_client_lock = asyncio.Lock()
+            self._async_client_loop = loop
+            self._async_client = None
+            self._async_client_stack = None
+        async with self._async_client_lock:
+            if self._async_client is None:
+                stack = AsyncExitStack()
+                self._async_client = await stack.enter_async_context(
+                    self._session.client('s3', config=self.client_config))
+                self._async_client_stack = stack
+                logger.info("Created shared async S3 client")
+        return self._async_client
+
+    async def close(self) -> None:
+        """Close the shared async client and its connection pool."""
+        stack, self._async_client_stack = self._async_client_stack, None
+        self._async_client = None
+        if stack is not None:
+            await stack.aclose()
+
     async def download_file(self, file_key: str) -> bytes:
-        """Download a file from S3 using a presigned URL."""
-        url = self.s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': self.bucket_name, 'Key': file_key},
-            ExpiresIn=60
-        )
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    raise Exception(f"Failed to download file: HTTP {response.status}")
-                return await response.read()
+        """Download a file from S3 through the shared async client."""
+        client = await self.async_client()
+        response = await client.get_object(Bucket=self.bucket_name, Key=file_key)
+        async with response['Body'] as stream:
+            return await stream.read()
+
+    async def iter_object(self, file_key: str, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+        """Stream an object's body in chunks with get_object.
+
+        For server-side reads: no presigned URL and no extra HTTP hop, and
+        the object is never held in memory as a whole.
+        """
+        client = await self.async_client()
+        response = await client.get_object(Bucket=self.bucket_name, Key=file_key)
+        async with response['Body'] as stream:
+            async for chunk in stream.iter_chunks(chunk_size):
+                yield chunk
 
     def get_file_content(self, file_key: str) -> bytes:
         """Get file content from S3 synchronously."""
         response = self.s3_client.get_object(Bucket=self.bucket_name, Key=file_key)
         return response['Body'].read()
 
-    def get_presigned_url(self, file_key: str, expires_in: int = 3600) -> str:
+    def get_presigned_url(self, file_key: str, expires_in: int = 3600, method: str = 'get_object') -> str:
         """Generate a presigned URL for secure, time-limited access to an S3 object.
+
+        URLs are cached per (file_key, method) and reused until they come
+        within presigned_urls.margin_seconds of expiring, so a reused URL may
+        have less than expires_in left.
         
         Args:
             file_key: The key of the file in S3
             expires_in: Number of seconds until the URL expires (default: 1 hour)
+            method: S3 client method the URL grants, e.g. 'get_object' or 'put_object'
             
         Returns:
             Presigned URL for the S3 object
         """
+        url = self.presigned_urls.get(file_key, method)
+        if url is not None:
+            return url
         try:
+            signed_at = time.time()
             url = self.s3_client.generate_presigned_url(
-                'get_object',
+                method,
                 Params={'Bucket': self.bucket_name, 'Key': file_key},
                 ExpiresIn=expires_in
             )
+            self.presigned_urls.put(file_key, method, url, signed_at + expires_in)
             logger.debug(f"Generated presigned URL for {file_key}, expires in {expires_in}s")
             return url
         except Exception as e:
@@ -91,31 +284,39 @@ class S3Service:
 
     async def upload_file(
         self, 
-        file_content: bytes, 
+        file_content: Union[bytes, BinaryIO], 
         filename: str,
         username: str = "anonymous",
         content_type: str = 'audio/wav',
-        subfolder: str = 'uploads'
+        subfolder: str = 'uploads',
+        content_length: Optional[int] = None
     ) -> Tuple[bool, str, Optional[str]]:
-        """Upload a file to S3 and return success status, message, and file key."""
+        """Upload a file to S3 and return success status, message, and file key.
+
+        file_content may be bytes or a readable binary file object, in which
+        case it is streamed from disk rather than loaded into memory.
+        """
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_key = f"{subfolder}/{username}/{timestamp}_{filename.split('/')[-1]}"
-            
+            file_key, metadata = self._new_object(filename, username, subfolder)
+            if content_length is None and isinstance(file_content, (bytes, bytearray)):
+                content_length = len(file_content)
+
+            put_kwargs = {}
+            if content_length is not None:
+                put_kwargs['ContentLength'] = content_length
+
             # Upload file with metadata
-            self.s3_client.put_object(
+            client = await self.async_client()
+            await client.put_object(
                 Bucket=self.bucket_name,
                 Key=file_key,
                 Body=file_content,
                 ContentType=content_type,
-                Metadata={
-                    'username': username,
-                    'original_filename': filename,
-                    'upload_timestamp': timestamp
-                }
+                Metadata=metadata,
+                **put_kwargs
             )
             
-            logger.info(f"Successfully uploaded {len(file_content)} bytes to S3: {file_key}")
+            logger.info(f"Successfully uploaded {content_length} bytes to S3: {file_key}")
             return True, "File uploaded successfully", file_key
             
         except ClientError as e:
@@ -127,5 +328,205 @@ class S3Service:
             logger.error(f"Unexpected error during S3 upload: {str(e)}")
             return False, f"Upload failed: {str(e)}", None
 
+    @staticmethod
+    def _new_object(filename: str, username: str, subfolder: str) -> Tuple[str, Dict[str, str]]:
+        """Return the key and metadata for a new upload."""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_key = f"{subfolder}/{username}/{timestamp}_{filename.split('/')[-1]}"
+        metadata = {
+            'username': username,
+            'original_filename': filename,
+            'upload_timestamp': timestamp
+        }
+        return file_key, metadata
+
+    async def _upload_part(self, client: Any, file_key: str, upload_id: str,
+                           part_number: int, body: bytes) -> Dict[str, Any]:
+        """Upload one part, retrying just this part with backoff on failure."""
+        for attempt in range(1, self.max_part_attempts + 1):
+            try:
+                response = await client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=file_key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=body
+                )
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            except Exception as e:
+                if attempt == self.max_part_attempts:
+                    raise
+                delay = 0.5 * 2 ** (attempt - 1)
+                logger.warning(f"Part {part_number} of {file_key} failed ({e}); "
+                               f"retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def upload_stream(
+        self,
+        source: StreamSource,
+        filename: str,
+        username: str = "anonymous",
+        content_type: str = 'audio/wav',
+        subfolder: str = 'uploads',
+        file_key: Optional[str] = None
+    ) -> Tuple[bool, str, Optional[str]]:
+        """Stream a file path or async byte iterator to S3 and return success status, message, and file key.
+
+        Content larger than one part goes through a multipart upload: parts
+        are read one at a time and uploaded in parallel, at most
+        multipart_concurrency at once (which also bounds memory), and a
+        failed part is retried on its own. If a part still fails, the upload
+        is aborted so no orphaned parts are billed. Smaller content is sent
+        with a single put_object. file_key overrides the generated
+        timestamp/filename key.
+        """
+        generated_key, metadata = self._new_object(filename, username, subfolder)
+        file_key = file_key or generated_key
+        chunks = _iter_file(source, self.part_size) if isinstance(source, (str, Path)) else source
+        parts = _iter_parts(chunks, self.part_size)
+        upload_id = None
+        tasks: List[asyncio.Task] = []
+        try:
+            client = await self.async_client()
+            first = await anext(parts, None)
+            second = await anext(parts, None) if first is not None else None
+            if second is None:
+                body = first or b''
+                await client.put_object(Bucket=self.bucket_name, Key=file_key, Body=body,
+                                        ContentType=content_type, Metadata=metadata)
+                logger.info(f"Successfully uploaded {len(body)} bytes to S3: {file_key}")
+                return True, "File uploaded successfully", file_key
+
+            response = await client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=file_key,
+                ContentType=content_type, Metadata=metadata)
+            upload_id = response['UploadId']
+
+            slots = asyncio.Semaphore(self.multipart_concurrency)
+            total_bytes = 0
+
+            async def upload_slot(part_number: int, body: bytes) -> Dict[str, Any]:
+                try:
+                    return await self._upload_part(client, file_key, upload_id, part_number, body)
+                finally:
+                    slots.release()
+
+            async def all_parts() -> AsyncIterator[bytes]:
+                yield first
+                yield second
+                async for part in parts:
+                    yield part
+
+            part_number = 0
+            async for body in all_parts():
+                await slots.acquire()
+                # Stop reading as soon as any part has given up
+                failed = next((t for t in tasks if t.done() and t.exception()), None)
+                if failed is not None:
+                    slots.release()
+                    raise failed.exception()
+                part_number += 1
+                total_bytes += len(body)
+                tasks.append(asyncio.create_task(upload_slot(part_number, body)))
+
+            completed = await asyncio.gather(*tasks)
+            await client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=file_key, UploadId=upload_id,
+                MultipartUpload={'Parts': completed})
+            logger.info(f"Successfully uploaded {total_bytes} bytes in {part_number} parts to S3: {file_key}")
+            return True, "File uploaded successfully", file_key
+
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if upload_id is not None:
+                try:
+                    await client.abort_multipart_upload(
+                        Bucket=self.bucket_name, Key=file_key, UploadId=upload_id)
+                except Exception as abort_error:
+                    logger.error(f"Failed to abort multipart upload {upload_id}: {abort_error}")
+            if isinstance(e, ClientError):
+                error_message = e.response['Error']['Message']
+                logger.error(f"S3 upload failed: {error_message}")
+                return False, f"S3 upload failed: {error_message}", None
+            logger.error(f"Unexpected error during S3 upload: {str(e)}")
+            return False, f"Upload failed: {str(e)}", None
+
+    @staticmethod
+    def content_key(sha256: str, filename: Optional[str] = None, subfolder: str = 'media') -> str:
+        """Content-addressed key: the same bytes always map to the same object."""
+        suffix = Path(filename).suffix.lower() if filename else ''
+        return f"{subfolder}/sha256/{sha256[:2]}/{sha256}{suffix}"
+
+    async def object_exists(self, file_key: str, size: Optional[int] = None) -> bool:
+        """HEAD the object; a size mismatch counts as missing (e.g. a truncated write)."""
+        client = await self.async_client()
+        try:
+            response = await client.head_object(Bucket=self.bucket_name, Key=file_key)
+        except ClientError as e:
+            if e.response['Error'].get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return size is None or response.get('ContentLength') == size
+
+    async def upload_content_addressed(
+        self,
+        source: StreamSource,
+        sha256: str,
+        filename: str,
+        size: Optional[int] = None,
+        username: str = "anonymous",
+        content_type: str = 'audio/wav',
+        subfolder: str = 'media'
+    ) -> Tuple[bool, str, Optional[str]]:
+        """Store content under its SHA-256 key, uploading only if it is not there yet.
+
+        A hit in the local index costs nothing; otherwise a HEAD decides
+        whether the upload can be skipped. Concurrent uploads of the same
+        content wait for the first one. Objects are shared by every upload
+        of the same content, so nothing deletes them per upload.
+        """
+        file_key = self.content_key(sha256, filename, subfolder)
+        if self.content_index.get(sha256) == file_key:
+            metrics.increment("s3_dedup_hits", source="index")
+            return True, "File already stored", file_key
+
+        # Counted before the first await, so the lock is only dropped once no
+        # coroutine holds it or is queued on it
+        entry = self._content_locks.setdefault(sha256, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if self.content_index.get(sha256) == file_key:
+                    metrics.increment("s3_dedup_hits", source="index")
+                    return True, "File already stored", file_key
+                try:
+                    exists = await self.object_exists(file_key, size)
+                except Exception as e:
+                    logger.warning(f"HEAD {file_key} failed, uploading anyway: {e}")
+                    exists = False
+                if exists:
+                    metrics.increment("s3_dedup_hits", source="head")
+                    self.content_index.put(sha256, file_key)
+                    return True, "File already stored", file_key
+
+                result = await self.upload_stream(
+                    source, filename, username=username, content_type=content_type,
+                    subfolder=subfolder, file_key=file_key)
+                if result[0]:
+                    metrics.increment("s3_dedup_misses")
+                    self.content_index.put(sha256, file_key)
+                return result
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._content_locks[sha256]
+
+
 # Create singleton instance
-s3_service = S3Service()
\ No newline at end of file
+s3_service = S3Service(
+    max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50")),
+    part_size=int(os.getenv("S3_MULTIPART_PART_SIZE", str(8 * 1024 * 1024))),
+    multipart_concurrency=int(os.getenv("S3_MULTIPART_CONCURRENCY", "4")),
+    presign_margin_seconds=float(os.getenv("S3_PRESIGN_MARGIN_SECONDS", "300")))
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+Reporters for AudioValidator results.
+
+Validation runs in worker processes; its outcome is reported in the calling
+process from the returned details, so reporters see every result and their
+metrics land in this process's sink. The JSON reporter is the production
+default. The Rich reporter renders the detailed panels and tables and is
+meant for local debugging only (Rich is imported on first use).
+"""
+
+import os
+import json
+import logging
+from typing import Dict, Any, Optional
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ValidationReporter:
+    """Receives the outcome of each validation; the base class ignores it."""
+
+    def report(self, has_speech: bool, details: Dict[str, Any]) -> None:
+        pass
+
+
+class NullReporter(ValidationReporter):
+    pass
+
+
+class JsonReporter(ValidationReporter):
+    """Records metrics and logs one structured JSON line per validation."""
+
+    def report(self, has_speech: bool, details: Dict[str, Any]) -> None:
+        outcome = "passed" if has_speech else "failed"
+        if "error" in details or str(details.get("reason", "")).startswith("Validation error"):
+            outcome = "error"
+        metrics.increment("audio_validations", outcome=outcome)
+        if details.get("duration_seconds") is not None:
+            metrics.observe("audio_validation_duration_seconds", details["duration_seconds"])
+        if details.get("speech_ratio") is not None:
+            metrics.observe("audio_validation_speech_ratio", details["speech_ratio"])
+
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        checks = (details.get("energy_stats") or details).get("checks") or {}
+        logger.info(json.dumps({
+            "event": "audio_validation",
+            "outcome": outcome,
+            "reason": details.get("reason") or details.get("error"),
+            "duration_seconds": details.get("duration_seconds"),
+            "speech_ratio": details.get("speech_ratio"),
+            "speech_segments": len(details.get("speech_segments") or []),
+            "total_silence_duration": details.get("total_silence_duration"),
+            "failed_energy_checks": [name for name, passed in checks.items() if not passed]
+        }))
+
+
+def format_duration(seconds: float) -> str:
+    """Format duration in a human-readable way."""
+    if seconds < 1:
+        return f"{seconds*1000:.0f}ms"
+    return f"{seconds:.1f}s"
+
+
+class RichReporter(ValidationReporter):
+    """Renders properties, energy checks, speech stats and the result with Rich."""
+
+    def __init__(self, console: Any = None):
+        from rich.console import Console
+        from rich.theme import Theme
+
+        # Custom theme with improved colors and styles
+        self.console = console or Console(theme=Theme({
+            "info": "cyan",
+            "warning": "yellow",
+            "error": "red",
+            "success": "green bold",
+            "metric": "cyan",
+            "value": "white",
+            "header": "blue bold"
+        }))
+
+    def _create_audio_properties_panel(self, properties: dict) -> Any:
+        """Create a formatted panel for audio properties."""
+        from rich.panel import Panel
+        from rich.box import ROUNDED
+        content = [
+            "[header]Audio Properties[/header]",
+            f"[metric]Format:[/metric] {properties['channels']}ch {properties['width']*8}bit {properties['rate']}Hz",
+            f"[metric]Duration:[/metric] {format_duration(properties['duration'])}",
+            f"[metric]Frames:[/metric] {properties['frames']:,}"
+        ]
+        return Panel("\n".join(content), title="Audio File", box=ROUNDED)
+
+    def _create_table(self, title: str, value_column: str) -> Any:
+        from rich.table import Table
+        from rich.box import ROUNDED
+        table = Table(
+            title=title,
+            box=ROUNDED,
+            show_header=True,
+            header_style="header",
+            title_style="header"
+        )
+        table.add_column("Metric", style="metric")
+        table.add_column(value_column, justify="center" if value_column == "Status" else "right",
+                         style=None if value_column == "Status" else "value")
+        return table
+
+    def _create_validation_table(self, checks: dict) -> Any:
+        """Create a formatted table for energy validation results."""
+        table = self._create_table("Energy Validation Results", "Status")
+        for metric, passed in checks.items():
+            status = "[success]✓ PASSED[/success]" if passed else "[error]✗ FAILED[/error]"
+            table.add_row(metric.replace('_', ' ').title(), status)
+        return table
+
+    def _create_speech_stats_table(self, details: dict) -> Any:
+        """Create a formatted table for speech statistics."""
+        table = self._create_table("Speech Detection Statistics", "Value")
+        formatted_stats = {
+            "Speech Ratio": f"{details.get('speech_ratio', 0) * 100:.1f}%",
+            "Max Consecutive Speech": f"{details.get('max_consecutive_speech_frames', 0):,} frames",
+            "Speech Segments": str(len(details.get("speech_segments") or [])),
+            "Total Silence": format_duration(details.get("total_silence_duration", 0))
+        }
+        for key, value in formatted_stats.items():
+            table.add_row(key, value)
+        return table
+
+    def report(self, has_speech: bool, details: Dict[str, Any]) -> None:
+        from rich.panel import Panel
+        from rich.box import ROUNDED
+
+        if "audio_properties" in details:
+            self.console.print(self._create_audio_properties_panel(details["audio_properties"]))
+        checks = (details.get("energy_stats") or details).get("checks")
+        if checks:
+            self.console.print(self._create_validation_table(checks))
+        if "speech_ratio" in details:
+            self.console.print(self._create_speech_stats_table(details))
+
+        # Final status with clear visual indicator
+        result_style = "success" if has_speech else "error"
+        result_icon = "✓" if has_speech else "✗"
+        reason = details.get("reason") or details.get("error")
+        self.console.print(Panel(
+            f"[{result_style}]{result_icon} Speech validation {has_speech and 'PASSED' or 'FAILED'}[/{result_style}]" +
+            (f"\nReason: {reason}" if not has_speech and reason else ""),
+            title="Validation Result",
+            box=ROUNDED
+        ))
+
+
+REPORTERS = {
+    "null": NullReporter,
+    "json": JsonReporter,
+    "rich": RichReporter
+}
+
+
+def create_reporter(name: Optional[str] = None) -> ValidationReporter:
+    """Build a reporter by name, defaulting to AUDIO_VALIDATION_REPORTER or "json"."""
+    name = (name or os.getenv("AUDIO_VALIDATION_REPORTER", "json")).lower()
+    reporter_class = REPORTERS.get(name)
+    if reporter_class is None:
+        logger.warning(f"Unknown audio validation reporter '{name}', using json")
+        reporter_class = JsonReporter
+    return reporter_class()
@@ -1,110 +1,145 @@
 import asyncio
 import json
 import logging
-import websockets
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
 from dotenv import load_dotenv
 import os
-from utils.ai.gemini_process import process_with_gemini
+import socket
+from typing import Union
+from utils.ai.gemini_process import process_with_gemini_async
+from utils.ai.gemini_scheduler import Priority
+from utils.ai.prompt_registry import prompt_watcher
 from utils.ai.process_llm_request import ProcessLLMRequestContent
+from utils.telegram.user_queues import UserQueues
+from utils.telegram.update_queue import UpdateQueue, LeasedUpdate, get_update_queue
+from utils.telegram.state_store import state_store
+from utils.telegram.conversation_mux import ConversationMux, ConversationClosed
 
 load_dotenv()
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
-WS_URL = "ws://localhost:8080/api/conversation"
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+WS_URL = os.getenv("CONVERSATION_WS_URL", "ws://localhost:8080/api/conversation/mux")
 
-# Store user WebSocket sessions
-user_sessions = {}
+# Users' conversations share a few multiplexed WebSocket connections
+conversation_mux = ConversationMux(
+    WS_URL,
+    connections=int(os.getenv("CONVERSATION_WS_CONNECTIONS", "2")),
+    max_pending=int(os.getenv("CONVERSATION_WS_MAX_PENDING", "8")),
+    idle_seconds=float(os.getenv("CONVERSATION_WS_IDLE_SECONDS", "900"))
+)
+
+# Each user's updates run in order; different users run concurrently
+user_queues = UserQueues(
+    max_pending_per_user=int(os.getenv("TELEGRAM_USER_QUEUE_SIZE", "5")),
+    max_concurrent_jobs=int(os.getenv("TELEGRAM_MAX_CONCURRENT_JOBS", "16"))
+)
 
 # Downloading and Processing of Content including Text should occur alongside these downloading functions
 # recieved inputs can be either hardcoded reasoning flow and parameters or otherwise webhooks to process the content using the handle_private_message to return the wanted results
-async def download_voice_message(update: Update, user_id: int) -> tuple[bool, str]:
-    """Downloads a voice message from a Telegram update."""
+async def download_voice_message(update: Update, user_id: int) -> tuple[bool, Union[bytes, str]]:
+    """Downloads a voice message from a Telegram update into memory."""
     try:
         voice_file = await update.message.voice.get_file()
-        file_path = f"voice_message_{user_id}.ogg"
-        await voice_file.download_to_drive(file_path)
-        logging.info(f"Voice message downloaded to {file_path}")
-        return True, file_path
+        file_data = bytes(await voice_file.download_as_bytearray())
+        logging.info(f"Voice message from user {user_id} downloaded ({len(file_data)} bytes)")
+        return True, file_data
     except Exception as e:
         error_msg = f"Failed to download voice message: {e}"
         logging.error(error_msg)
         return False, error_msg
 
-async def download_video_message(update: Update, user_id: int) -> tuple[bool, str]:
+async def download_video_message(update: Update, user_id: int) -> tuple[bool, Union[bytes, str]]:
     """
-    Downloads a video message from a Telegram update.
+    Downloads a video message from a Telegram update into memory.
+
+    The Bot API serves files of at most 20 MB, so buffering in memory is
+    bounded and avoids shared files in the working directory.
     
     Args:
         update: The telegram update containing the video message
         user_id: The user's telegram ID
         
     Returns:
-        tuple: (success: bool, result: str)
-        - If successful: (True, file_path)
+        tuple: (success: bool, result: bytes | str)
+        - If successful: (True, file_data)
         - If failed: (False, error_message)
     """
     try:
         video_file = await update.message.video.get_file()
-        file_path = f"video_message_{user_id}.mp4"
-        await video_file.download_to_drive(file_path)
-        logging.info(f"Video message downloaded to {file_path}")
-        return True, file_path
+        file_data = bytes(await video_file.download_as_bytearray())
+        logging.info(f"Video message from user {user_id} downloaded ({len(file_data)} bytes)")
+        return True, file_data
     except Exception as e:
         error_msg = f"Failed to download video message: {e}"
         logging.error(error_msg)
         return False, error_msg
 
-# Update the message handler to include video
-async def process_downloaded_file(file_path: str, mime_type: str) -> tuple[bool, str]:
-    """Process a downloaded file with Gemini without modifying the original download logic."""
-    try:
-        # Create the request structure directly instead of using ProcessLLMRequestContent
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
-            
-        uploaded_files = {
-            "role": "user",
-            "content": {
-                "parts": [
-                    {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": file_data
-                        }
-                    },
-                    {
-                        "text": "Analyzing media content"
+def build_media_request(file_data: bytes, mime_type: str, text: str = "Analyzing media content") -> dict:
+    """Wrap downloaded media in the request structure used by process_with_gemini."""
+    return {
+        "role": "user",
+        "content": {
+            "parts": [
+                {
+                    "inline_data": {
+                        "mime_type": mime_type,
+                        "data": file_data
                     }
-                ]
-            }
+                },
+                {
+                    "text": text
+                }
+            ]
         }
-        
-        result = process_with_gemini(
+    }
 
-async def handle_name_input(update: Update, context: CallbackContext, audio_path: str):
+# Update the message handler to include video
+async def process_downloaded_file(file_data: bytes, mime_type: str) -> tuple[bool, str]:
+    """Process downloaded media with Gemini on the async path."""
+    try:
+        uploaded_files = build_media_request(file_data, mime_type)
+
+        result = await process_with_gemini_async(
+            uploaded_files=uploaded_files,
+            prompt_type="default_transcription",
+            temperature=0.7,
+            max_output_tokens=4096,
+            priority=Priority.INTERACTIVE
+        )
+        return True, json.dumps(result, indent=2)
+    except Exception as e:
+        return False, str(e)
+
+async def handle_name_input(update: Update, context: CallbackContext, audio: bytes):
     """Process name input from voice message."""
     user_id = update.message.from_user.id
     
     # Process with Gemini using name_input prompt type
-    result = await process_with_gemini(
-        audio_path=audio_path,
-        prompt_type="name_input"
+    result = await process_with_gemini_async(
+        uploaded_files=build_media_request(audio, "audio/ogg", "Analyzing name introduction"),
+        prompt_type="name_input",
+        priority=Priority.INTERACTIVE
     )
     
-    user_profiles[user_id] = {
-        "name_audio": audio_path,
-        "name_analysis": result
-    }
+    await state_store.update_profile(
+        user_id, replace=True,
+        # Telegram file id: the audio can be fetched again without keeping it here
+        name_audio=update.message.voice.file_id,
+        name_analysis=result
+    )
     
     # Format and send response
+    formatted_result = await format_response_for_telegram(result, "gemini")
     await update.message.reply_text(
         f"I heard your introduction! Is this correct?\n\n"
-        f"{result['analysis']}\n\n"
+        f"{formatted_result}\n\n"
         "Please reply with 'yes' or 'no'."
     )
-    user_states[user_id] = "awaiting_name_confirmation"
+    await state_store.set_state(user_id, "awaiting_name_confirmation")
 
 async def handle_name_confirmation(update: Update, context: CallbackContext):
     """Handle yes/no response for name confirmation."""
@@ -118,41 +153,43 @@ async def handle_name_confirmation(update: Update, context: CallbackContext):
             "Record a voice message with three statements - two true and one false.\n"
             "Make them interesting! I'll try to guess which one is the lie."
         )
-        user_states[user_id] = "awaiting_truthnlie"
+        await state_store.set_state(user_id, "awaiting_truthnlie")
     else:
         await update.message.reply_text(
             "I apologize! Please type your correct full name as you spoke it in the audio."
         )
-        user_states[user_id] = "awaiting_name_correction"
+        await state_store.set_state(user_id, "awaiting_name_correction")
 
-async def handle_truthnlie(update: Update, context: CallbackContext, audio_path: str):
+async def handle_truthnlie(update: Update, context: CallbackContext, audio: bytes):
     """Process truth and lie statements."""
     user_id = update.message.from_user.id
+    profile = await state_store.get_profile(user_id)
+    name_analysis = profile.get("name_analysis") or {}
     
     # Process with Gemini using truthnlie prompt type
-    result = await process_with_gemini(
-        audio_path=audio_path,
-        prompt_type="truthnlie"
+    result = await process_with_gemini_async(
+        uploaded_files=build_media_request(audio, "audio/ogg", "Analyzing truth and lie statements"),
+        prompt_type="truthnlie",
+        step_variables={
+            "name": profile.get("corrected_name") or name_analysis.get("name", ""),
+            "name_analysis": json.dumps(name_analysis)
+        },
+        priority=Priority.INTERACTIVE
     )
     
-    user_profiles[user_id]["truthnlie_audio"] = audio_path
-    user_profiles[user_id]["truthnlie_analysis"] = result
+    await state_store.update_profile(
+        user_id,
+        truthnlie_audio=update.message.voice.file_id,
+        truthnlie_analysis=result
+    )
     
+    formatted_result = await format_response_for_telegram(result, "gemini")
     await update.message.reply_text(
         f"Here's my analysis of your statements:\n\n"
-        f"{result['analysis']}\n\n"
+        f"{formatted_result}\n\n"
         "Did I guess correctly? Reply with 'yes' or 'no'."
     )
-    user_states[user_id] = "awaiting_truthnlie_confirmation"
-
-            uploaded_files=uploaded_files,
-            prompt_type="default_transcription",
-            temperature=0.7,
-            max_output_tokens=4096
-        )
-        return True, json.dumps(result, indent=2)
-    except Exception as e:
-        return False, str(e)
+    await state_store.set_state(user_id, "awaiting_truthnlie_confirmation")
 
 # Modify only the message handling part in handle_private_message
 async def format_response_for_telegram(response: str, response_type: str = "default") -> str:
@@ -188,37 +225,70 @@ async def format_response_for_telegram(response: str, response_type: str = "defa
         logging.error(f"Error formatting response: {e}")
         return f"Error formatting response: {str(e)}"
 
-# Update handle_private_message to use the new formatter
 async def handle_private_message(update: Update, context: CallbackContext):
+    """Queue the update behind the user's earlier ones and return to polling.
+
+    Webhook workers handle it inline instead (see run_update_worker).
+    """
     user_id = update.message.from_user.id
-    state = user_states.get(user_id, "awaiting_name_input")
-    
-    if update.message.voice:
-        file_path = f"voice_message_{user_id}.ogg"
+    if context.application.bot_data.get("ordered_updates"):
+        # The update queue already serializes each chat, and the update may
+        # only be acked once it has been handled
+        await process_private_message(update, context)
+        return
+    if not user_queues.submit(user_id, lambda: process_private_message(update, context)):
+        await update.message.reply_text(
+            "I'm still working on your previous messages. Please wait a moment.")
+
+async def handle_media_message(update: Update, context: CallbackContext, state: str):
+    """Download a voice or video message into memory and analyze it."""
+    user_id = update.message.from_user.id
+    is_voice = bool(update.message.voice)
+    if is_voice:
         success, result = await download_voice_message(update, user_id)
-        
-        if not success:
-            await update.message.reply_text("Sorry, I couldn't process your voice message.")
-            return
-            
-        if state == "awaiting_name_input":
-            await handle_name_input(update, context, file_path)
-        elif state == "awaiting_truthnlie":
-            await handle_truthnlie(update, context, file_path)
+    else:
+        success, result = await download_video_message(update, user_id)
+    if not success:
+        kind = "voice" if is_voice else "video"
+        await update.message.reply_text(f"Sorry, I couldn't process your {kind} message.")
+        return
+
+    if is_voice and state == "awaiting_name_input":
+        await handle_name_input(update, context, result)
+        return
+    if is_voice and state == "awaiting_truthnlie":
+        await handle_truthnlie(update, context, result)
+        return
+
+    success, analysis = await process_downloaded_file(result, "audio/ogg" if is_voice else "video/mp4")
+    if success:
+        await update.message.reply_text(await format_response_for_telegram(analysis, "gemini"))
+    else:
+        await update.message.reply_text(f"Processing failed: {analysis}")
+
+async def process_private_message(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    state = await state_store.get_state(user_id)
+    
+    if update.message.voice or update.message.video:
+        await handle_media_message(update, context, state)
+        return
             
-    elif update.message.text:
+    if update.message.text:
         text = update.message.text.lower()
         
         if state == "awaiting_name_confirmation":
             await handle_name_confirmation(update, context)
+            return
         elif state == "awaiting_name_correction":
             # Store corrected name and move to truth/lie
-            user_profiles[user_id]["corrected_name"] = update.message.text
+            await state_store.update_profile(user_id, corrected_name=update.message.text)
             await update.message.reply_text(
                 "Thanks for the correction! Now let's play Two Truths and a Lie!\n\n"
                 "Record a voice message with three statements - two true and one false."
             )
-            user_states[user_id] = "awaiting_truthnlie"
+            await state_store.set_state(user_id, "awaiting_truthnlie")
+            return
         elif state == "awaiting_truthnlie_confirmation":
             if text == "yes":
                 # Complete the flow
@@ -228,66 +298,31 @@ async def handle_private_message(update: Update, context: CallbackContext):
                     "Join our waitlist to be notified when our app launches!"
                 )
                 # Store final profile data
-                user_states[user_id] = "completed"
+                await state_store.set_state(user_id, "completed")
             else:
                 await update.message.reply_text(
                     "I apologize for my mistake. Would you like to try the game again?\n"
                     "Record a new voice message with your three statements."
                 )
-                user_states[user_id] = "awaiting_truthnlie"
-    
-    if update.message.voice:
-        success, file_path = await download_voice_message(update, user_id)
-        if not success:
-            await update.message.reply_text("Sorry, I couldn't process your voice message.")
+                await state_store.set_state(user_id, "awaiting_truthnlie")
             return
-            
-        success, result = await process_downloaded_file(file_path, "audio/ogg")
-        if success:
-            formatted_result = await format_response_for_telegram(result, "gemini")
-            await update.message.reply_text(formatted_result)
-        else:
-            await update.message.reply_text(f"Processing failed: {result}")
-        return
-        
-    elif update.message.video:
-        success, file_path = await download_video_message(update, user_id)
-        if not success:
-            await update.message.reply_text("Sorry, I couldn't process your video message.")
-            return
-            
-        # Process the downloaded file
-        success, result = await process_downloaded_file(file_path, "video/mp4")
-        if success:
-            await update.message.reply_text(f"Analysis complete:\n{result}")
-        else:
-            await update.message.reply_text(f"Processing failed: {result}")
-        return
 
     message_text = update.message.text
 
     logging.info(f"Received message from user {user_id}: {message_text}")
 
-    # If user does not have an active WebSocket session, create one
-    if user_id not in user_sessions:
-        try:
-            websocket = await websockets.connect(WS_URL)
-            user_sessions[user_id] = websocket
-            logging.info(f"WebSocket connection established for user {user_id}")
-        except Exception as e:
-            logging.error(f"Failed to connect to WebSocket: {e}")
-            await update.message.reply_text("Error connecting to the conversation service.")
-            return
-
-    websocket = user_sessions[user_id]
-
+    # Starts a conversation if the user has none open
     try:
-        # Send user message to WebSocket
-        await websocket.send(message_text)
+        await conversation_mux.send(user_id, message_text)
         logging.info(f"Sent message to WebSocket: {message_text}")
+    except Exception as e:
+        logging.error(f"Failed to connect to WebSocket: {e}")
+        await update.message.reply_text("Error connecting to the conversation service.")
+        return
 
+    try:
         # Wait for WebSocket response
-        response = await websocket.recv()
+        response = await conversation_mux.receive(user_id)
         logging.info(f"Received response from WebSocket: {response}")
 
         # Try parsing JSON response if available
@@ -295,24 +330,22 @@ async def handle_private_message(update: Update, context: CallbackContext):
             parsed_response = json.loads(response)
             formatted_response = json.dumps(parsed_response, indent=2)
             await update.message.reply_text(f"Summary:\n{formatted_response}")
-            del user_sessions[user_id]  # End session
+            await conversation_mux.close_session(user_id)  # End session
         except json.JSONDecodeError:
             await update.message.reply_text(response)
 
+    except ConversationClosed:
+        await update.message.reply_text("The conversation has ended. Send any message to start a new one.")
+
     except Exception as e:
         logging.error(f"Error in WebSocket communication: {e}")
         await update.message.reply_text("An error occurred while processing your request.")
 
 
-# Store user states
-user_states = {}
-# Store user data
-user_profiles = {}
-
 async def start(update: Update, context):
     """Initiates the onboarding flow."""
     user_id = update.message.from_user.id
-    user_states[user_id] = "awaiting_name_input"
+    await state_store.set_state(user_id, "awaiting_name_input")
     
     welcome_message = (
         "Welcome! Let's get to know each other. 👋\n\n"
@@ -339,12 +372,11 @@ async def help(update: Update, context):
     await update.message.reply_text(help_text)
 
 async def stop(update: Update, context):
-    """Stops the current conversation and closes WebSocket connection."""
+    """Stops the current conversation and closes its WebSocket session."""
     user_id = update.message.chat_id
-    if user_id in user_sessions:
+    if conversation_mux.has_session(user_id):
         try:
-            await user_sessions[user_id].close()
-            del user_sessions[user_id]
+            await conversation_mux.close_session(user_id)
             await update.message.reply_text("Conversation stopped. Send any message to start a new one.")
         except Exception as e:
             logging.error(f"Error stopping conversation: {e}")
@@ -355,28 +387,153 @@ async def stop(update: Update, context):
 async def clear(update: Update, context):
     """Clears the conversation history for the user."""
     user_id = update.message.chat_id
-    if user_id in user_sessions:
+    if conversation_mux.has_session(user_id):
         try:
-            await user_sessions[user_id].close()
-            del user_sessions[user_id]
+            await conversation_mux.close_session(user_id)
             await update.message.reply_text("Conversation history cleared. You can start a new conversation.")
         except Exception as e:
             logging.error(f"Error clearing conversation: {e}")
             await update.message.reply_text("Error clearing conversation history. Please try again.")
     else:
         await update.message.reply_text("No conversation history to clear.")
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    
-    app = Application.builder().token(TOKEN).build()
-    
+
+async def on_startup(app: Application):
+    await state_store.start()
+
+async def on_shutdown(app: Application):
+    await state_store.close()
+    await conversation_mux.close()
+
+def build_application() -> Application:
+    """Build the bot application with its handlers registered."""
+    # Updates are handed to per-user queues (or leased one per chat from the
+    # update queue), so the dispatcher itself can run many at once without
+    # breaking each user's ordering
+    app = (Application.builder()
+           .token(TOKEN)
+           .concurrent_updates(int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "256")))
+           .post_init(on_startup)
+           .post_shutdown(on_shutdown)
+           .build())
+
     # Register handlers
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help))
     app.add_handler(MessageHandler(
-        (filters.TEXT | filters.VOICE) & filters.ChatType.PRIVATE,
+        (filters.TEXT | filters.VOICE | filters.VIDEO) & filters.ChatType.PRIVATE,
         handle_private_message
     ))
-    
-    logging.info("Bot is running...")
-    app.run_polling()
+    return app
+
+async def keep_lease(update_queue: UpdateQueue, worker_id: str, update_id: int,
+                     handler: asyncio.Task):
+    """Renew an update's lease while its handlers run; cancel them if it is lost."""
+    while True:
+        await asyncio.sleep(update_queue.lease_seconds / 3)
+        if not await asyncio.to_thread(update_queue.renew, update_id, worker_id):
+            # Another worker may lease the update now; stop before both handle it
+            logging.error(f"Lost the lease on update {update_id}, cancelling its handlers")
+            handler.cancel()
+            return
+
+async def process_leased_update(app: Application, update_queue: UpdateQueue,
+                                worker_id: str, leased: LeasedUpdate):
+    """Run the handlers for one leased update, then ack or release it."""
+    handler = asyncio.create_task(app.process_update(Update.de_json(leased.payload, app.bot)))
+    heartbeat = asyncio.create_task(keep_lease(update_queue, worker_id, leased.update_id, handler))
+    try:
+        await handler
+    except asyncio.CancelledError:
+        if not heartbeat.done():
+            # The worker itself is being cancelled
+            handler.cancel()
+            raise
+        return
+    except Exception as e:
+        # Handler errors are logged by the application; this covers failures
+        # around them, which get retried with backoff
+        delay = min(60, 2 ** leased.attempts)
+        logging.error(f"Update {leased.update_id} failed (attempt {leased.attempts}), retrying in {delay}s: {e}")
+        await asyncio.to_thread(update_queue.release, leased.update_id, worker_id, delay)
+        return
+    finally:
+        heartbeat.cancel()
+    await asyncio.to_thread(update_queue.ack, leased.update_id, worker_id)
+
+async def run_update_worker(app: Application, update_queue: UpdateQueue,
+                            max_in_flight: int = 32, poll_interval: float = 0.5,
+                            purge_interval: float = 600):
+    """
+    Consume updates pushed by the webhook endpoint.
+
+    Any number of workers can run against the same queue: each leases at
+    most one update per chat, handles up to max_in_flight updates at once
+    and acks each only after its handlers finished, so a crashed worker's
+    updates are picked up again when their leases expire.
+
+    Args:
+        app: Application built by build_application
+        update_queue: Queue shared with the webhook endpoint
+        max_in_flight: Updates this worker handles concurrently
+        poll_interval: Seconds to wait when the queue has nothing to lease
+        purge_interval: Seconds between purges of finished updates
+    """
+    if not WEBHOOK_SECRET:
+        # The webhook endpoint rejects every update without it, and
+        # registering a webhook without one would let anyone post updates
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET must be set in worker mode")
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    app.bot_data["ordered_updates"] = True
+    # A user's next update may be leased by another worker
+    state_store.shared = True
+    in_flight: set[asyncio.Task] = set()
+    last_purge = 0.0
+
+    async with app:
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=Update.ALL_TYPES)
+            logging.info(f"Webhook set to {WEBHOOK_URL}")
+        logging.info(f"Update worker {worker_id} is running...")
+
+        await state_store.start()
+        try:
+            while True:
+                loop_time = asyncio.get_running_loop().time()
+                if loop_time - last_purge > purge_interval:
+                    await asyncio.to_thread(update_queue.purge)
+                    last_purge = loop_time
+
+                free = max_in_flight - len(in_flight)
+                leased = await asyncio.to_thread(update_queue.lease, worker_id, free) if free else []
+                for item in leased:
+                    in_flight.add(asyncio.create_task(
+                        process_leased_update(app, update_queue, worker_id, item)))
+
+                if leased and len(in_flight) < max_in_flight:
+                    continue
+                if in_flight:
+                    _, in_flight = await asyncio.wait(
+                        in_flight, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(poll_interval)
+        finally:
+            await state_store.close()
+            await conversation_mux.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    app = build_application()
+
+    if prompt_watcher.interval > 0:
+        prompt_watcher.start()
+
+    if TELEGRAM_MODE == "worker":
+        # Updates arrive through POST /api/telegram/webhook
+        asyncio.run(run_update_worker(
+            app, get_update_queue(),
+            max_in_flight=int(os.getenv("TELEGRAM_WORKER_MAX_IN_FLIGHT", "32"))))
+    else:
+        logging.info("Bot is running...")
+        app.run_polling()
@@ -1,7 +1,7 @@
 from typing import Dict, Any, List, Optional
 from pathlib import Path
 from utils.ai.variable_injector import VariableInjector
-from utils.ai.json_prompt_types_loader import ConfigLoader
+from utils.ai.prompt_registry import get_prompt_registry
 from utils.ai.gemini_chat_formatter import _format_chat_messages
 import logging
 
@@ -14,7 +14,7 @@ class ChatFormatterSystem:
         Args:
             config_dir: Directory containing prompt type configuration files
         """
-        self.config_loader = ConfigLoader(config_dir)
+        self.config_dir = config_dir
         self.variable_injector = VariableInjector()
         
     def format_chat(self,
@@ -40,10 +40,12 @@ class ChatFormatterSystem:
             # Load prompt type configuration if specified
             prompt_type = None
             if prompt_type_name:
-                prompt_type = self.config_loader.load_config(prompt_type_name, variables)
-                if not prompt_type:
+                # Fetched per call so hot reloads of the configs are picked up
+                compiled_prompt = get_prompt_registry(self.config_dir).get(prompt_type_name)
+                if not compiled_prompt:
                     logger.error(f"Failed to load prompt type: {prompt_type_name}")
                     raise ValueError(f"Failed to load prompt type: {prompt_type_name}")
+                prompt_type = compiled_prompt.to_prompt_schema(variables)
             
             # Format messages using the Gemini formatter
             formatted_messages = _format_chat_messages(
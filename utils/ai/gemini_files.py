@@ -0,0 +1,229 @@
+"""Gemini File API uploads for large media, cached by content hash.
+
+Inline base64 adds a third to the request size and keeps a full copy of the
+media in memory for every call. Media at or above the size threshold is
+uploaded once with genai.upload_file and later prompts refer to it through a
+file_data part. Handles are cached by the SHA-256 of the content until
+shortly before Gemini expires the upload (48 hours).
+"""
+
+import io
+import os
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Union
+import google.generativeai as genai
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Gemini keeps uploaded files for 48 hours
+FILE_TTL_SECONDS = 48 * 3600
+
+
+class _FileHandle:
+    __slots__ = ("name", "uri", "mime_type", "size", "expires_at")
+
+    def __init__(self, name: str, uri: str, mime_type: str, size: int, expires_at: float):
+        self.name = name
+        self.uri = uri
+        self.mime_type = mime_type
+        self.size = size
+        self.expires_at = expires_at
+
+    def to_part(self) -> Dict[str, Any]:
+        return {"file_data": {"mime_type": self.mime_type, "file_uri": self.uri}}
+
+
+def _inline_size(inline: Dict[str, Any]) -> int:
+    """Decoded size of inline data without decoding it."""
+    data = inline.get("data") or b""
+    if isinstance(data, str):
+        return len(data) * 3 // 4 - data[-2:].count("=")
+    return len(data)
+
+
+class GeminiFileCache:
+    def __init__(
+        self,
+        threshold_bytes: int = 4 * 1024 * 1024,
+        expiry_margin_seconds: float = 3600,
+        poll_interval: float = 1.0,
+        processing_timeout: float = 300.0
+    ):
+        """Initialize the cache.
+
+        Args:
+            threshold_bytes: Media at or above this size goes through the File API
+            expiry_margin_seconds: Stop reusing a handle this long before it expires
+            poll_interval: Seconds between state checks while Gemini processes an upload
+            processing_timeout: Give up waiting for an upload to become ACTIVE after this long
+        """
+        self.threshold_bytes = threshold_bytes
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self.poll_interval = poll_interval
+        self.processing_timeout = processing_timeout
+        self._handles: Dict[str, _FileHandle] = {}
+        self._sizes_by_uri: Dict[str, int] = {}
+        self._digests_by_uri: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        # digest -> [lock, threads holding or waiting for it]
+        self._upload_locks: Dict[str, List[Any]] = {}
+
+    def should_upload(self, size: int) -> bool:
+        return self.threshold_bytes > 0 and size >= self.threshold_bytes
+
+    def _cached(self, digest: str) -> Optional[_FileHandle]:
+        with self._lock:
+            handle = self._handles.get(digest)
+            if handle and handle.expires_at > time.time():
+                return handle
+            if handle:
+                del self._handles[digest]
+                self._forget_uri(handle.uri)
+            return None
+
+    def _forget_uri(self, uri: str) -> None:
+        # Caller holds self._lock
+        self._sizes_by_uri.pop(uri, None)
+        self._digests_by_uri.pop(uri, None)
+
+    def _wait_until_active(self, uploaded: Any) -> Any:
+        deadline = time.monotonic() + self.processing_timeout
+        while uploaded.state.name == "PROCESSING":
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Gemini file {uploaded.name} still processing")
+            time.sleep(self.poll_interval)
+            uploaded = genai.get_file(uploaded.name)
+        if uploaded.state.name != "ACTIVE":
+            raise RuntimeError(f"Gemini file {uploaded.name} is {uploaded.state.name}")
+        return uploaded
+
+    def _expires_at(self, uploaded: Any) -> float:
+        expiration = getattr(uploaded, "expiration_time", None)
+        expires_at = expiration.timestamp() if expiration else time.time() + FILE_TTL_SECONDS
+        return expires_at - self.expiry_margin_seconds
+
+    def get_or_upload(
+        self,
+        source: Union[str, Path, io.IOBase],
+        mime_type: str,
+        digest: str,
+        size: int
+    ) -> _FileHandle:
+        """Return the cached handle for digest, uploading source on a miss.
+
+        Args:
+            source: File path or binary file object with the media
+            mime_type: MIME type of the media
+            digest: SHA-256 hex digest of the media bytes
+            size: Size of the media in bytes
+
+        Returns:
+            Handle of an ACTIVE Gemini file
+        """
+        handle = self._cached(digest)
+        if handle:
+            metrics.increment("gemini_file_cache_hits")
+            return handle
+
+        with self._lock:
+            entry = self._upload_locks.setdefault(digest, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            # Concurrent requests for the same media share one upload
+            with entry[0]:
+                handle = self._cached(digest)
+                if handle:
+                    metrics.increment("gemini_file_cache_hits")
+                    return handle
+
+                started = time.monotonic()
+                uploaded = genai.upload_file(source, mime_type=mime_type, display_name=digest[:32])
+                uploaded = self._wait_until_active(uploaded)
+                handle = _FileHandle(uploaded.name, uploaded.uri, mime_type, size, self._expires_at(uploaded))
+                with self._lock:
+                    self._handles[digest] = handle
+                    self._sizes_by_uri[handle.uri] = size
+                    self._digests_by_uri[handle.uri] = digest
+        finally:
+            # Released on failures too; removed once no thread holds or awaits it
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._upload_locks[digest]
+
+        metrics.increment("gemini_file_uploads")
+        metrics.observe("gemini_file_upload_seconds", time.monotonic() - started)
+        logger.info(f"Uploaded {size} bytes to the Gemini File API as {handle.name}")
+        return handle
+
+    def resolve_part(self, part: Dict[str, Any]) -> Dict[str, Any]:
+        """Swap large inline_data for a file_data reference; other parts pass through."""
+        inline = part.get("inline_data")
+        if not inline:
+            return part
+        size = _inline_size(inline)
+        if not self.should_upload(size):
+            return part
+        data = inline.get("data") or b""
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        try:
+            handle = self.get_or_upload(
+                io.BytesIO(data), inline.get("mime_type", "application/octet-stream"),
+                hashlib.sha256(data).hexdigest(), size)
+        except Exception as e:
+            logger.warning(f"File API upload failed, sending {size} bytes inline: {e}")
+            return part
+        return handle.to_part()
+
+    def resolve_parts(self, parts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [self.resolve_part(part) for part in parts]
+
+    async def resolve_parts_async(self, parts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async resolve_parts; uploads run in a worker thread."""
+        if not any(self.should_upload(_inline_size(part["inline_data"]))
+                   for part in parts if part.get("inline_data")):
+            return parts
+        return await asyncio.to_thread(self.resolve_parts, parts)
+
+    async def file_part_async(self, path: Union[str, Path], mime_type: str,
+                              digest: str, size: int) -> Dict[str, Any]:
+        """Upload (or reuse) media already on disk and return its file_data part."""
+        handle = await asyncio.to_thread(self.get_or_upload, str(path), mime_type, digest, size)
+        return handle.to_part()
+
+    def file_sizes(self) -> Dict[str, int]:
+        """Sizes of cached uploads by URI, for token estimates."""
+        with self._lock:
+            return dict(self._sizes_by_uri)
+
+    def file_digests(self) -> Dict[str, str]:
+        """SHA-256 of cached uploads by URI, so results can be keyed on content."""
+        with self._lock:
+            return dict(self._digests_by_uri)
+
+    def invalidate(self, digest: str) -> None:
+        with self._lock:
+            handle = self._handles.pop(digest, None)
+            if handle:
+                self._forget_uri(handle.uri)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "threshold_bytes": self.threshold_bytes,
+                "cached_files": len(self._handles),
+                "cached_bytes": sum(handle.size for handle in self._handles.values())
+            }
+
+
+# Create singleton instance (a threshold of 0 disables the File API path)
+gemini_files = GeminiFileCache(
+    threshold_bytes=int(os.getenv("GEMINI_FILE_API_THRESHOLD", str(4 * 1024 * 1024))))
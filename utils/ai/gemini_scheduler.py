@@ -0,0 +1,201 @@
+"""Shared scheduler bounding concurrent Gemini calls per model.
+
+Callers wait for a slot on the model they target; waiting callers are served
+by priority (interactive Telegram turns before bulk uploads) and then FIFO.
+
+The lanes live on one event loop, the first running loop to use the
+scheduler. Callers on any other loop (a worker thread running its own loop)
+are forwarded to it, so lane state is only ever touched from that loop's
+thread.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from enum import IntEnum
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple, Any, Optional, AsyncIterator
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Lower values are scheduled first."""
+    INTERACTIVE = 0
+    BULK = 10
+
+
+def _priority_label(priority: int) -> str:
+    try:
+        return Priority(priority).name
+    except ValueError:
+        return str(priority)
+
+
+class _ModelLane:
+    """Concurrency state for a single model."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.max_queue_depth = 0
+        self.completed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, fut in self.waiters if not fut.done())
+
+
+class GeminiScheduler:
+    def __init__(self, default_limit: int = 4, limits: Optional[Dict[str, int]] = None):
+        """Initialize the scheduler.
+
+        Args:
+            default_limit: Maximum concurrent requests for models without an explicit limit
+            limits: Per-model overrides of the concurrency limit
+        """
+        if default_limit < 1:
+            raise ValueError("default_limit must be at least 1")
+        self.default_limit = default_limit
+        self.limits = dict(limits or {})
+        self._lanes: Dict[str, _ModelLane] = {}
+        self._sequence = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """The running loop the lanes live on, if any."""
+        loop = self._loop
+        return loop if loop is not None and loop.is_running() else None
+
+    def _home(self) -> asyncio.AbstractEventLoop:
+        """Loop lane state belongs to, adopting the caller's if the old one stopped."""
+        home = self.loop
+        if home is None:
+            if self._loop is not None:
+                # Waiters of a stopped loop can never be woken; start afresh
+                logger.info("Gemini scheduler moving to a new event loop")
+                self._lanes = {}
+            home = self._loop = asyncio.get_running_loop()
+        return home
+
+    def _lane(self, model_name: str) -> _ModelLane:
+        lane = self._lanes.get(model_name)
+        if lane is None:
+            lane = _ModelLane(self.limits.get(model_name, self.default_limit))
+            self._lanes[model_name] = lane
+        return lane
+
+    def _report(self, model_name: str, lane: _ModelLane) -> None:
+        depth = lane.queue_depth
+        lane.max_queue_depth = max(lane.max_queue_depth, depth)
+        metrics.gauge("gemini_scheduler_queue_depth", depth, model=model_name)
+        metrics.gauge("gemini_scheduler_active", lane.active, model=model_name)
+
+    async def acquire(self, model_name: str, priority: int = Priority.BULK) -> None:
+        """Wait until a slot for model_name is available."""
+        home = self._home()
+        if home is not asyncio.get_running_loop():
+            await self._acquire_on(home, model_name, priority)
+            return
+
+        lane = self._lane(model_name)
+        started = time.monotonic()
+
+        if lane.active < lane.limit and not lane.queue_depth:
+            lane.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(lane.waiters, (int(priority), next(self._sequence), future))
+            self._report(model_name, lane)
+            try:
+                # release() hands its slot straight to us, so active is unchanged
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just as we were cancelled
+                    self.release(model_name)
+                raise
+
+        waited = time.monotonic() - started
+        metrics.observe("gemini_scheduler_wait_seconds", waited,
+                        model=model_name, priority=_priority_label(priority))
+        self._report(model_name, lane)
+        if waited > 1:
+            logger.info(f"Waited {waited:.2f}s for a Gemini slot on '{model_name}'")
+
+    async def _acquire_on(self, home: asyncio.AbstractEventLoop, model_name: str,
+                          priority: int) -> None:
+        """Acquire on the home loop for a caller running on another loop."""
+        handoff = asyncio.run_coroutine_threadsafe(self.acquire(model_name, priority), home)
+        try:
+            await asyncio.wrap_future(handoff)
+        except asyncio.CancelledError:
+            if handoff.done() and not handoff.cancelled() and handoff.exception() is None:
+                # The slot was granted just as we were cancelled
+                self.release(model_name)
+            raise
+
+    def release(self, model_name: str) -> None:
+        """Return a slot, handing it to the highest-priority waiter if any."""
+        home = self.loop
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        if home is not None and home is not current:
+            home.call_soon_threadsafe(self.release, model_name)
+            return
+
+        lane = self._lane(model_name)
+        lane.completed += 1
+        while lane.waiters:
+            _, _, future = heapq.heappop(lane.waiters)
+            if not future.done():
+                future.set_result(None)
+                self._report(model_name, lane)
+                return
+        lane.active = max(0, lane.active - 1)
+        self._report(model_name, lane)
+
+    @asynccontextmanager
+    async def slot(self, model_name: str, priority: int = Priority.BULK) -> AsyncIterator[None]:
+        """Async context manager holding a slot for the duration of a call."""
+        await self.acquire(model_name, priority)
+        try:
+            yield
+        finally:
+            self.release(model_name)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return per-model concurrency and queue statistics."""
+        return {
+            model_name: {
+                "limit": lane.limit,
+                "active": lane.active,
+                "queue_depth": lane.queue_depth,
+                "max_queue_depth": lane.max_queue_depth,
+                "completed": lane.completed
+            }
+            for model_name, lane in self._lanes.items()
+        }
+
+
+def _parse_limits(raw: str) -> Dict[str, int]:
+    """Parse 'model=limit,model=limit' into a dict."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in raw.split(","))):
+        name, _, value = item.partition("=")
+        limits[name.strip()] = int(value)
+    return limits
+
+
+# Create singleton instance
+gemini_scheduler = GeminiScheduler(
+    default_limit=int(os.getenv("GEMINI_MAX_CONCURRENCY", "4")),
+    limits=_parse_limits(os.getenv("GEMINI_MODEL_CONCURRENCY", "")))
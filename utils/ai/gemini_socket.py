@@ -4,6 +4,9 @@ import json
 from dotenv import load_dotenv
 import os
 from typing import Optional, AsyncGenerator, Literal, Dict, Any, List, Union
+from utils.ai.rate_limiter import rate_limiter, is_rate_limit_error
+from utils.ai.token_counter import token_counter
+from utils.ai.token_estimator import token_estimator
 
 ResponseType = Literal["TEXT", "AUDIO"]
 VoiceName = Literal["Aoede", "Charon", "Fenrir", "Kore", "Puck"]
@@ -13,9 +16,49 @@ class ServerMessage:
         self.message_type = message_type
         self.content = content
 
+class RateLimitedChatSession:
+    """Chat session whose sends go through the shared Gemini rate limiter."""
+
+    def __init__(self, chat: Any, model_id: str):
+        self.chat = chat
+        self.model_id = model_id
+
+    async def send_message_async(self, content: Any, **kwargs) -> Any:
+        """Send a message, waiting for rate limit budget and backing off on 429."""
+        # The whole history is resent with every message, so budget for it too
+        history_parts = [part for message in self.chat.history for part in getattr(message, "parts", [])]
+        parts = [{"text": part.text} for part in history_parts if getattr(part, "text", None)]
+        if isinstance(content, str):
+            parts.append({"text": content})
+        raw_tokens = token_counter.estimate_parts_tokens(parts)
+        # Media and non-text content are billed but not estimated, so they must not calibrate
+        text_only = isinstance(content, str) and len(parts) == len(history_parts) + 1
+        estimated_tokens = token_estimator.correct(self.model_id, raw_tokens)
+
+        for attempt in range(1, rate_limiter.max_attempts + 1):
+            await rate_limiter.acquire(self.model_id, estimated_tokens)
+            try:
+                response = await self.chat.send_message_async(content, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                rate_limiter.on_throttled(self.model_id)
+                if attempt == rate_limiter.max_attempts:
+                    raise
+                continue
+            rate_limiter.on_success(self.model_id)
+            rate_limiter.record_usage(self.model_id, estimated_tokens, response)
+            if text_only:
+                token_estimator.observe_response(self.model_id, raw_tokens, response)
+            return response
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.chat, name)
+
 class GeminiWebSocket:
     def __init__(self, api_key: str, model_id: str = "gemini-2.0-flash-exp") -> None:
         genai.configure(api_key=api_key)
+        self.model_id = model_id
         self.model = genai.GenerativeModel(model_id)
         self.tools: List[Dict[str, Any]] = []
         self.active_function_calls: Dict[str, Any] = {}
@@ -48,8 +91,8 @@ class GeminiWebSocket:
         self, 
         response_type: ResponseType = "TEXT", 
         voice_name: Optional[VoiceName] = None
-    ) -> genai.GenerativeModel:
-        """Initialize a session with specified response type and voice settings"""
+    ) -> RateLimitedChatSession:
+        """Initialize a rate-limited chat session with specified response type and voice settings"""
         config = {
             "responseModalities": [response_type],
             "tools": self.tools
@@ -64,7 +107,7 @@ class GeminiWebSocket:
                 }
             }
         
-        return self.model
+        return RateLimitedChatSession(self.model.start_chat(), self.model_id)
 
     async def process_server_message(self, message: Any) -> ServerMessage:
         """Process different types of server messages"""
@@ -89,8 +132,7 @@ class GeminiWebSocket:
         voice_name: Optional[VoiceName] = None
     ) -> None:
         """Run an interactive chat session with configurable response type"""
-        model = await self.create_session(response_type, voice_name)
-        chat = model.start_chat()
+        chat = await self.create_session(response_type, voice_name)
         
         print(f"Session started with {response_type} response type")
         if voice_name:
@@ -0,0 +1,100 @@
+"""Bounded registry of configured Gemini GenerativeModel instances."""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple, Any
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+ModelKey = Tuple[str, float, float, int, int]
+
+
+class GenerativeModelRegistry:
+    """Thread-safe LRU cache of GenerativeModel instances.
+
+    Models are keyed on (model_name, temperature, top_p, top_k, max_output_tokens)
+    so callers sharing the same generation parameters reuse one instance
+    instead of rebuilding the GenerationConfig and model per request.
+    """
+
+    def __init__(self, max_size: int = 16):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self._models: "OrderedDict[ModelKey, genai.GenerativeModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_model(
+        self,
+        model_name: str = "gemini-1.5-flash",
+        temperature: float = 1.0,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        max_output_tokens: int = 8192
+    ) -> genai.GenerativeModel:
+        """Return a cached model for the given parameters, building it on a miss."""
+        key: ModelKey = (model_name, float(temperature), float(top_p), int(top_k), int(max_output_tokens))
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+
+        # Build outside the lock so a slow construction does not block hits
+        generation_config = genai.types.GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            max_output_tokens=max_output_tokens)
+        model = genai.GenerativeModel(model_name=model_name,
+                                      generation_config=generation_config)
+
+        with self._lock:
+            # Another thread may have built the same model in the meantime
+            existing = self._models.get(key)
+            if existing is not None:
+                self._models.move_to_end(key)
+                return existing
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                evicted_key, _ = self._models.popitem(last=False)
+                self.evictions += 1
+                logger.debug(f"Evicted Gemini model from registry: {evicted_key}")
+
+        logger.info(f"Created Gemini model '{model_name}' for registry key {key}")
+        return model
+
+    def stats(self) -> Dict[str, Any]:
+        """Return registry size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._models),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def clear(self) -> None:
+        """Drop all cached models and reset counters."""
+        with self._lock:
+            self._models.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+# Create singleton instance
+model_registry = GenerativeModelRegistry(
+    max_size=int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "16")))
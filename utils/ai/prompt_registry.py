@@ -0,0 +1,261 @@
+"""Compiled, immutable registry of prompt type configurations.
+
+Each ``configs/*.json`` file is parsed and validated once. Its prompt text is
+split into literal segments and ``{name}`` / ``{{ name }}`` placeholders so
+rendering is a single join. The response schema is serialised to the JSON
+string appended to prompts ahead of time.
+
+Registries are never mutated. PromptRegistryWatcher polls the config files
+and, when one changes, compiles a new registry and swaps it in atomically.
+A prompt's version is derived from its file content, so the same revision
+has the same version in every process and across restarts.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, Any, Iterator, Mapping, Optional, Tuple, Union
+from utils.ai.json_prompt_types_loader import ConfigLoader
+from utils.ai.gemini_config import PromptSchema
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIGS_DIR = os.getenv(
+    "PROMPT_CONFIGS_DIR",
+    str(Path(__file__).resolve().parents[2] / "configs"))
+
+PLACEHOLDER_PATTERN = re.compile(
+    r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+class PromptTemplate:
+    """Prompt text pre-tokenized into literal text and named placeholders.
+
+    Placeholders without a matching variable are left as written, matching
+    the previous str.replace based injection.
+    """
+
+    __slots__ = ("source", "placeholders", "_segments")
+
+    def __init__(self, source: str):
+        self.source = source
+        segments = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(source):
+            segments.append((source[position:match.start()], None, None))
+            segments.append(("", match.group(1) or match.group(2), match.group(0)))
+            position = match.end()
+        segments.append((source[position:], None, None))
+        self._segments: Tuple[Tuple[str, Optional[str], Optional[str]], ...] = tuple(
+            segment for segment in segments if segment[0] or segment[1])
+        self.placeholders = frozenset(name for _, name, _ in self._segments if name)
+
+    def render(self, variables: Optional[Dict[str, Any]] = None) -> str:
+        """Substitute variables into the template."""
+        if not variables or not self.placeholders:
+            return self.source
+        return "".join(
+            literal if name is None
+            else str(variables[name]) if name in variables
+            else raw
+            for literal, name, raw in self._segments)
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    name: str
+    template: PromptTemplate
+    response_schema: Union[str, dict]
+    schema_json: str
+    schema_template: Optional[PromptTemplate] = None
+    content_hash: str = ""
+
+    @property
+    def version(self) -> str:
+        """Short content hash identifying this revision of the prompt."""
+        return self.content_hash[:12]
+
+    def render(self, variables: Optional[Dict[str, Any]] = None, force_json: bool = True) -> str:
+        """Render the full prompt, with the response format appended when force_json is set."""
+        prompt_text = self.template.render(variables)
+        if not force_json:
+            return prompt_text
+        schema_json = self.schema_json
+        if self.schema_template is not None and variables:
+            schema_json = json.dumps(self.schema_template.render(variables), indent=2)
+        return f"{prompt_text}\nResponse format: {schema_json}"
+
+    def to_prompt_schema(self, variables: Optional[Dict[str, Any]] = None) -> PromptSchema:
+        """Return the rendered config in the PromptSchema shape used by the formatters."""
+        return {
+            "prompt_text": self.template.render(variables),
+            "response_schema": self.response_schema
+        }
+
+
+class PromptRegistry(Mapping[str, CompiledPrompt]):
+    """Read-only mapping of prompt type name to compiled prompt."""
+
+    def __init__(self, prompts: Dict[str, CompiledPrompt], config_dir: str):
+        self._prompts = MappingProxyType(dict(prompts))
+        self.config_dir = config_dir
+        digest = hashlib.sha256()
+        for name in sorted(self._prompts):
+            digest.update(f"{name}:{self._prompts[name].content_hash}\n".encode())
+        self.version = digest.hexdigest()[:12]
+
+    def __getitem__(self, name: str) -> CompiledPrompt:
+        return self._prompts[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._prompts)
+
+    def __len__(self) -> int:
+        return len(self._prompts)
+
+    def versions(self) -> Dict[str, str]:
+        """Return the current version of every prompt type."""
+        return {name: prompt.version for name, prompt in self._prompts.items()}
+
+    @classmethod
+    def from_directory(cls, config_dir: str, previous: Optional["PromptRegistry"] = None) -> "PromptRegistry":
+        """Load, validate and compile every JSON config in config_dir.
+
+        When previous is given, unchanged files reuse their compiled prompt
+        and files that fail to load keep their previous compiled prompt.
+        """
+        loader = ConfigLoader(config_dir)
+        prompts = {}
+        for filename in sorted(os.listdir(config_dir)):
+            if not filename.endswith('.json'):
+                continue
+            prompt_type = os.path.splitext(filename)[0]
+            old_prompt = previous.get(prompt_type) if previous else None
+            with open(os.path.join(config_dir, filename), 'rb') as f:
+                content_hash = hashlib.sha256(f.read()).hexdigest()
+            if old_prompt and old_prompt.content_hash == content_hash:
+                prompts[prompt_type] = old_prompt
+                continue
+
+            config = loader.load_config(prompt_type)
+            if not config:
+                logger.error(f"Failed to load configuration for '{prompt_type}'.")
+                if old_prompt:
+                    prompts[prompt_type] = old_prompt
+                continue
+            prompts[prompt_type] = compile_prompt(prompt_type, config, content_hash)
+            logger.info(f"Compiled configuration '{prompt_type}' v{prompts[prompt_type].version} successfully.")
+        return cls(prompts, config_dir)
+
+
+def compile_prompt(name: str, config: PromptSchema, content_hash: str = "") -> CompiledPrompt:
+    """Compile a validated prompt config."""
+    response_schema = config["response_schema"]
+    return CompiledPrompt(
+        name=name,
+        template=PromptTemplate(config["prompt_text"]),
+        response_schema=response_schema,
+        schema_json=json.dumps(response_schema, indent=2),
+        # String schemas may carry placeholders of their own
+        schema_template=PromptTemplate(response_schema) if isinstance(response_schema, str) else None,
+        content_hash=content_hash)
+
+
+_registries: Dict[str, PromptRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def _registry_key(config_dir: Optional[str]) -> str:
+    return str(Path(config_dir or DEFAULT_CONFIGS_DIR).resolve())
+
+
+def get_prompt_registry(config_dir: Optional[str] = None) -> PromptRegistry:
+    """Return the current compiled registry for config_dir, compiling it on first use.
+
+    Callers should fetch the registry per request rather than holding on to
+    it, so that hot reloads are picked up.
+    """
+    key = _registry_key(config_dir)
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.get(key)
+            if registry is None:
+                registry = PromptRegistry.from_directory(key)
+                _registries[key] = registry
+    return registry
+
+
+def reload_prompt_registry(config_dir: Optional[str] = None) -> PromptRegistry:
+    """Recompile config_dir and atomically swap the new registry in."""
+    key = _registry_key(config_dir)
+    with _registries_lock:
+        previous = _registries.get(key)
+        registry = PromptRegistry.from_directory(key, previous)
+        _registries[key] = registry
+    if previous is None or registry.versions() != previous.versions():
+        logger.info(f"Prompt registry reloaded (v{registry.version}): {registry.versions()}")
+    return registry
+
+
+class PromptRegistryWatcher:
+    """Polls a configs directory and hot-reloads the registry on change."""
+
+    def __init__(self, config_dir: Optional[str] = None, interval: float = 2.0):
+        self.config_dir = _registry_key(config_dir)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_snapshot: Dict[str, Tuple[int, int]] = {}
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for entry in os.scandir(self.config_dir):
+            if entry.name.endswith('.json') and entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def check(self) -> bool:
+        """Reload if any config file was added, removed or modified. Returns True on reload."""
+        snapshot = self._snapshot()
+        if snapshot == self._last_snapshot:
+            return False
+        self._last_snapshot = snapshot
+        reload_prompt_registry(self.config_dir)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Prompt hot-reload failed: {e}")
+
+    def start(self) -> None:
+        """Start polling in a daemon thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._last_snapshot = self._snapshot()
+        get_prompt_registry(self.config_dir)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="prompt-registry-watcher", daemon=True)
+        self._thread.start()
+        logger.info(f"Watching {self.config_dir} for prompt changes every {self.interval}s")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+
+# Shared watcher for the default configs directory (started by the app)
+prompt_watcher = PromptRegistryWatcher(
+    interval=float(os.getenv("PROMPT_RELOAD_INTERVAL", "2")))
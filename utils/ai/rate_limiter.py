@@ -0,0 +1,170 @@
+"""Client-side rate limiting for Gemini requests.
+
+Each model gets a requests-per-minute and a tokens-per-minute token bucket.
+Token reservations are made from local estimates and reconciled against the
+usage_metadata of the response. When the API answers with 429 the effective
+refill rate is cut and a cooldown applied, then recovers gradually on success.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional
+from google.api_core import exceptions as google_exceptions
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket that may go into debt; callers wait out the deficit."""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float, rate_scale: float) -> None:
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second * rate_scale)
+        self.updated_at = now
+
+    def reserve(self, amount: float, rate_scale: float = 1.0) -> float:
+        """Take amount tokens and return how many seconds the caller must wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now, rate_scale)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / (self.refill_per_second * rate_scale)
+
+    def adjust(self, amount: float) -> None:
+        """Credit (positive) or debit (negative) tokens after the fact."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _ModelLimits:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.rate_scale = 1.0
+        self.cooldown_until = 0.0
+        self.consecutive_throttles = 0
+        self.throttled = 0
+
+
+class GeminiRateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: float = 15,
+        tokens_per_minute: float = 1_000_000,
+        min_rate_scale: float = 0.1,
+        recovery_step: float = 0.05,
+        max_cooldown: float = 60.0,
+        max_attempts: int = 3
+    ):
+        """Initialize the limiter.
+
+        Args:
+            requests_per_minute: Request budget per model
+            tokens_per_minute: Input token budget per model
+            min_rate_scale: Lowest fraction of the budget used after repeated 429s
+            recovery_step: Fraction of the budget regained per successful request
+            max_cooldown: Upper bound in seconds for the pause after a 429
+            max_attempts: Attempts per request when the API keeps answering 429
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_rate_scale = min_rate_scale
+        self.recovery_step = recovery_step
+        self.max_cooldown = max_cooldown
+        self.max_attempts = max_attempts
+        self._models: Dict[str, _ModelLimits] = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, model_name: str) -> _ModelLimits:
+        with self._lock:
+            limits = self._models.get(model_name)
+            if limits is None:
+                limits = _ModelLimits(self.requests_per_minute, self.tokens_per_minute)
+                self._models[model_name] = limits
+            return limits
+
+    def _reserve(self, model_name: str, estimated_tokens: int) -> float:
+        limits = self._limits(model_name)
+        delay = max(
+            limits.requests.reserve(1, limits.rate_scale),
+            limits.tokens.reserve(estimated_tokens, limits.rate_scale),
+            limits.cooldown_until - time.monotonic()
+        )
+        if delay > 0:
+            metrics.observe("gemini_rate_limit_delay_seconds", delay, model=model_name)
+            logger.info(f"Rate limiting '{model_name}': waiting {delay:.2f}s")
+        return max(0.0, delay)
+
+    async def acquire(self, model_name: str, estimated_tokens: int = 0) -> None:
+        """Reserve budget for one request, sleeping on the event loop if needed."""
+        delay = self._reserve(model_name, estimated_tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def record_usage(self, model_name: str, estimated_tokens: int, response: Any) -> None:
+        """Reconcile the token bucket with the usage reported by the response."""
+        usage = getattr(response, "usage_metadata", None)
+        actual = getattr(usage, "prompt_token_count", None) if usage else None
+        if not actual:
+            return
+        self._limits(model_name).tokens.adjust(estimated_tokens - actual)
+        metrics.increment("gemini_tokens_used", actual, model=model_name)
+
+    def on_success(self, model_name: str) -> None:
+        limits = self._limits(model_name)
+        limits.consecutive_throttles = 0
+        limits.rate_scale = min(1.0, limits.rate_scale + self.recovery_step)
+
+    def on_throttled(self, model_name: str) -> None:
+        """Slow down after the API reported 429 / resource exhausted."""
+        limits = self._limits(model_name)
+        limits.throttled += 1
+        limits.consecutive_throttles += 1
+        limits.rate_scale = max(self.min_rate_scale, limits.rate_scale / 2)
+        cooldown = min(self.max_cooldown, 2 ** limits.consecutive_throttles)
+        limits.cooldown_until = max(limits.cooldown_until, time.monotonic() + cooldown)
+        metrics.increment("gemini_throttled", model=model_name)
+        logger.warning(
+            f"Gemini throttled '{model_name}': rate scaled to {limits.rate_scale:.2f}, "
+            f"cooling down {cooldown:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return current budgets and backoff state per model."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model_name: {
+                    "requests_available": round(limits.requests.tokens, 2),
+                    "tokens_available": round(limits.tokens.tokens),
+                    "rate_scale": limits.rate_scale,
+                    "cooldown_remaining": max(0.0, limits.cooldown_until - now),
+                    "throttled": limits.throttled
+                }
+                for model_name, limits in self._models.items()
+            }
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Return True if error is the API telling us to slow down (HTTP 429)."""
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        return True
+    return getattr(error, "code", None) == 429 or "429" in str(error)
+
+
+# Create singleton instance
+rate_limiter = GeminiRateLimiter(
+    requests_per_minute=float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "15")),
+    tokens_per_minute=float(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000")))
@@ -0,0 +1,200 @@
+"""Content-addressed cache for Gemini analysis results.
+
+Results are keyed on the SHA-256 of the submitted media bytes together with
+the prompt type, injected variables and generation parameters. Lookups hit
+an in-memory LRU first and fall back to a SQLite file shared across restarts.
+"""
+
+import os
+import json
+import time
+import asyncio
+import base64
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def hash_media_data(data: Any) -> str:
+    """Return the SHA-256 hex digest of inline media, decoding base64 strings first."""
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+class GeminiResultCache:
+    def __init__(self, db_path: str, max_memory_entries: int = 256, ttl_seconds: float = 7 * 24 * 3600):
+        """Initialize the cache.
+
+        Args:
+            db_path: SQLite file backing the persistent tier
+            max_memory_entries: Size of the in-memory LRU tier
+            ttl_seconds: Lifetime of a cached result in both tiers
+        """
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Lazy initialization of the SQLite connection."""
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS gemini_results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, expires_at REAL NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(
+        parts: List[Dict[str, Any]],
+        prompt_type: str,
+        variables: Dict[str, Any],
+        generation_params: Dict[str, Any],
+        file_digests: Optional[Dict[str, str]] = None,
+        media_digests: Optional[List[Optional[str]]] = None
+    ) -> str:
+        """Build the content-addressed key for a request.
+
+        Media is keyed on its SHA-256 whether it is sent inline or as a File
+        API reference, so a result survives the upload expiring or being
+        redone under a new URI. file_digests maps known file URIs to their
+        content digests; unknown URIs are keyed as they are. media_digests
+        gives the SHA-256 of each media part in order, when the caller
+        already has it (e.g. from ingest), so inline data is not hashed again.
+        """
+        file_digests = file_digests or {}
+        known = iter(media_digests or [])
+        digest = hashlib.sha256()
+        for part in parts:
+            inline = part.get("inline_data")
+            file_data = part.get("file_data")
+            if inline or file_data:
+                content_hash = next(known, None)
+            if inline:
+                digest.update(f"media:{inline.get('mime_type', '')}:".encode())
+                digest.update((content_hash or hash_media_data(inline.get("data", b""))).encode())
+            elif file_data:
+                uri = file_data.get("file_uri", "")
+                content_hash = content_hash or file_digests.get(uri)
+                if content_hash:
+                    digest.update(f"media:{file_data.get('mime_type', '')}:".encode())
+                    digest.update(content_hash.encode())
+                else:
+                    digest.update(f"file:{uri}".encode())
+            elif "text" in part:
+                digest.update(b"text:")
+                digest.update(part["text"].encode("utf-8"))
+            digest.update(b"\0")
+        digest.update(json.dumps({
+            "prompt_type": prompt_type,
+            "variables": variables,
+            "generation": generation_params
+        }, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _get_memory(self, key: str, now: float) -> Optional[Any]:
+        # Caller holds self._lock
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                metrics.increment("gemini_result_cache_hits", tier="memory")
+                return value
+            del self._memory[key]
+        return None
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return a cached result or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            value = self._get_memory(key, now)
+            if value is not None:
+                return value
+
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM gemini_results WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                metrics.increment("gemini_result_cache_misses")
+                return None
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+        metrics.increment("gemini_result_cache_hits", tier="sqlite")
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a result in both tiers."""
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        try:
+            serialized = json.dumps(value)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Not caching unserializable Gemini result: {e}")
+            return
+        with self._lock:
+            self._remember(key, expires_at, value)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO gemini_results (key, value, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?)", (key, serialized, now, expires_at))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self.conn.execute("DELETE FROM gemini_results WHERE expires_at <= ?", (now,))
+            self.conn.commit()
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        """get for event loops: memory hits inline, SQLite lookups in a thread."""
+        with self._lock:
+            value = self._get_memory(key, time.time())
+        if value is not None:
+            return value
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(self, key: str, value: Any) -> None:
+        """set for event loops; the SQLite write and commit run in a thread."""
+        await asyncio.to_thread(self.set, key, value)
+
+    def _remember(self, key: str, expires_at: float, value: Any) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove every cached result."""
+        with self._lock:
+            self._memory.clear()
+            self.conn.execute("DELETE FROM gemini_results")
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stored = self.conn.execute("SELECT COUNT(*) FROM gemini_results").fetchone()[0]
+            return {
+                "memory_entries": len(self._memory),
+                "max_memory_entries": self.max_memory_entries,
+                "stored_entries": stored,
+                "ttl_seconds": self.ttl_seconds
+            }
+
+
+# Create singleton instance
+result_cache = GeminiResultCache(
+    db_path=os.getenv("GEMINI_RESULT_CACHE_PATH", os.path.join(".cache", "gemini_results.db")),
+    max_memory_entries=int(os.getenv("GEMINI_RESULT_CACHE_SIZE", "256")),
+    ttl_seconds=float(os.getenv("GEMINI_RESULT_CACHE_TTL", str(7 * 24 * 3600))))
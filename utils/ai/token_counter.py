@@ -1,25 +1,27 @@
-"""Token Counter Module for Gemini API"""
+"""Token Counter Module for Gemini API
+
+Importing this module is cheap and silent: the Gemini model is created on
+first API count, counts are reported to the metrics sink, and results are
+plain dicts/ints. Rich tables and DEBUG logging are opt-in for CLI use via
+enable_rich_output().
+"""
 
-import logging
-from typing import Union, List, Dict, Any, Optional
-import google.generativeai as genai
-from PIL import Image
-from pathlib import Path
-import wave
-import io
 import os
-import tempfile
-import subprocess
-import sys
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.table import Table
-from rich.panel import Panel
-from rich.text import Text
-from rich.live import Live
-
-# Configure Rich console and logging
-console = Console(force_terminal=True)
+import base64
+import binascii
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Literal, Tuple
+from utils.audio.decoder import audio_decoder, DecodedAudio, AudioDecodeError
+from utils.audio.probe import AudioProbe
+from utils.audio.duration import read_duration
+from utils.ai.token_estimator import token_estimator
+from utils.metrics import metrics
+
+TokenCountMode = Literal["api", "local"]
+
+logger = logging.getLogger(__name__)
+
 
 # Custom formatter to keep debug messages concise
 class ConciseFormatter(logging.Formatter):
@@ -30,23 +32,6 @@ class ConciseFormatter(logging.Formatter):
         # For other levels, use standard formatting
         return super().format(record)
 
-# Configure logging with custom handler
-handler = RichHandler(
-    console=console,
-    rich_tracebacks=True,
-    show_time=False,
-    show_path=False,  # Don't show file path
-    enable_link_path=False  # Don't show clickable links
-    # add requests and responses to this 
-)
-handler.setFormatter(ConciseFormatter("%(message)s"))
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    handlers=[handler]
-)
-
-logger = logging.getLogger(__name__)
 
 class TokenCounter:
     """Utility class for counting tokens in various content types for Gemini API."""
@@ -55,107 +40,76 @@ class TokenCounter:
     IMAGE_TOKENS = 258
     VIDEO_TOKENS_PER_SECOND = 263
     AUDIO_TOKENS_PER_SECOND = 32
+
+    # Rough ratios for local estimates where an API call is too expensive
+    AUDIO_BYTES_PER_SECOND = 16000
+    VIDEO_BYTES_PER_SECOND = 250000
+    # Role and turn markers added per chat message
+    MESSAGE_OVERHEAD_TOKENS = 3
     
-    def __init__(self, model_name: str = "gemini-1.5-flash"):
-        self.model = genai.GenerativeModel(model_name)
-        self.console = console
-        logger.info(f"TokenCounter initialized with model: {model_name}")
+    def __init__(self, model_name: str = "gemini-1.5-flash", default_mode: TokenCountMode = "api",
+                 rich_output: bool = False):
+        """Initialize the counter.
+
+        Args:
+            model_name: Model whose tokenizer is used for counting
+            default_mode: "api" counts with model.count_tokens, "local" uses the
+                offline estimator; either can be overridden per call
+            rich_output: Render each count as a Rich table (CLI use only)
+        """
+        self.model_name = model_name
+        self.default_mode = default_mode
+        self.rich_output = rich_output
+        self.console = None
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    @property
+    def model(self) -> Any:
+        """The Gemini model, created (and the SDK imported) on first use."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    import google.generativeai as genai
+                    self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    def _is_local(self, mode: Optional[TokenCountMode]) -> bool:
+        return (mode or self.default_mode) == "local"
+
+    def _record(self, kind: str, tokens: int, mode: str) -> None:
+        """Report a count to the metrics sink."""
+        metrics.increment("token_counts", kind=kind, mode=mode)
+        metrics.increment("tokens_counted", tokens, kind=kind, mode=mode)
+
+    def _render(self, title: str, data: Dict[str, Any], border_style: str = "blue") -> None:
+        """Print data as a Rich table when rich_output is enabled."""
+        if not self.rich_output:
+            return
+        from rich.console import Console
+        from rich.panel import Panel
+        if self.console is None:
+            self.console = Console(force_terminal=True)
+        self.console.print(Panel(self._create_token_table(title, data), border_style=border_style))
 
     def _inspect_audio_content(self, audio_content: bytes) -> None:
         """Debug helper to inspect audio content."""
-        try:
-            # Check first few bytes for WAV header
-            if len(audio_content) > 12:
-                header = audio_content[:12]
-                logger.debug(f"Audio header bytes: {header.hex()}")
-                if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
-                    logger.debug("Valid WAV header detected")
-                else:
-                    logger.warning("Invalid or non-WAV header detected")
-            
-            logger.debug(f"Audio content size: {len(audio_content)} bytes")
-        except Exception as e:
-            logger.error(f"Error inspecting audio content: {e}")
-
-    def _normalize_audio_content(self, audio_content: bytes) -> Optional[bytes]:
-        """Normalize audio content to ensure it's valid WAV format."""
-        try:
-            # First try to read as WAV
-            with io.BytesIO(audio_content) as buf:
-                try:
-                    with wave.open(buf, 'rb') as wav:
-                        # If we can open it as WAV, it's already good
-                        return audio_content
-                except wave.Error:
-                    logger.debug("Content is not in WAV format, attempting conversion")
-                    
-            # If not WAV, try converting using ffmpeg
-            with tempfile.NamedTemporaryFile(suffix='.tmp', delete=False) as temp_in:
-                temp_in.write(audio_content)
-                temp_in_path = temp_in.name
-                
-            temp_out_path = temp_in_path + '.wav'
-            
-            try:
-                cmd = [
-                    'ffmpeg',
-                    '-i', temp_in_path,
-                    '-acodec', 'pcm_s16le',  # Convert to 16-bit PCM WAV
-                    '-ar', '44100',  # Standard sample rate
-                    '-ac', '1',  # Mono
-                    '-y',  # Overwrite output
-                    temp_out_path
-                ]
-                
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                
-                if result.returncode == 0:
-                    with open(temp_out_path, 'rb') as f:
-                        normalized_content = f.read()
-                    logger.debug("Successfully normalized audio to WAV format")
-                    return normalized_content
-                else:
-                    logger.error(f"FFmpeg conversion failed: {result.stderr}")
-                    return None
-            finally:
-                # Clean up temp files
-                try:
-                    os.unlink(temp_in_path)
-                    if os.path.exists(temp_out_path):
-                        os.unlink(temp_out_path)
-                except Exception as e:
-                    logger.warning(f"Error cleaning up temp files: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error normalizing audio content: {e}")
-            return None
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug(f"Audio header bytes: {bytes(audio_content[:12]).hex()}")
+        logger.debug(f"Audio content size: {len(audio_content)} bytes")
 
-    def _get_audio_duration_wave(self, audio_content: bytes) -> float:
-        """Get audio duration using wave module."""
-        try:
-            with io.BytesIO(audio_content) as buf:
-                with wave.open(buf, 'rb') as wav:
-                    frames = wav.getnframes()
-                    rate = wav.getframerate()
-                    channels = wav.getnchannels()
-                    sampwidth = wav.getsampwidth()
-                    
-                    duration = frames / float(rate)
-                    
-                    logger.debug("Wave file details:")
-                    logger.debug(f"- Frames: {frames:,}")
-                    logger.debug(f"- Sample Rate: {rate:,} Hz")
-                    logger.debug(f"- Channels: {channels}")
-                    logger.debug(f"- Sample Width: {sampwidth * 8} bits")
-                    logger.debug(f"- Duration: {duration:.3f}s")
-                    
-                    return duration
-        except Exception as e:
-            logger.warning(f"Wave duration detection failed: {str(e)}")
-            return 0
+    def get_audio_duration(self, audio_content: bytes, decoded: Optional[DecodedAudio] = None,
+                           probe: Optional[AudioProbe] = None) -> float:
+        """Get duration of audio content in seconds.
 
-    def get_audio_duration(self, audio_content: bytes) -> float:
-        """Get duration of audio content in seconds."""
+        Prefers an existing AudioProbe or DecodedAudio, then the container
+        headers; only unknown containers go through the shared decoder.
+        """
+        if probe is not None:
+            return probe.duration
+        if decoded is not None:
+            return decoded.duration
         if not audio_content:
             logger.error("No audio content provided")
             return 0
@@ -163,22 +117,25 @@ class TokenCounter:
         # Inspect the audio content
         self._inspect_audio_content(audio_content)
         
-        # Try to normalize the audio content if needed
-        normalized_content = self._normalize_audio_content(audio_content)
-        if normalized_content:
-            audio_content = normalized_content
-        
-        # Get duration using wave
-        duration = self._get_audio_duration_wave(audio_content)
-        if duration > 0:
+        duration = read_duration(audio_content)
+        if duration is not None:
+            logger.debug(f"- Duration: {duration:.3f}s (from headers)")
             return duration
-            
-        logger.error("Failed to detect audio duration")
-        return 0
+
+        try:
+            duration = audio_decoder.decode_sync(audio_content).duration
+        except AudioDecodeError as e:
+            logger.error(f"Failed to detect audio duration: {e}")
+            return 0
+        logger.debug(f"- Duration: {duration:.3f}s")
+        return duration
     
-    def count_audio_content_tokens(self, audio_content: bytes, prompt_text: str = None) -> Dict[str, Any]:
+    def count_audio_content_tokens(self, audio_content: bytes, prompt_text: str = None,
+                                   decoded: Optional[DecodedAudio] = None,
+                                   probe: Optional[AudioProbe] = None,
+                                   mode: Optional[TokenCountMode] = None) -> Dict[str, Any]:
         """Count tokens for audio content including prompt if provided."""
-        if not audio_content:
+        if not audio_content and decoded is None and probe is None:
             logger.error("No audio content provided")
             return {
                 "audio_duration": 0,
@@ -187,9 +144,10 @@ class TokenCounter:
                 "total_tokens": 0
             }
         
-        logger.debug(f"Processing audio content of size: {len(audio_content):,} bytes")
+        if audio_content:
+            logger.debug(f"Processing audio content of size: {len(audio_content):,} bytes")
         
-        duration = self.get_audio_duration(audio_content)
+        duration = self.get_audio_duration(audio_content, decoded, probe)
         if duration == 0:
             logger.warning("Could not determine audio duration, using minimum token count")
             audio_tokens = self.AUDIO_TOKENS_PER_SECOND  # Minimum 1 second
@@ -197,7 +155,7 @@ class TokenCounter:
             # Round up to nearest second to match Gemini's token counting behavior
             audio_tokens = int(self.AUDIO_TOKENS_PER_SECOND * max(1, round(duration)))
             
-        prompt_tokens = self.count_text_tokens(prompt_text) if prompt_text else 0
+        prompt_tokens = self.count_text_tokens(prompt_text, mode) if prompt_text else 0
         total_tokens = audio_tokens + prompt_tokens
         
         # Create compact token analysis
@@ -208,9 +166,8 @@ class TokenCounter:
             "Total Tokens": f"{total_tokens:,}"
         }
         
-        # Create and display token table
-        table = self._create_token_table("Audio Content Analysis", token_data)
-        self.console.print(Panel(table, border_style="blue"))
+        self._render("Audio Content Analysis", token_data)
+        self._record("audio", audio_tokens, "local")
         
         return {
             "audio_duration": duration,
@@ -219,8 +176,9 @@ class TokenCounter:
             "total_tokens": total_tokens
         }
 
-    def _create_token_table(self, title: str, data: Dict[str, Any]) -> Table:
+    def _create_token_table(self, title: str, data: Dict[str, Any]) -> Any:
         """Create a standardized token count table."""
+        from rich.table import Table
         table = Table(title=title, box=None, show_header=True, padding=(0, 1))
         table.add_column("Component", style="cyan")
         table.add_column("Count", justify="right", style="green")
@@ -231,28 +189,144 @@ class TokenCounter:
             )
         return table
     
-    def count_text_tokens(self, text: str) -> int:
-        """Count tokens in text content."""
+    def _count_with_api(self, contents: Any, raw_estimate: int, calibrate: bool = True) -> Optional[int]:
+        """Count with the API and, if calibrate, the local estimator; None on failure."""
+        try:
+            actual = self.model.count_tokens(contents).total_tokens
+        except Exception as e:
+            logger.warning(f"count_tokens failed, using local estimate: {e}")
+            return None
+        if calibrate:
+            token_estimator.observe(self.model_name, raw_estimate, actual)
+        return actual
+
+    def count_text_tokens(self, text: str, mode: Optional[TokenCountMode] = None) -> int:
+        """Count tokens in text content.
+
+        Args:
+            text: Text to count
+            mode: "api" or "local"; defaults to the counter's default_mode
+        """
         if not text:
             return 0
-        return self.model.count_tokens(text).total_tokens
+        raw_estimate = token_estimator.raw_text_tokens(text)
+        if not self._is_local(mode):
+            actual = self._count_with_api(text, raw_estimate)
+            if actual is not None:
+                self._record("text", actual, "api")
+                return actual
+        tokens = token_estimator.correct(self.model_name, raw_estimate)
+        self._record("text", tokens, "local")
+        return tokens
+
+    @staticmethod
+    def _message_text(message: Any) -> str:
+        """Concatenate the text parts of a chat message in any of the SDK's shapes."""
+        parts = message.get("parts", "") if isinstance(message, dict) else message
+        if isinstance(parts, str):
+            return parts
+        texts = []
+        for part in parts if isinstance(parts, list) else [parts]:
+            if isinstance(part, str):
+                texts.append(part)
+            elif isinstance(part, dict) and part.get("text"):
+                texts.append(part["text"])
+        return "\n".join(texts)
+
+    @staticmethod
+    def _is_text_only(message: Any) -> bool:
+        parts = message.get("parts", "") if isinstance(message, dict) else message
+        return all(isinstance(part, str) or (isinstance(part, dict) and set(part) <= {"text"})
+                   for part in (parts if isinstance(parts, list) else [parts]))
+
+    def _raw_chat_tokens(self, history: List[Dict[str, Any]]) -> int:
+        return sum(token_estimator.raw_text_tokens(self._message_text(message))
+                   + self.MESSAGE_OVERHEAD_TOKENS for message in history)
     
-    def count_chat_tokens(self, history: List[Dict[str, str]], next_message: str = None) -> int:
-        """Count tokens in chat history and optionally include next message."""
+    def _estimate_media_tokens(self, mime_type: str, size: int, data: Any = None) -> int:
+        if mime_type.startswith("image/"):
+            return self.IMAGE_TOKENS
+        if mime_type.startswith("video/"):
+            return self.VIDEO_TOKENS_PER_SECOND * max(1, size // self.VIDEO_BYTES_PER_SECOND)
+        # Raw audio bytes usually carry their duration in the container headers
+        duration = read_duration(data) if isinstance(data, (bytes, bytearray, memoryview)) else None
+        if duration is not None:
+            return self.AUDIO_TOKENS_PER_SECOND * max(1, round(duration))
+        return self.AUDIO_TOKENS_PER_SECOND * max(1, size // self.AUDIO_BYTES_PER_SECOND)
+
+    def split_parts_tokens(self, parts: List[Dict[str, Any]],
+                           file_sizes: Optional[Dict[str, int]] = None) -> Tuple[int, int]:
+        """Estimate input tokens for content parts locally, without an API call.
+
+        Text goes through the offline estimator and media duration comes from
+        container headers or, failing that, the encoded size. Returns the text
+        and media estimates separately: pass both to token_estimator.correct()
+        for budgeting and to token_estimator.observe_response() once
+        usage_metadata is known. file_sizes maps File API URIs to their size
+        for file_data parts.
+        """
+        text_tokens = 0
+        media_tokens = 0
+        for part in parts:
+            if "text" in part:
+                text_tokens += token_estimator.raw_text_tokens(part["text"])
+                continue
+            file_data = part.get("file_data")
+            if file_data:
+                size = (file_sizes or {}).get(file_data.get("file_uri"), 0)
+                media_tokens += self._estimate_media_tokens(file_data.get("mime_type", ""), size)
+                continue
+            inline = part.get("inline_data")
+            if not inline:
+                continue
+            data = inline.get("data") or b""
+            if isinstance(data, str):
+                # Decoded so the duration comes from the container headers
+                try:
+                    data = base64.b64decode(data)
+                except (binascii.Error, ValueError):
+                    # Base64 strings are a third larger than the bytes they encode
+                    media_tokens += self._estimate_media_tokens(
+                        inline.get("mime_type", ""), len(data) * 3 // 4)
+                    continue
+            media_tokens += self._estimate_media_tokens(inline.get("mime_type", ""), len(data), data)
+        return text_tokens, media_tokens
+
+    def estimate_parts_tokens(self, parts: List[Dict[str, Any]],
+                              file_sizes: Optional[Dict[str, int]] = None) -> int:
+        """Uncorrected total of split_parts_tokens."""
+        return sum(self.split_parts_tokens(parts, file_sizes))
+
+    def count_chat_tokens(self, history: List[Dict[str, str]], next_message: str = None,
+                          mode: Optional[TokenCountMode] = None) -> int:
+        """Count tokens in chat history and optionally include next message.
+
+        In "api" mode this is a single count_tokens call; the split between
+        history and next message is estimated locally.
+        """
+        contents = history + [{"role": "user", "parts": next_message}] if next_message else history
+        raw_estimate = self._raw_chat_tokens(contents)
+        # The raw estimate leaves out media, so only text-only chats calibrate
+        calibrate = all(self._is_text_only(message) for message in contents)
+        total_tokens = None if self._is_local(mode) else self._count_with_api(
+            contents, raw_estimate, calibrate)
+        if total_tokens is None:
+            total_tokens = token_estimator.correct(self.model_name, raw_estimate)
+            self._record("chat", total_tokens, "local")
+        else:
+            self._record("chat", total_tokens, "api")
+
         if next_message:
-            total_tokens = self.model.count_tokens(history + [{"role": "user", "parts": next_message}]).total_tokens
-            next_msg_tokens = self.model.count_tokens(next_message).total_tokens
+            next_msg_tokens = min(total_tokens, token_estimator.text_tokens(next_message, self.model_name))
             data = {
                 "Chat History": total_tokens - next_msg_tokens,
                 "Next Message": next_msg_tokens,
                 "Total": total_tokens
             }
         else:
-            total_tokens = self.model.count_tokens(history).total_tokens
             data = {"Chat History": total_tokens}
             
-        table = self._create_token_table("Chat Token Analysis", data)
-        self.console.print(Panel(table, border_style="blue"))
+        self._render("Chat Token Analysis", data)
         return total_tokens
     
     def get_response_token_usage(self, response) -> Dict[str, int]:
@@ -265,10 +339,8 @@ class TokenCounter:
                 "Total Tokens": metadata.total_token_count
             }
             
-            logger.info(f"Response Token Usage - Total: {usage['Total Tokens']}")
-            
-            table = self._create_token_table("Response Token Usage", usage)
-            self.console.print(Panel(table, border_style="green"))
+            logger.debug(f"Response Token Usage - Total: {usage['Total Tokens']}")
+            self._render("Response Token Usage", usage, border_style="green")
             
             return {
                 "prompt_tokens": usage["Prompt Tokens"],
@@ -279,5 +351,32 @@ class TokenCounter:
             logger.warning(f"Could not get token usage: {e}")
             return {"error": str(e)}
 
+def enable_rich_output(level: int = logging.DEBUG) -> None:
+    """Render counts as Rich tables and log this module through Rich (CLI use).
+
+    Only this module's logger is configured; the root logger is left alone.
+    """
+    from rich.console import Console
+    from rich.logging import RichHandler
+
+    console = Console(force_terminal=True)
+    handler = RichHandler(
+        console=console,
+        rich_tracebacks=True,
+        show_time=False,
+        show_path=False,  # Don't show file path
+        enable_link_path=False  # Don't show clickable links
+    )
+    handler.setFormatter(ConciseFormatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    token_counter.console = console
+    token_counter.rich_output = True
+
+
 # Create a singleton instance
-token_counter = TokenCounter()
+token_counter = TokenCounter(
+    default_mode=os.getenv("TOKEN_COUNT_MODE", "api"),
+    rich_output=os.getenv("TOKEN_COUNTER_RICH_OUTPUT", "false").lower() == "true")
@@ -0,0 +1,139 @@
+"""Local token estimation for Gemini prompts.
+
+Approximates the SentencePiece tokenizer without a network call: letter runs
+are split into word pieces, digits and punctuation count one token each, and
+CJK characters one token per character. Each model gets a correction factor
+learned from the usage_metadata of past responses (prompt_token_count vs. the
+raw local estimate), so budgeting converges on what the API actually bills.
+
+The factor describes text only. Media is billed at fixed per-second or
+per-image rates that the counter already applies, so media estimates are
+added uncorrected, and requests carrying media calibrate on the text share
+of the bill: prompt_token_count minus the media estimate. Dividing the whole
+bill by the text estimate would let a long recording pull the factor
+towards its bounds.
+"""
+
+import os
+import re
+import math
+import logging
+import threading
+from typing import Dict, Any, Optional
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d|\S")
+_CJK_PATTERN = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+class TokenEstimator:
+    # Average characters per word piece for Latin and other alphabetic scripts
+    ASCII_CHARS_PER_TOKEN = 6
+    OTHER_CHARS_PER_TOKEN = 3
+
+    def __init__(
+        self,
+        learning_rate: float = 0.1,
+        min_factor: float = 0.25,
+        max_factor: float = 4.0
+    ):
+        """Initialize the estimator.
+
+        Args:
+            learning_rate: Weight of each new observation in the correction factor
+            min_factor: Lower bound for a model's correction factor
+            max_factor: Upper bound for a model's correction factor
+        """
+        self.learning_rate = learning_rate
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self._factors: Dict[str, float] = {}
+        self._observations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def raw_text_tokens(self, text: str) -> int:
+        """Estimate tokens in text before any per-model correction."""
+        if not text:
+            return 0
+        tokens = 0
+        for match in _TOKEN_PATTERN.finditer(text):
+            piece = match.group()
+            if len(piece) == 1 or not piece[0].isalpha():
+                tokens += 1
+            elif piece.isascii():
+                tokens += math.ceil(len(piece) / self.ASCII_CHARS_PER_TOKEN)
+            else:
+                cjk = len(_CJK_PATTERN.findall(piece))
+                tokens += cjk + math.ceil((len(piece) - cjk) / self.OTHER_CHARS_PER_TOKEN)
+        return tokens
+
+    def factor(self, model_name: Optional[str]) -> float:
+        """Current correction factor for model_name (1.0 until calibrated)."""
+        if not model_name:
+            return 1.0
+        with self._lock:
+            return self._factors.get(model_name, 1.0)
+
+    def correct(self, model_name: Optional[str], raw_tokens: int, media_tokens: int = 0) -> int:
+        """Apply model_name's correction factor to a raw text estimate.
+
+        Args:
+            model_name: Model whose factor is applied
+            raw_tokens: Uncorrected estimate of the text
+            media_tokens: Estimate of the media in the same request, added as is
+        """
+        if not raw_tokens:
+            return media_tokens
+        return max(1, round(raw_tokens * self.factor(model_name))) + media_tokens
+
+    def text_tokens(self, text: str, model_name: Optional[str] = None) -> int:
+        """Estimate tokens in text, corrected for model_name when known."""
+        return self.correct(model_name, self.raw_text_tokens(text))
+
+    def observe(self, model_name: str, raw_tokens: int, actual_tokens: int) -> None:
+        """Move model_name's correction factor towards actual / raw."""
+        if not model_name or raw_tokens <= 0 or actual_tokens <= 0:
+            return
+        ratio = min(self.max_factor, max(self.min_factor, actual_tokens / raw_tokens))
+        with self._lock:
+            current = self._factors.get(model_name)
+            updated = ratio if current is None else current + self.learning_rate * (ratio - current)
+            self._factors[model_name] = updated
+            self._observations[model_name] = self._observations.get(model_name, 0) + 1
+        metrics.gauge("token_estimator_factor", updated, model=model_name)
+        metrics.observe("token_estimate_error_ratio", abs(actual_tokens / raw_tokens - 1),
+                        model=model_name)
+
+    def observe_response(self, model_name: str, raw_tokens: int, response: Any,
+                         media_tokens: int = 0) -> None:
+        """Calibrate from the prompt_token_count in a response's usage_metadata.
+
+        Args:
+            model_name: Model that answered
+            raw_tokens: Uncorrected estimate of the request's text
+            response: Response carrying usage_metadata
+            media_tokens: Estimate of the request's media, taken off the
+                billed count so only the text share calibrates
+        """
+        usage = getattr(response, "usage_metadata", None)
+        actual = getattr(usage, "prompt_token_count", None) if usage else None
+        if actual:
+            # Nothing is learnt if the media estimate accounts for the whole bill
+            self.observe(model_name, raw_tokens, actual - media_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                model_name: {
+                    "factor": round(factor, 4),
+                    "observations": self._observations.get(model_name, 0)
+                }
+                for model_name, factor in self._factors.items()
+            }
+
+
+# Create singleton instance
+token_estimator = TokenEstimator(
+    learning_rate=float(os.getenv("TOKEN_ESTIMATOR_LEARNING_RATE", "0.1")))
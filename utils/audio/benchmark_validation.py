@@ -0,0 +1,119 @@
+# backend/utils/audio/benchmark_validation.py
+"""
+Benchmark AudioValidator analysis on the clips in audio-samples/.
+
+Each clip is decoded to 16 kHz mono PCM by the shared decoder, then the
+energy and VAD frame analysis are timed against the previous per-frame
+Python loops kept below as reference implementations. Reports frames/sec
+for both.
+
+Usage:
+    python -m utils.audio.benchmark_validation [audio_dir] [--repeat N]
+"""
+
+import sys
+import time
+import array
+import argparse
+from pathlib import Path
+from typing import Callable, List, Tuple
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from services.audio_validation import AudioValidator
+from services.validation_reporters import NullReporter
+from utils.audio.decoder import audio_decoder
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+DEFAULT_AUDIO_DIR = Path(__file__).resolve().parents[2] / "audio-samples"
+
+
+def decode_to_pcm(path: Path) -> bytes:
+    """Decode a clip to 16-bit 16 kHz mono PCM with the shared decoder."""
+    return audio_decoder.decode_sync(path).pcm
+
+
+def legacy_energies(audio_array: array.array) -> np.ndarray:
+    """Reference: RMS computed with a Python loop over 30ms slices."""
+    samples = np.array(audio_array, dtype=np.float32) / 32768.0
+    frame_length = int(SAMPLE_RATE * FRAME_MS / 1000)
+    energies = []
+    for i in range(0, len(samples), frame_length):
+        frame = samples[i:i + frame_length]
+        if len(frame) == frame_length:
+            energies.append(float(np.sqrt(np.mean(frame ** 2))))
+    return np.array(energies)
+
+
+def legacy_frames(validator: AudioValidator, audio: bytes) -> Tuple[int, int]:
+    """Reference: per-frame VAD with a list-based sliding window."""
+    window, window_size = [], 8
+    speech_frames = total_frames = 0
+    for frame, _ in validator._frame_generator(audio, SAMPLE_RATE):
+        window.append(validator.vad.is_speech(frame, SAMPLE_RATE))
+        if len(window) > window_size:
+            window.pop(0)
+        if len(window) == window_size:
+            total_frames += 1
+            if sum(window) >= int(window_size * 0.7):
+                speech_frames += 1
+    return speech_frames, total_frames
+
+
+def _best_of(fn: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(audio_dir: Path, repeat: int) -> List[dict]:
+    validator = AudioValidator(reporter=NullReporter())
+    rows = []
+    for path in sorted(audio_dir.iterdir()):
+        if path.suffix.lower() not in {'.ogg', '.wav', '.mp3', '.m4a', '.flac', '.aac'}:
+            continue
+        pcm = decode_to_pcm(path)
+        samples = array.array('h')
+        samples.frombytes(pcm)
+        frames = len(pcm) // (SAMPLE_RATE * FRAME_MS // 1000 * 2)
+        if not frames:
+            continue
+
+        rows.append({
+            "file": path.name,
+            "frames": frames,
+            "energy_before": frames / _best_of(lambda: legacy_energies(samples), repeat),
+            "energy_after": frames / _best_of(lambda: validator._analyze_audio_energy(samples), repeat),
+            "vad_before": frames / _best_of(lambda: legacy_frames(validator, pcm), repeat),
+            "vad_after": frames / _best_of(
+                lambda: validator._process_audio_frames(
+                    validator._frame_generator(pcm, SAMPLE_RATE), SAMPLE_RATE), repeat),
+        })
+    return rows
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("audio_dir", nargs="?", type=Path, default=DEFAULT_AUDIO_DIR)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rows = run(args.audio_dir, args.repeat)
+    table = Table(title="AudioValidator throughput (frames/sec, best of %d)" % args.repeat)
+    for column in ("File", "Frames", "Energy before", "Energy after", "VAD before", "VAD after"):
+        table.add_column(column, justify="left" if column == "File" else "right")
+    for row in rows:
+        table.add_row(
+            row["file"], f"{row['frames']:,}",
+            f"{row['energy_before']:,.0f}", f"{row['energy_after']:,.0f}",
+            f"{row['vad_before']:,.0f}", f"{row['vad_after']:,.0f}")
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,290 @@
+# backend/utils/audio/decoder.py
+"""
+Shared audio decoding stage.
+
+Every upload is decoded once to 16 kHz mono 16-bit PCM, the format the VAD,
+energy analysis, token counting and duration probing all work from. WAV input
+is decoded in-process (resampled with scipy when needed); everything else is
+piped through ffmpeg's stdin/stdout, so no intermediate files are written.
+Decoded audio is memoized by content hash, so later stages handling the same
+upload reuse the PCM instead of decoding again.
+"""
+
+import io
+import os
+import re
+import wave
+import asyncio
+import hashlib
+import logging
+import subprocess
+import threading
+from math import gcd
+from pathlib import Path
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Union
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AudioSource = Union[bytes, bytearray, memoryview, str, Path]
+
+TARGET_SAMPLE_RATE = 16000
+# EBU R128 loudness normalisation the validation thresholds were tuned against
+LOUDNORM_FILTER = 'loudnorm=I=-16:LRA=11:TP=-1.5'
+
+
+class AudioDecodeError(Exception):
+    """Raised when audio cannot be decoded"""
+    pass
+
+
+@dataclass(frozen=True)
+class DecodedAudio:
+    """16-bit mono PCM at TARGET_SAMPLE_RATE."""
+    pcm: bytes
+    sample_rate: int = TARGET_SAMPLE_RATE
+    normalized: bool = False
+    # Properties of the original stream, as reported while decoding
+    source_codec: Optional[str] = None
+    source_sample_rate: Optional[int] = None
+    source_channels: Optional[int] = None
+
+    @property
+    def frames(self) -> int:
+        return len(self.pcm) // 2
+
+    @property
+    def duration(self) -> float:
+        return self.frames / float(self.sample_rate)
+
+    def samples(self) -> np.ndarray:
+        """Zero-copy int16 view of the PCM."""
+        return np.frombuffer(self.pcm, dtype=np.int16)
+
+    def to_wav_bytes(self) -> bytes:
+        """Wrap the PCM in a WAV container."""
+        buf = io.BytesIO()
+        with wave.open(buf, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(self.pcm)
+        return buf.getvalue()
+
+
+def _is_wav(header: bytes) -> bool:
+    return header[:4] == b'RIFF' and header[8:12] == b'WAVE'
+
+
+def _decode_wav(data: AudioSource) -> Optional[DecodedAudio]:
+    """Decode PCM WAV in-process, downmixing and resampling as needed.
+
+    Returns None for WAV variants the wave module cannot read (e.g. float
+    or compressed), which then fall back to ffmpeg.
+    """
+    path_or_data = str(data) if isinstance(data, Path) else data
+    try:
+        with wave.open(path_or_data if isinstance(path_or_data, str) else io.BytesIO(path_or_data), 'rb') as wf:
+            channels, width, rate = wf.getnchannels(), wf.getsampwidth(), wf.getframerate()
+            raw = wf.readframes(wf.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width != 2:
+        return None
+
+    source = dict(source_codec='pcm_s16le', source_sample_rate=rate, source_channels=channels)
+    if channels == 1 and rate == TARGET_SAMPLE_RATE:
+        return DecodedAudio(pcm=raw, **source)
+
+    samples = np.frombuffer(raw, dtype=np.int16).reshape(-1, channels).astype(np.float32)
+    mono = samples.mean(axis=1)
+    if rate != TARGET_SAMPLE_RATE:
+        # scipy.signal is slow to import and only needed for non-16k WAVs
+        from scipy import signal
+        divisor = gcd(rate, TARGET_SAMPLE_RATE)
+        mono = signal.resample_poly(mono, TARGET_SAMPLE_RATE // divisor, rate // divisor)
+    pcm = np.clip(np.round(mono), -32768, 32767).astype(np.int16).tobytes()
+    return DecodedAudio(pcm=pcm, **source)
+
+
+def content_digest(source: AudioSource) -> str:
+    """SHA-256 hex digest of encoded audio bytes or of a file's content."""
+    digest = hashlib.sha256()
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+
+def _ffmpeg_command(input_arg: str, normalize: bool) -> List[str]:
+    cmd = ['ffmpeg', '-hide_banner', '-i', input_arg]
+    if normalize:
+        cmd += ['-af', LOUDNORM_FILTER]
+    cmd += ['-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1',
+            '-ar', str(TARGET_SAMPLE_RATE), '-loglevel', 'info', '-nostats', 'pipe:1']
+    return cmd
+
+
+# e.g. "Stream #0:0: Audio: opus, 48000 Hz, mono, fltp"
+_STREAM_PATTERN = re.compile(
+    r"Stream #0:\d+.*?: Audio: (\w+).*?, (\d+) Hz, ([^,\n]+)")
+_CHANNEL_LAYOUTS = {"mono": 1, "stereo": 2, "2.1": 3, "quad": 4, "5.0": 5, "5.1": 6, "7.1": 8}
+
+
+def _parse_stream_info(stderr: str) -> Dict[str, Any]:
+    """Read codec, sample rate and channel count of the input from ffmpeg's log."""
+    match = _STREAM_PATTERN.search(stderr.split("Output #0", 1)[0])
+    if not match:
+        return {}
+    layout = match.group(3).strip()
+    channels = _CHANNEL_LAYOUTS.get(layout)
+    if channels is None:
+        count = re.match(r"(\d+) channels", layout)
+        channels = int(count.group(1)) if count else None
+    return {
+        "source_codec": match.group(1),
+        "source_sample_rate": int(match.group(2)),
+        "source_channels": channels
+    }
+
+
+class AudioDecoder:
+    def __init__(self, cache_bytes: int = 64 * 1024 * 1024):
+        """Initialize the decoder.
+
+        Args:
+            cache_bytes: Total PCM kept in the content-hash memo (0 disables it)
+        """
+        self.cache_bytes = cache_bytes
+        self._cache: "OrderedDict[str, DecodedAudio]" = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read_header(source: AudioSource) -> bytes:
+        if isinstance(source, (str, Path)):
+            with open(source, 'rb') as f:
+                return f.read(12)
+        return bytes(source[:12])
+
+    def _cache_key(self, source: AudioSource, digest: Optional[str], normalize: bool) -> str:
+        return f"{digest or content_digest(source)}:{int(normalize)}"
+
+    def _get_cached(self, key: str) -> Optional[DecodedAudio]:
+        with self._lock:
+            decoded = self._cache.get(key)
+            if decoded is not None:
+                self._cache.move_to_end(key)
+            return decoded
+
+    def _remember(self, key: str, decoded: DecodedAudio) -> None:
+        if len(decoded.pcm) > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = decoded
+            self._cached_bytes += len(decoded.pcm)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted.pcm)
+
+    def _prepare(self, source: AudioSource, normalize: bool):
+        """Return (decoded, ffmpeg_cmd, stdin_bytes); decoded is set for in-process WAV."""
+        if _is_wav(self._read_header(source)):
+            decoded = _decode_wav(source)
+            if decoded is not None:
+                return decoded, None, None
+        if isinstance(source, (str, Path)):
+            return None, _ffmpeg_command(str(source), normalize), None
+        return None, _ffmpeg_command('pipe:0', normalize), bytes(source)
+
+    async def decode(
+        self,
+        source: AudioSource,
+        digest: Optional[str] = None,
+        normalize: bool = True
+    ) -> DecodedAudio:
+        """Decode audio to 16 kHz mono PCM without blocking the event loop.
+
+        Args:
+            source: Encoded audio bytes or a path to the file
+            digest: SHA-256 of the content if already known (skips rehashing)
+            normalize: Apply loudness normalisation to non-WAV input
+
+        Returns:
+            DecodedAudio, shared with any earlier decode of the same content
+        """
+        key = None
+        if self.cache_bytes:
+            key = (self._cache_key(source, digest, normalize) if digest
+                   else await asyncio.to_thread(self._cache_key, source, digest, normalize))
+            if (cached := self._get_cached(key)) is not None:
+                return cached
+
+        # WAV decoding and resampling happen in-process, so keep them off the loop
+        decoded, cmd, stdin_bytes = await asyncio.to_thread(self._prepare, source, normalize)
+        if decoded is None:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE if stdin_bytes is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            pcm, stderr = await process.communicate(stdin_bytes)
+            decoded = self._finish(process.returncode, pcm, stderr, normalize)
+
+        if key:
+            self._remember(key, decoded)
+        return decoded
+
+    def decode_sync(
+        self,
+        source: AudioSource,
+        digest: Optional[str] = None,
+        normalize: bool = True
+    ) -> DecodedAudio:
+        """Blocking counterpart of decode() for synchronous callers."""
+        key = self._cache_key(source, digest, normalize) if self.cache_bytes else None
+        if key and (cached := self._get_cached(key)) is not None:
+            return cached
+
+        decoded, cmd, stdin_bytes = self._prepare(source, normalize)
+        if decoded is None:
+            if stdin_bytes is None:
+                result = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True)
+            else:
+                result = subprocess.run(cmd, input=stdin_bytes, capture_output=True)
+            decoded = self._finish(result.returncode, result.stdout, result.stderr, normalize)
+
+        if key:
+            self._remember(key, decoded)
+        return decoded
+
+    @staticmethod
+    def _finish(returncode: int, pcm: bytes, stderr: bytes, normalize: bool) -> DecodedAudio:
+        log = stderr.decode(errors='replace')
+        if returncode != 0:
+            tail = "\n".join(log.strip().splitlines()[-3:])
+            raise AudioDecodeError(f"FFmpeg decoding failed: {tail}")
+        if not pcm:
+            raise AudioDecodeError("Decoded audio is empty")
+        return DecodedAudio(pcm=pcm, normalized=normalize, **_parse_stream_info(log))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cached_entries": len(self._cache),
+                "cached_bytes": self._cached_bytes,
+                "cache_bytes": self.cache_bytes
+            }
+
+
+# Create singleton instance
+audio_decoder = AudioDecoder(
+    cache_bytes=int(os.getenv("AUDIO_DECODE_CACHE_BYTES", str(64 * 1024 * 1024))))
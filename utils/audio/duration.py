@@ -0,0 +1,319 @@
+# backend/utils/audio/duration.py
+"""
+Header-only duration estimation for common audio containers.
+
+Reads at most a few kilobytes from the start and end of the content (WebM
+without a Duration element walks block headers through an mmap), never
+decodes audio, and returns None for containers it does not recognise so
+callers can fall back to the decoder.
+
+Supported:
+    - WAV: data chunk size / byte rate
+    - OGG (Opus, Vorbis): granule position of the last page
+    - FLAC: total samples in STREAMINFO
+    - WebM/Matroska: Info Duration, else the last block timecode
+    - MP3: Xing/Info or VBRI frame count, else CBR size / bitrate
+"""
+
+import os
+import mmap
+import struct
+import logging
+from pathlib import Path
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+DurationSource = Union[bytes, bytearray, memoryview, str, Path]
+
+HEAD_BYTES = 64 * 1024
+TAIL_BYTES = 64 * 1024
+OPUS_SAMPLE_RATE = 48000
+
+
+class _Content:
+    """Head, tail and total size of the content."""
+
+    def __init__(self, source: DurationSource):
+        if isinstance(source, (str, Path)):
+            self.size = os.path.getsize(source)
+            with open(source, 'rb') as f:
+                self.head = f.read(HEAD_BYTES)
+                if self.size > HEAD_BYTES:
+                    f.seek(max(0, self.size - TAIL_BYTES))
+                    self.tail = f.read()
+                else:
+                    self.tail = self.head
+            self._path = source
+        else:
+            view = memoryview(source)
+            self.size = len(view)
+            self.head = bytes(view[:HEAD_BYTES])
+            self.tail = bytes(view[-TAIL_BYTES:]) if self.size > HEAD_BYTES else self.head
+            self._path = None
+        self._source = source
+
+    def map(self):
+        """Random access to the whole content without reading it (mmap for files)."""
+        if self._path is None:
+            source = self._source
+            return source if isinstance(source, bytes) else bytes(source)
+        with open(self._path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _wav_duration(content: _Content) -> Optional[float]:
+    head = content.head
+    offset = 12
+    byte_rate = None
+    while offset + 8 <= len(head):
+        chunk_id = head[offset:offset + 4]
+        chunk_size = struct.unpack_from('<I', head, offset + 4)[0]
+        if chunk_id == b'fmt ' and offset + 16 <= len(head):
+            byte_rate = struct.unpack_from('<I', head, offset + 16)[0]
+        elif chunk_id == b'data':
+            if not byte_rate:
+                return None
+            # Streamed WAVs may leave the size unset; use what is actually there
+            available = content.size - (offset + 8)
+            if chunk_size in (0, 0xFFFFFFFF) or chunk_size > available:
+                chunk_size = available
+            return chunk_size / byte_rate
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def _ogg_first_packet(head: bytes) -> bytes:
+    segments = head[26]
+    start = 27 + segments
+    length = sum(head[27:27 + segments])
+    return head[start:start + length]
+
+
+def _ogg_duration(content: _Content) -> Optional[float]:
+    packet = _ogg_first_packet(content.head)
+    if packet.startswith(b'OpusHead'):
+        sample_rate = OPUS_SAMPLE_RATE
+        pre_skip = struct.unpack_from('<H', packet, 10)[0]
+    elif packet.startswith(b'\x01vorbis'):
+        sample_rate = struct.unpack_from('<I', packet, 12)[0]
+        pre_skip = 0
+    else:
+        return None
+
+    last_page = content.tail.rfind(b'OggS')
+    # Skip false matches inside packet data: a page header has version 0
+    while last_page != -1 and (last_page + 14 > len(content.tail) or content.tail[last_page + 4] != 0):
+        last_page = content.tail.rfind(b'OggS', 0, last_page)
+    if last_page == -1:
+        return None
+    granule = struct.unpack_from('<q', content.tail, last_page + 6)[0]
+    if granule <= 0 or not sample_rate:
+        return None
+    return max(0, granule - pre_skip) / sample_rate
+
+
+def _flac_duration(content: _Content) -> Optional[float]:
+    head = content.head
+    # STREAMINFO is always the first metadata block
+    if len(head) < 8 + 18 or head[4] & 0x7F != 0:
+        return None
+    info = head[8:8 + 18]
+    packed = int.from_bytes(info[10:18], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+    return total_samples / sample_rate
+
+
+_EBML_SEGMENT = 0x18538067
+_EBML_INFO = 0x1549A966
+_EBML_CLUSTER = b'\x1f\x43\xb6\x75'
+_EBML_TIMECODE_SCALE = 0x2AD7B1
+_EBML_DURATION = 0x4489
+_EBML_CLUSTER_TIMECODE = 0xE7
+_EBML_SIMPLE_BLOCK = 0xA3
+_EBML_BLOCK_GROUP = 0xA0
+_EBML_BLOCK = 0xA1
+_EBML_UNKNOWN_SIZE = -1
+
+
+def _ebml_vint(data: bytes, offset: int, keep_marker: bool) -> tuple:
+    """Read an EBML variable-length integer; returns (value, next_offset)."""
+    first = data[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML varint")
+    value = first if keep_marker else first & (0xFF >> length)
+    for i in range(1, length):
+        value = (value << 8) | data[offset + i]
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = _EBML_UNKNOWN_SIZE
+    return value, offset + length
+
+
+def _ebml_elements(data: bytes, offset: int, end: int):
+    """Yield (element_id, data_offset, size) for elements between offset and end."""
+    while offset < end and offset < len(data):
+        element_id, offset = _ebml_vint(data, offset, keep_marker=True)
+        size, offset = _ebml_vint(data, offset, keep_marker=False)
+        yield element_id, offset, size
+        if size == _EBML_UNKNOWN_SIZE:
+            return
+        offset += size
+
+
+def _webm_duration(content: _Content) -> Optional[float]:
+    head = content.head
+    scale = 1_000_000  # TimecodeScale default: 1ms in ns
+    for element_id, offset, size in _ebml_elements(head, 0, len(head)):
+        if element_id != _EBML_SEGMENT:
+            continue
+        segment_end = len(head) if size == _EBML_UNKNOWN_SIZE else offset + size
+        for child_id, child_offset, child_size in _ebml_elements(head, offset, segment_end):
+            if child_id != _EBML_INFO:
+                continue
+            duration = None
+            for info_id, info_offset, info_size in _ebml_elements(
+                    head, child_offset, child_offset + child_size):
+                value = head[info_offset:info_offset + info_size]
+                if info_id == _EBML_TIMECODE_SCALE:
+                    scale = int.from_bytes(value, 'big')
+                elif info_id == _EBML_DURATION:
+                    duration = struct.unpack('>f' if info_size == 4 else '>d', value)[0]
+            if duration:
+                return duration * scale / 1e9
+            break
+        break
+
+    # Live recordings (e.g. MediaRecorder) omit Duration and often write one
+    # unknown-size cluster: walk the last cluster's element headers instead
+    data = content.map()
+    try:
+        cluster = data.rfind(_EBML_CLUSTER)
+        if cluster == -1:
+            return None
+        _, offset = _ebml_vint(data, cluster, keep_marker=True)
+        size, offset = _ebml_vint(data, offset, keep_marker=False)
+        end = content.size if size == _EBML_UNKNOWN_SIZE else min(content.size, offset + size)
+        cluster_timecode = None
+        last_block = 0
+        for element_id, data_offset, data_size in _ebml_elements(data, offset, end):
+            if element_id == _EBML_CLUSTER_TIMECODE:
+                cluster_timecode = int.from_bytes(data[data_offset:data_offset + data_size], 'big')
+            elif element_id in (_EBML_SIMPLE_BLOCK, _EBML_BLOCK_GROUP):
+                block = data_offset
+                if element_id == _EBML_BLOCK_GROUP:
+                    if data[block] != _EBML_BLOCK:
+                        continue
+                    _, block = _ebml_vint(data, block, keep_marker=True)
+                    _, block = _ebml_vint(data, block, keep_marker=False)
+                _, block = _ebml_vint(data, block, keep_marker=False)  # track number
+                if block + 2 <= content.size:
+                    last_block = max(last_block, struct.unpack_from('>h', data, block)[0])
+        if cluster_timecode is None:
+            return None
+        return (cluster_timecode + last_block) * scale / 1e9
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+# Kbps by [version is MPEG1][layer][index]; layer 1 = Layer III
+_MP3_BITRATES = {
+    (True, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (False, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _id3v2_size(head: bytes) -> int:
+    if head[:3] != b'ID3' or len(head) < 10:
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _mp3_duration(content: _Content) -> Optional[float]:
+    head = content.head
+    offset = _id3v2_size(head)
+    if offset >= len(head):
+        return None
+
+    # Find the first valid frame header
+    while offset + 4 <= len(head):
+        if head[offset] == 0xFF and head[offset + 1] & 0xE0 == 0xE0:
+            version_bits = (head[offset + 1] >> 3) & 0x03
+            layer_bits = (head[offset + 1] >> 1) & 0x03
+            bitrate_index = head[offset + 2] >> 4
+            rate_index = (head[offset + 2] >> 2) & 0x03
+            if version_bits != 1 and layer_bits and 0 < bitrate_index < 15 and rate_index < 3:
+                break
+        offset += 1
+    else:
+        return None
+
+    mpeg1 = version_bits == 3
+    sample_rate = _MP3_SAMPLE_RATES[version_bits][rate_index]
+    if layer_bits == 3:      # Layer I
+        samples_per_frame = 384
+    elif layer_bits == 2 or mpeg1:  # Layer II, or Layer III in MPEG1
+        samples_per_frame = 1152
+    else:                    # Layer III in MPEG2/2.5
+        samples_per_frame = 576
+
+    # VBR headers sit after the side info of the first frame
+    mono = (head[offset + 3] >> 6) == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = offset + 4 + side_info
+    if head[xing:xing + 4] in (b'Xing', b'Info') and head[xing + 7] & 0x01:
+        frames = struct.unpack_from('>I', head, xing + 8)[0]
+        return frames * samples_per_frame / sample_rate
+    vbri = offset + 4 + 32
+    if head[vbri:vbri + 4] == b'VBRI':
+        frames = struct.unpack_from('>I', head, vbri + 14)[0]
+        return frames * samples_per_frame / sample_rate
+
+    bitrate = _MP3_BITRATES[(mpeg1, layer_bits)][bitrate_index] * 1000
+    audio_bytes = content.size - offset
+    if content.tail[-128:-125] == b'TAG':
+        audio_bytes -= 128
+    return audio_bytes * 8 / bitrate
+
+
+def read_duration(source: DurationSource) -> Optional[float]:
+    """Return the duration in seconds from container headers, or None if unknown.
+
+    Args:
+        source: Encoded audio bytes, a memoryview, or a path to the file
+
+    Returns:
+        Duration in seconds, or None when the container is not recognised
+        or its headers do not carry enough information
+    """
+    try:
+        content = _Content(source)
+        head = content.head
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return _wav_duration(content)
+        if head[:4] == b'OggS':
+            return _ogg_duration(content)
+        if head[:4] == b'fLaC':
+            return _flac_duration(content)
+        if head[:4] == b'\x1aE\xdf\xa3':
+            return _webm_duration(content)
+        # 0xFFF1/0xFFF9 is ADTS (AAC), which has no duration header
+        if head[:3] == b'ID3' or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+                                  and head[1] & 0xF6 != 0xF0):
+            return _mp3_duration(content)
+    except (struct.error, IndexError, ValueError, OSError) as e:
+        logger.debug(f"Header duration parse failed: {e}")
+    return None
@@ -0,0 +1,114 @@
+# backend/utils/audio/probe.py
+"""
+AudioProbe: everything downstream stages need to know about one upload.
+
+A probe is built once from the decoded PCM (plus the validator's VAD output
+when validation runs) and is small enough to memoize by content hash, so
+duration limits, token counting and validation results never trigger a
+second decode.
+"""
+
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Any, Optional
+import numpy as np
+from utils.audio.decoder import DecodedAudio
+
+RMS_FRAME_SECONDS = 0.03
+
+
+def summarize_rms(decoded: DecodedAudio) -> Dict[str, float]:
+    """Mean, peak and spread of per-frame RMS over 30ms frames, normalized to [0, 1]."""
+    frame_length = int(decoded.sample_rate * RMS_FRAME_SECONDS)
+    samples = decoded.samples()
+    n_frames = len(samples) // frame_length
+    if not n_frames:
+        return {"mean": 0.0, "peak": 0.0, "std": 0.0}
+    frames = samples[:n_frames * frame_length].reshape(n_frames, frame_length).astype(np.float32) / 32768.0
+    energies = np.sqrt(np.einsum('ij,ij->i', frames, frames) / frame_length)
+    return {
+        "mean": float(energies.mean()),
+        "peak": float(energies.max()),
+        "std": float(energies.std())
+    }
+
+
+@dataclass(frozen=True)
+class AudioProbe:
+    content_hash: str
+    duration: float
+    sample_rate: Optional[int]
+    channels: Optional[int]
+    codec: Optional[str]
+    mime_type: Optional[str] = None
+    size_bytes: Optional[int] = None
+    rms: Dict[str, float] = field(default_factory=dict)
+    # Populated once validation has run
+    speech_segments: Optional[List[Dict[str, float]]] = None
+    speech_ratio: Optional[float] = None
+    validation: Optional[Dict[str, Any]] = None
+
+    @property
+    def validated(self) -> bool:
+        return self.validation is not None
+
+    @classmethod
+    def from_decoded(
+        cls,
+        decoded: DecodedAudio,
+        content_hash: str,
+        mime_type: Optional[str] = None,
+        size_bytes: Optional[int] = None
+    ) -> "AudioProbe":
+        return cls(
+            content_hash=content_hash,
+            duration=decoded.duration,
+            sample_rate=decoded.source_sample_rate,
+            channels=decoded.source_channels,
+            codec=decoded.source_codec,
+            mime_type=mime_type,
+            size_bytes=size_bytes,
+            rms=summarize_rms(decoded)
+        )
+
+    @classmethod
+    def from_headers(
+        cls,
+        content_hash: str,
+        duration: float,
+        mime_type: Optional[str] = None,
+        size_bytes: Optional[int] = None
+    ) -> "AudioProbe":
+        """Probe carrying only the duration read from the container headers."""
+        return cls(
+            content_hash=content_hash,
+            duration=duration,
+            sample_rate=None,
+            channels=None,
+            codec=None,
+            mime_type=mime_type,
+            size_bytes=size_bytes
+        )
+
+    def with_validation(self, validation_details: Dict[str, Any]) -> "AudioProbe":
+        """Return a copy carrying the validator's VAD segments and verdict."""
+        return replace(
+            self,
+            speech_segments=validation_details.get("speech_segments"),
+            speech_ratio=validation_details.get("speech_ratio"),
+            validation=validation_details
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "content_hash": self.content_hash,
+            "duration": self.duration,
+            "sample_rate": self.sample_rate,
+            "channels": self.channels,
+            "codec": self.codec,
+            "mime_type": self.mime_type,
+            "size_bytes": self.size_bytes,
+            "rms": self.rms,
+            "speech_segments": self.speech_segments,
+            "speech_ratio": self.speech_ratio,
+            "validation": self.validation
+        }
@@ -0,0 +1,78 @@
+"""Lightweight in-process metrics sink.
+
+Counters, gauges and timing observations are kept in memory and exposed
+through snapshot() so routers can serve them without an external backend.
+"""
+
+import threading
+from typing import Dict, Any, Tuple
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_key(key: MetricKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}"
+
+
+class MetricsSink:
+    """Thread-safe store for counters, gauges and observations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[MetricKey, float] = {}
+        self._gauges: Dict[MetricKey, float] = {}
+        self._observations: Dict[MetricKey, Dict[str, float]] = {}
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """Add value to a monotonically increasing counter."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        """Set a gauge to its current value."""
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record a sample (e.g. a latency) keeping count, sum and max."""
+        key = _key(name, labels)
+        with self._lock:
+            stats = self._observations.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["max"] = max(stats["max"], value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a JSON-serialisable copy of all metrics."""
+        with self._lock:
+            return {
+                "counters": {_format_key(k): v for k, v in self._counters.items()},
+                "gauges": {_format_key(k): v for k, v in self._gauges.items()},
+                "observations": {
+                    _format_key(k): {
+                        **v,
+                        "avg": v["sum"] / v["count"] if v["count"] else 0.0
+                    }
+                    for k, v in self._observations.items()
+                }
+            }
+
+    def reset(self) -> None:
+        """Clear all recorded metrics."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._observations.clear()
+
+
+# Create singleton instance
+metrics = MetricsSink()
@@ -0,0 +1,230 @@
+"""Multiplexed client for the conversation WebSocket.
+
+Instead of one socket per Telegram user, conversations share a few
+connections to /api/conversation/mux, each tagged with a session id (see
+conversation_mux_endpoint for the frame format). Every conversation has a
+bounded inbox and grants the server credit only as it consumes messages, so
+a user who stops reading holds up nobody else. Conversations idle for
+longer than idle_seconds are closed, and so are connections left without
+conversations.
+"""
+
+import json
+import time
+import asyncio
+import logging
+import itertools
+from typing import Dict, Any, Optional
+import websockets
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_CLOSED = object()
+
+
+class ConversationClosed(Exception):
+    """The server ended the conversation or the connection carrying it was lost."""
+
+
+class _Conversation:
+    def __init__(self, key: Any, session_id: str, connection: "_Connection", max_pending: int):
+        self.key = key
+        self.session_id = session_id
+        self.connection = connection
+        self.inbox: asyncio.Queue = asyncio.Queue(max_pending)
+        self.last_active = time.monotonic()
+
+
+class _Connection:
+    def __init__(self, url: str):
+        self.url = url
+        self.websocket = None
+        self.reader: Optional[asyncio.Task] = None
+        self.conversations: Dict[str, _Conversation] = {}
+        self.last_active = time.monotonic()
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def open(self) -> bool:
+        return self.websocket is not None and self.reader is not None and not self.reader.done()
+
+    async def ensure_open(self) -> None:
+        async with self._connect_lock:
+            if not self.open:
+                self.websocket = await websockets.connect(self.url)
+                self.reader = asyncio.create_task(self._read())
+                metrics.increment("ws_mux_connects")
+                logger.info(f"Mux connection to {self.url} established")
+
+    async def send(self, frame: Dict[str, Any]) -> None:
+        await self.websocket.send(json.dumps(frame))
+        self.last_active = time.monotonic()
+
+    async def _read(self) -> None:
+        try:
+            async for raw in self.websocket:
+                frame = json.loads(raw)
+                conversation = self.conversations.get(frame.get("session"))
+                if conversation is None:
+                    # Frames for conversations that were already closed
+                    continue
+                if frame.get("type") == "message":
+                    # Cannot overflow: the server sends no more than the credit granted
+                    conversation.inbox.put_nowait(frame.get("text", ""))
+                elif frame.get("type") == "closed":
+                    self._end(conversation)
+                elif frame.get("type") == "error":
+                    logger.warning(f"Mux session {conversation.session_id}: {frame.get('error')}")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.error(f"Mux connection to {self.url} failed: {e}")
+        finally:
+            for conversation in list(self.conversations.values()):
+                self._end(conversation)
+
+    def _end(self, conversation: _Conversation) -> None:
+        self.conversations.pop(conversation.session_id, None)
+        try:
+            conversation.inbox.put_nowait(_CLOSED)
+        except asyncio.QueueFull:
+            # receive notices the conversation is gone once the inbox drains
+            pass
+
+    async def close(self) -> None:
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+        self.websocket = None
+        self.reader = None
+
+
+class ConversationMux:
+    def __init__(
+        self,
+        url: str,
+        connections: int = 2,
+        max_pending: int = 8,
+        idle_seconds: float = 900,
+        receive_timeout: float = 120
+    ):
+        """Initialize the multiplexer; connections are opened on first use.
+
+        Args:
+            url: ws:// URL of the conversation mux endpoint
+            connections: Connections conversations are spread over
+            max_pending: Unread server messages per conversation before the
+                server has to wait
+            idle_seconds: Inactivity after which a conversation, and then an
+                unused connection, is closed
+            receive_timeout: Default seconds receive waits for a reply
+        """
+        self.url = url
+        self.max_pending = max_pending
+        self.idle_seconds = idle_seconds
+        self.receive_timeout = receive_timeout
+        self._connections = [_Connection(url) for _ in range(connections)]
+        self._conversations: Dict[Any, _Conversation] = {}
+        self._session_ids = itertools.count(1)
+        self._reaper: Optional[asyncio.Task] = None
+
+    def has_session(self, key: Any) -> bool:
+        conversation = self._conversations.get(key)
+        return conversation is not None and conversation.session_id in conversation.connection.conversations
+
+    async def _conversation(self, key: Any) -> _Conversation:
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+        if self.has_session(key):
+            return self._conversations[key]
+        connection = self._connections[hash(key) % len(self._connections)]
+        await connection.ensure_open()
+        # Fresh id per conversation, so late frames of a finished one are ignored
+        session_id = f"{key}:{next(self._session_ids)}"
+        conversation = _Conversation(key, session_id, connection, self.max_pending)
+        connection.conversations[session_id] = conversation
+        self._conversations[key] = conversation
+        metrics.gauge("ws_mux_conversations", len(self._conversations))
+        return conversation
+
+    async def send(self, key: Any, text: str) -> None:
+        """Send text in key's conversation, starting a new one if none is open."""
+        conversation = await self._conversation(key)
+        conversation.last_active = time.monotonic()
+        await conversation.connection.send({
+            "type": "message",
+            "session": conversation.session_id,
+            "text": text,
+            "window": self.max_pending
+        })
+
+    async def receive(self, key: Any, timeout: Optional[float] = None) -> str:
+        """Wait for the next message in key's conversation.
+
+        Raises:
+            ConversationClosed: If the conversation ended or its connection was lost
+            asyncio.TimeoutError: If no message arrived within timeout
+        """
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            raise ConversationClosed(f"No conversation for {key}")
+        ended = conversation.session_id not in conversation.connection.conversations
+        if ended and conversation.inbox.empty():
+            text = _CLOSED
+        else:
+            text = await asyncio.wait_for(conversation.inbox.get(),
+                                          timeout or self.receive_timeout)
+        if text is _CLOSED:
+            self._conversations.pop(key, None)
+            raise ConversationClosed(f"Conversation {conversation.session_id} ended")
+        conversation.last_active = time.monotonic()
+        if not ended:
+            await conversation.connection.send(
+                {"type": "credit", "session": conversation.session_id, "n": 1})
+        return text
+
+    async def close_session(self, key: Any) -> None:
+        """End key's conversation, if one is open."""
+        conversation = self._conversations.pop(key, None)
+        if conversation is None:
+            return
+        conversation.connection.conversations.pop(conversation.session_id, None)
+        metrics.gauge("ws_mux_conversations", len(self._conversations))
+        if conversation.connection.open:
+            try:
+                await conversation.connection.send(
+                    {"type": "close", "session": conversation.session_id})
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(min(60, self.idle_seconds / 4))
+            cutoff = time.monotonic() - self.idle_seconds
+            for key, conversation in list(self._conversations.items()):
+                if conversation.last_active < cutoff:
+                    logger.info(f"Closing idle conversation {conversation.session_id}")
+                    await self.close_session(key)
+            for connection in self._connections:
+                if connection.open and not connection.conversations and connection.last_active < cutoff:
+                    logger.info(f"Closing idle mux connection to {self.url}")
+                    await connection.close()
+
+    async def close(self) -> None:
+        """Close every conversation and connection."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for key in list(self._conversations):
+            await self.close_session(key)
+        for connection in self._connections:
+            await connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conversations": len(self._conversations),
+            "open_connections": sum(1 for connection in self._connections if connection.open),
+            "max_pending": self.max_pending
+        }
@@ -0,0 +1,370 @@
+"""Conversation state of the Telegram onboarding flow.
+
+Each user's onboarding step and collected answers (voice file ids, Gemini
+analyses, corrected name) live in the telegram_users row: tutorial_state
+holds the step and tutorial_data the answers. The store keeps recently
+active users in an LRU cache and writes changes back in batches; users idle
+for longer than idle_seconds are flushed and evicted, so memory stays flat
+however many users the bot has seen.
+
+With several worker processes (webhook mode) a user's updates may land on
+any worker, so the store runs in shared mode: reads go to the database and
+writes go through immediately.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE = "awaiting_name_input"
+
+# Flask(__name__).instance_path of app.py, where Flask-SQLAlchemy puts
+# relative SQLite databases
+INSTANCE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "instance")
+
+
+@dataclass
+class ConversationState:
+    state: str = DEFAULT_STATE
+    profile: Dict[str, Any] = field(default_factory=dict)
+
+
+class StateBackend:
+    """Interface shared by the persistence backends."""
+
+    def open(self) -> None:
+        """Check the backend is usable before the first update is handled."""
+
+    def load(self, user_id: int) -> Optional[ConversationState]:
+        """Stored state of user_id, or None if the user is unknown."""
+        raise NotImplementedError
+
+    def save(self, states: Dict[int, ConversationState]) -> None:
+        """Persist the given states, creating users as needed."""
+        raise NotImplementedError
+
+
+class MemoryStateBackend(StateBackend):
+    """Keeps states in a dict; for a single process without a database."""
+
+    def __init__(self):
+        self._states: Dict[int, ConversationState] = {}
+
+    def load(self, user_id: int) -> Optional[ConversationState]:
+        stored = self._states.get(user_id)
+        return ConversationState(stored.state, dict(stored.profile)) if stored else None
+
+    def save(self, states: Dict[int, ConversationState]) -> None:
+        for user_id, state in states.items():
+            self._states[user_id] = ConversationState(state.state, dict(state.profile))
+
+
+def _resolve_database_url(url: str) -> str:
+    """Resolve a relative SQLite path under INSTANCE_PATH, as Flask-SQLAlchemy does."""
+    from sqlalchemy.engine import make_url
+
+    parsed = make_url(url)
+    if parsed.drivername not in {"sqlite", "sqlite+pysqlite"} or parsed.database in {None, "", ":memory:"}:
+        return url
+    is_uri = parsed.query.get("uri", False)
+    path = parsed.database[5:] if is_uri else parsed.database
+    if os.path.isabs(path):
+        return url
+    path = os.path.join(INSTANCE_PATH, path)
+    return parsed.set(database=f"file:{path}" if is_uri else path).render_as_string(hide_password=False)
+
+
+class TelegramUserStateBackend(StateBackend):
+    """Stores states in the telegram_users table of the application database.
+
+    The bot runs outside the Flask app, so this talks to the table through a
+    plain SQLAlchemy engine instead of the Flask-SQLAlchemy session.
+    """
+
+    def __init__(self, database_url: str):
+        self.database_url = database_url
+        self._engine = None
+        self._table = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        """Lazy initialization of the engine, after checking the schema it writes.
+
+        Raises:
+            RuntimeError: If telegram_users is missing or cannot be upgraded
+        """
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    from sqlalchemy import create_engine, inspect
+                    from models.auth import TelegramUser
+                    from models.migrations import upgrade_schema
+
+                    engine = create_engine(_resolve_database_url(self.database_url),
+                                           pool_pre_ping=True)
+                    if TelegramUser.__tablename__ not in inspect(engine).get_table_names():
+                        raise RuntimeError(
+                            f"No {TelegramUser.__tablename__} table in {engine.url!r}; "
+                            "start the app once to create the schema")
+                    # Rows are created without a linked account and need tutorial_data
+                    upgrade_schema(engine)
+                    self._table = TelegramUser.__table__
+                    self._engine = engine
+        return self._engine
+
+    def open(self) -> None:
+        # Builds the engine, which checks and upgrades the table
+        _ = self.engine
+
+    def load(self, user_id: int) -> Optional[ConversationState]:
+        from sqlalchemy import select
+
+        engine = self.engine
+        table = self._table
+        with engine.connect() as conn:
+            row = conn.execute(
+                select(table.c.tutorial_state, table.c.tutorial_data)
+                .where(table.c.telegram_id == user_id)).first()
+        if row is None:
+            return None
+        return ConversationState(row.tutorial_state or DEFAULT_STATE, dict(row.tutorial_data or {}))
+
+    def save(self, states: Dict[int, ConversationState]) -> None:
+        from sqlalchemy import insert, update
+        from sqlalchemy.exc import IntegrityError
+
+        engine = self.engine
+        table = self._table
+        now = datetime.utcnow()
+        for user_id, state in states.items():
+            values = {
+                "tutorial_state": state.state,
+                "tutorial_data": state.profile,
+                "onboarding_completed": state.state == "completed",
+                "last_interaction": now
+            }
+            with engine.begin() as conn:
+                result = conn.execute(
+                    update(table).where(table.c.telegram_id == user_id).values(**values))
+                if result.rowcount:
+                    continue
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(table).values(telegram_id=user_id, **values))
+            except IntegrityError:
+                # Only a unique violation on telegram_id (another worker created
+                # the row in the meantime) is recoverable: the row must now exist
+                with engine.begin() as conn:
+                    result = conn.execute(
+                        update(table).where(table.c.telegram_id == user_id).values(**values))
+                if result.rowcount != 1:
+                    raise
+
+
+@dataclass
+class _Entry:
+    state: ConversationState
+    last_access: float
+    version: int = 0
+    saved_version: int = 0
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.saved_version
+
+
+class ConversationStateStore:
+    def __init__(
+        self,
+        backend: StateBackend,
+        max_entries: int = 10000,
+        idle_seconds: float = 3600,
+        flush_interval: float = 5.0,
+        shared: bool = False
+    ):
+        """Initialize the store.
+
+        Args:
+            backend: Where states are persisted
+            max_entries: Users kept in the cache
+            idle_seconds: Inactivity after which a user is evicted
+            flush_interval: Seconds between write-backs of changed states
+            shared: Read and write through to the backend on every access,
+                for when several processes handle the same users
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _entry(self, user_id: int) -> _Entry:
+        entry = self._entries.get(user_id)
+        if entry is not None and not self.shared:
+            self._entries.move_to_end(user_id)
+            entry.last_access = time.monotonic()
+            metrics.increment("telegram_state_cache_hits")
+            return entry
+
+        metrics.increment("telegram_state_cache_misses")
+        stored = await asyncio.to_thread(self.backend.load, user_id)
+        # Another coroutine may have cached the user while this one was loading
+        entry = self._entries.get(user_id)
+        if entry is None or self.shared:
+            entry = _Entry(stored or ConversationState(), time.monotonic())
+            self._entries[user_id] = entry
+            self._evict_over_capacity()
+        return entry
+
+    async def _changed(self, user_id: int, entry: _Entry) -> None:
+        entry.version += 1
+        if self.shared:
+            await self._save({user_id: entry})
+
+    async def get_state(self, user_id: int) -> str:
+        return (await self._entry(user_id)).state.state
+
+    async def set_state(self, user_id: int, state: str) -> None:
+        entry = await self._entry(user_id)
+        entry.state.state = state
+        await self._changed(user_id, entry)
+
+    async def get_profile(self, user_id: int) -> Dict[str, Any]:
+        """Copy of the answers collected from user_id so far."""
+        return dict((await self._entry(user_id)).state.profile)
+
+    async def update_profile(self, user_id: int, replace: bool = False, **fields: Any) -> None:
+        """Merge fields into user_id's answers, or replace them all if replace is set."""
+        entry = await self._entry(user_id)
+        if replace:
+            entry.state.profile = {}
+        entry.state.profile.update(fields)
+        await self._changed(user_id, entry)
+
+    async def _save(self, entries: Dict[int, _Entry]) -> None:
+        versions = {user_id: entry.version for user_id, entry in entries.items()}
+        snapshot = {
+            user_id: ConversationState(entry.state.state, dict(entry.state.profile))
+            for user_id, entry in entries.items()
+        }
+        await asyncio.to_thread(self.backend.save, snapshot)
+        for user_id, entry in entries.items():
+            entry.saved_version = max(entry.saved_version, versions[user_id])
+        metrics.increment("telegram_state_writes", len(snapshot))
+
+    async def flush(self) -> None:
+        """Write back every changed state."""
+        async with self._flush_lock:
+            dirty = {user_id: entry for user_id, entry in self._entries.items() if entry.dirty}
+            if dirty:
+                await self._save(dirty)
+
+    def _evict_over_capacity(self) -> None:
+        # Only clean entries can go without losing changes; dirty ones are
+        # written back and evicted by the next maintenance pass
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        victims: List[int] = []
+        for user_id, entry in self._entries.items():
+            if len(victims) >= excess:
+                break
+            if not entry.dirty:
+                victims.append(user_id)
+        for user_id in victims:
+            del self._entries[user_id]
+        metrics.increment("telegram_state_evictions", len(victims))
+
+    def _evict_idle(self) -> None:
+        cutoff = time.monotonic() - self.idle_seconds
+        idle = [user_id for user_id, entry in self._entries.items()
+                if entry.last_access < cutoff and not entry.dirty]
+        for user_id in idle:
+            del self._entries[user_id]
+        if idle:
+            metrics.increment("telegram_state_evictions", len(idle))
+
+    async def maintain(self) -> None:
+        """Write back changes, then evict idle users and any over capacity."""
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Writing back Telegram conversation states failed: {e}")
+        self._evict_idle()
+        self._evict_over_capacity()
+        metrics.gauge("telegram_state_cache_size", len(self._entries))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.maintain()
+
+    async def start(self) -> None:
+        """Open the backend and start the periodic write-back on the running loop.
+
+        A single polling process can do without the database, so if the
+        backend cannot be opened there, states are kept in memory instead.
+        In shared mode the error is raised.
+        """
+        try:
+            await asyncio.to_thread(self.backend.open)
+        except Exception as e:
+            if self.shared:
+                raise
+            logger.warning(f"Conversation state backend unavailable, keeping states in memory: {e}")
+            self.backend = MemoryStateBackend()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the write-back and flush what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached_users": len(self._entries),
+            "dirty_users": sum(1 for entry in self._entries.values() if entry.dirty),
+            "max_entries": self.max_entries,
+            "shared": self.shared
+        }
+
+
+def create_state_backend(url: Optional[str] = None) -> StateBackend:
+    """Build a backend from a URL: a SQLAlchemy database URL or memory://.
+
+    Defaults to TELEGRAM_STATE_URL, then to the application's DATABASE_URL,
+    whose relative SQLite paths point into the app's instance folder.
+    """
+    url = url or os.getenv("TELEGRAM_STATE_URL") or os.getenv("DATABASE_URL", "sqlite:///./app.db")
+    if url.startswith("memory://"):
+        return MemoryStateBackend()
+    return TelegramUserStateBackend(url)
+
+
+# Create singleton instance
+state_store = ConversationStateStore(
+    create_state_backend(),
+    max_entries=int(os.getenv("TELEGRAM_STATE_CACHE_SIZE", "10000")),
+    idle_seconds=float(os.getenv("TELEGRAM_STATE_IDLE_SECONDS", "3600")),
+    flush_interval=float(os.getenv("TELEGRAM_STATE_FLUSH_INTERVAL", "5")))
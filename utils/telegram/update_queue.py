@@ -0,0 +1,365 @@
+"""Durable queue of Telegram updates between the webhook and bot workers.
+
+The webhook pushes raw updates; any number of worker processes lease them,
+run the bot handlers and ack. Guarantees:
+
+- Dedup: an update_id is accepted once (Telegram re-delivers on timeouts),
+  and finished ids are remembered for retention_seconds.
+- Leases: a leased update is invisible to other workers until it is acked,
+  released or its lease expires (worker crash), so nothing is dropped. The
+  worker renews the lease while its handlers run, so slow handlers keep
+  their update and a healthy worker never sees another worker's update.
+- Per-chat ordering: only the oldest unfinished update of a chat can be
+  leased, so one chat's updates are handled one at a time, in order.
+- Poison updates are parked as dead after max_attempts.
+
+UpdateQueue is the interface a Redis-backed queue would implement;
+SQLiteUpdateQueue serves workers on one host and MemoryUpdateQueue only
+works when the webhook and the worker share a process.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Any, Optional
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+
+@dataclass
+class LeasedUpdate:
+    update_id: int
+    chat_id: Optional[int]
+    payload: Dict[str, Any]
+    attempts: int
+
+
+def update_chat_id(payload: Dict[str, Any]) -> Optional[int]:
+    """Chat an update belongs to, used to keep each chat's updates in order."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if payload.get(field):
+            return payload[field].get("chat", {}).get("id")
+    callback = payload.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"].get("chat", {}).get("id")
+    for field in ("inline_query", "chosen_inline_result", "my_chat_member", "chat_member"):
+        if payload.get(field):
+            sender = payload[field].get("from") or payload[field].get("chat") or {}
+            return sender.get("id")
+    return None
+
+
+class UpdateQueue:
+    """Interface shared by the queue backends."""
+
+    def __init__(self, lease_seconds: float = 300, max_attempts: int = 5,
+                 retention_seconds: float = 24 * 3600):
+        """
+        Args:
+            lease_seconds: How long a leased update stays invisible to other workers
+            max_attempts: Leases per update before it is parked as dead
+            retention_seconds: How long finished update ids are kept for dedup
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+
+    def push(self, payload: Dict[str, Any]) -> bool:
+        """Enqueue a raw update; False if its update_id was already seen."""
+        raise NotImplementedError
+
+    def lease(self, worker_id: str, limit: int = 1) -> List[LeasedUpdate]:
+        """Lease up to limit updates, at most one per chat."""
+        raise NotImplementedError
+
+    def renew(self, update_id: int, worker_id: str) -> bool:
+        """Extend worker_id's lease by lease_seconds; False if the lease was lost."""
+        raise NotImplementedError
+
+    def ack(self, update_id: int, worker_id: str) -> bool:
+        """Mark a leased update as handled; False if the lease was lost."""
+        raise NotImplementedError
+
+    def release(self, update_id: int, worker_id: str, delay: float = 0) -> None:
+        """Give a leased update back for a retry after delay seconds."""
+        raise NotImplementedError
+
+    def purge(self) -> None:
+        """Forget finished updates older than retention_seconds."""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class SQLiteUpdateQueue(UpdateQueue):
+    """Queue in a SQLite file shared by the webhook and worker processes."""
+
+    def __init__(self, db_path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Lazy initialization of the SQLite connection."""
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Autocommit mode; transactions are opened explicitly
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS telegram_updates ("
+                "update_id INTEGER PRIMARY KEY, chat_id INTEGER, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL, lease_owner TEXT, lease_expires REAL, "
+                "available_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, finished_at REAL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_telegram_updates_chat "
+                "ON telegram_updates(chat_id, status, update_id)")
+            self._conn = conn
+        return self._conn
+
+    def push(self, payload: Dict[str, Any]) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO telegram_updates "
+                "(update_id, chat_id, payload, status, available_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (payload["update_id"], update_chat_id(payload), json.dumps(payload), PENDING, now, now))
+        accepted = cursor.rowcount == 1
+        metrics.increment("telegram_updates_pushed" if accepted else "telegram_updates_duplicate")
+        return accepted
+
+    def lease(self, worker_id: str, limit: int = 1) -> List[LeasedUpdate]:
+        now = time.time()
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases count as pending again; per chat only the
+                # oldest unfinished update is eligible
+                rows = conn.execute(
+                    "SELECT u.update_id, u.chat_id, u.payload, u.attempts FROM telegram_updates u "
+                    "WHERE (u.status = ? OR (u.status = ? AND u.lease_expires < ?)) "
+                    "AND u.available_at <= ? "
+                    "AND (u.chat_id IS NULL OR u.update_id = ("
+                    "  SELECT MIN(v.update_id) FROM telegram_updates v "
+                    "  WHERE v.chat_id = u.chat_id AND v.status IN (?, ?))) "
+                    "ORDER BY u.update_id LIMIT ?",
+                    (PENDING, LEASED, now, now, PENDING, LEASED, limit)).fetchall()
+                leased = []
+                for update_id, chat_id, payload, attempts in rows:
+                    if attempts >= self.max_attempts:
+                        conn.execute(
+                            "UPDATE telegram_updates SET status = ?, finished_at = ? WHERE update_id = ?",
+                            (DEAD, now, update_id))
+                        metrics.increment("telegram_updates_dead")
+                        logger.error(f"Telegram update {update_id} failed {attempts} times; parked as dead")
+                        continue
+                    conn.execute(
+                        "UPDATE telegram_updates SET status = ?, lease_owner = ?, lease_expires = ?, "
+                        "attempts = attempts + 1 WHERE update_id = ?",
+                        (LEASED, worker_id, now + self.lease_seconds, update_id))
+                    leased.append(LeasedUpdate(update_id, chat_id, json.loads(payload), attempts + 1))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return leased
+
+    def renew(self, update_id: int, worker_id: str) -> bool:
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE telegram_updates SET lease_expires = ? "
+                "WHERE update_id = ? AND lease_owner = ? AND status = ?",
+                (time.time() + self.lease_seconds, update_id, worker_id, LEASED))
+        return cursor.rowcount == 1
+
+    def ack(self, update_id: int, worker_id: str) -> bool:
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE telegram_updates SET status = ?, finished_at = ?, payload = '{}' "
+                "WHERE update_id = ? AND lease_owner = ? AND status = ?",
+                (DONE, time.time(), update_id, worker_id, LEASED))
+        if cursor.rowcount != 1:
+            logger.warning(f"Ack for Telegram update {update_id} by {worker_id} after its lease was lost")
+            return False
+        return True
+
+    def release(self, update_id: int, worker_id: str, delay: float = 0) -> None:
+        with self._lock:
+            self.conn.execute(
+                "UPDATE telegram_updates SET status = ?, lease_owner = NULL, lease_expires = NULL, "
+                "available_at = ? WHERE update_id = ? AND lease_owner = ? AND status = ?",
+                (PENDING, time.time() + delay, update_id, worker_id, LEASED))
+
+    def purge(self) -> None:
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM telegram_updates WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, DEAD, time.time() - self.retention_seconds))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self.conn.execute(
+                "SELECT status, COUNT(*) FROM telegram_updates GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in (PENDING, LEASED, DONE, DEAD)}
+
+
+class MemoryUpdateQueue(UpdateQueue):
+    """In-process queue with the same semantics, for a webhook and worker sharing one process."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._updates: Dict[int, Dict[str, Any]] = {}
+
+    def push(self, payload: Dict[str, Any]) -> bool:
+        now = time.time()
+        with self._lock:
+            if payload["update_id"] in self._updates:
+                metrics.increment("telegram_updates_duplicate")
+                return False
+            self._updates[payload["update_id"]] = {
+                "chat_id": update_chat_id(payload), "payload": payload, "status": PENDING,
+                "lease_owner": None, "lease_expires": None, "available_at": now,
+                "attempts": 0, "finished_at": None
+            }
+        metrics.increment("telegram_updates_pushed")
+        return True
+
+    def lease(self, worker_id: str, limit: int = 1) -> List[LeasedUpdate]:
+        now = time.time()
+        leased = []
+        with self._lock:
+            seen_chats = set()
+            for update_id in sorted(self._updates):
+                entry = self._updates[update_id]
+                if entry["status"] not in (PENDING, LEASED):
+                    continue
+                chat_id = entry["chat_id"]
+                # Only the oldest unfinished update of each chat is eligible
+                if chat_id is not None:
+                    if chat_id in seen_chats:
+                        continue
+                    seen_chats.add(chat_id)
+                expired = entry["status"] == LEASED and entry["lease_expires"] < now
+                if not (entry["status"] == PENDING or expired) or entry["available_at"] > now:
+                    continue
+                if entry["attempts"] >= self.max_attempts:
+                    entry.update(status=DEAD, finished_at=now)
+                    metrics.increment("telegram_updates_dead")
+                    logger.error(f"Telegram update {update_id} failed {entry['attempts']} times; parked as dead")
+                    continue
+                entry.update(status=LEASED, lease_owner=worker_id,
+                             lease_expires=now + self.lease_seconds, attempts=entry["attempts"] + 1)
+                leased.append(LeasedUpdate(update_id, chat_id, entry["payload"], entry["attempts"]))
+                if len(leased) >= limit:
+                    break
+        return leased
+
+    def _owned(self, update_id: int, worker_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._updates.get(update_id)
+        if entry is None or entry["status"] != LEASED or entry["lease_owner"] != worker_id:
+            return None
+        return entry
+
+    def renew(self, update_id: int, worker_id: str) -> bool:
+        with self._lock:
+            entry = self._owned(update_id, worker_id)
+            if entry is None:
+                return False
+            entry["lease_expires"] = time.time() + self.lease_seconds
+            return True
+
+    def ack(self, update_id: int, worker_id: str) -> bool:
+        with self._lock:
+            entry = self._owned(update_id, worker_id)
+            if entry is None:
+                logger.warning(f"Ack for Telegram update {update_id} by {worker_id} after its lease was lost")
+                return False
+            entry.update(status=DONE, finished_at=time.time(), payload={})
+            return True
+
+    def release(self, update_id: int, worker_id: str, delay: float = 0) -> None:
+        with self._lock:
+            entry = self._owned(update_id, worker_id)
+            if entry is not None:
+                entry.update(status=PENDING, lease_owner=None, lease_expires=None,
+                             available_at=time.time() + delay)
+
+    def purge(self) -> None:
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            for update_id in [u for u, e in self._updates.items()
+                              if e["status"] in (DONE, DEAD) and e["finished_at"] < cutoff]:
+                del self._updates[update_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            statuses = [entry["status"] for entry in self._updates.values()]
+        return {status: statuses.count(status) for status in (PENDING, LEASED, DONE, DEAD)}
+
+
+def create_update_queue(url: Optional[str] = None, in_process: bool = False,
+                        **kwargs) -> UpdateQueue:
+    """Build a queue from a URL: sqlite:///path/to/file.db or memory://.
+
+    Defaults to TELEGRAM_UPDATE_QUEUE_URL. The webhook and the workers run in
+    separate processes, so an unusable queue raises instead of degrading to
+    a private one that would silently swallow every update.
+
+    Args:
+        url: Queue URL
+        in_process: The webhook and the worker share this process, which is
+            the only case where memory:// can deliver anything
+
+    Raises:
+        ValueError: For an unsupported URL, or memory:// across processes
+        sqlite3.Error: If the SQLite file cannot be opened
+    """
+    url = url or os.getenv("TELEGRAM_UPDATE_QUEUE_URL",
+                           "sqlite:///" + os.path.join(".cache", "telegram_updates.db"))
+    if url.startswith("memory://"):
+        if not in_process:
+            raise ValueError("memory:// update queues are not shared between the webhook "
+                             "and worker processes; use a sqlite:/// URL")
+        return MemoryUpdateQueue(**kwargs)
+    if url.startswith("sqlite:///"):
+        queue = SQLiteUpdateQueue(url[len("sqlite:///"):], **kwargs)
+        # Open now so a bad path fails at startup, not on the first update
+        queue.conn
+        return queue
+    raise ValueError(f"Unsupported Telegram update queue URL: {url}")
+
+
+_update_queue: Optional[UpdateQueue] = None
+_update_queue_lock = threading.Lock()
+
+
+def get_update_queue() -> UpdateQueue:
+    """Process-wide update queue, configured from the environment on first use."""
+    global _update_queue
+    if _update_queue is None:
+        with _update_queue_lock:
+            if _update_queue is None:
+                _update_queue = create_update_queue(
+                    lease_seconds=float(os.getenv("TELEGRAM_UPDATE_LEASE_SECONDS", "300")),
+                    max_attempts=int(os.getenv("TELEGRAM_UPDATE_MAX_ATTEMPTS", "5")))
+    return _update_queue
@@ -0,0 +1,76 @@
+"""Per-user job queues for the Telegram bot.
+
+Each user's updates run strictly in order (the onboarding state machine
+depends on it) while different users run concurrently. A worker task exists
+only while a user has pending jobs, and a global semaphore caps how many
+jobs run at once across all users.
+"""
+
+import logging
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Any
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class UserQueues:
+    def __init__(self, max_pending_per_user: int = 5, max_concurrent_jobs: int = 16):
+        """Initialize the queues.
+
+        Args:
+            max_pending_per_user: Jobs a user may have waiting behind the
+                running one before new ones are rejected
+            max_concurrent_jobs: Jobs running at once across all users
+        """
+        self.max_pending_per_user = max_pending_per_user
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self._queues: Dict[Hashable, asyncio.Queue] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self._slots = asyncio.Semaphore(max_concurrent_jobs)
+
+    def submit(self, user_id: Hashable, job: Job) -> bool:
+        """Queue job behind the user's earlier jobs; False if their queue is full."""
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = asyncio.Queue(self.max_pending_per_user)
+        try:
+            queue.put_nowait(job)
+        except asyncio.QueueFull:
+            metrics.increment("telegram_jobs_rejected")
+            return False
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._drain(user_id, queue))
+        metrics.gauge("telegram_active_users", len(self._workers))
+        return True
+
+    async def _drain(self, user_id: Hashable, queue: asyncio.Queue) -> None:
+        try:
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                async with self._slots:
+                    try:
+                        await job()
+                    except Exception:
+                        logger.exception(f"Telegram job failed for user {user_id}")
+                    finally:
+                        queue.task_done()
+        finally:
+            # No await since the queue was found empty, so no job can have slipped in
+            self._workers.pop(user_id, None)
+            if queue.empty():
+                self._queues.pop(user_id, None)
+            metrics.gauge("telegram_active_users", len(self._workers))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_users": len(self._workers),
+            "pending_jobs": sum(queue.qsize() for queue in self._queues.values()),
+            "max_pending_per_user": self.max_pending_per_user,
+            "max_concurrent_jobs": self.max_concurrent_jobs
+        }